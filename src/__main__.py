@@ -89,6 +89,10 @@ def main() -> None:
     fallback_handlers = [
         CommandHandler("stop", stop),
         CommandHandler("res", res),
+        CommandHandler("days", days),
+        CommandHandler("expand", expand),
+        CommandHandler("fastlock", fastlock),
+        CommandHandler("snipe", snipe),
         CallbackQueryHandler(handle_datetime_type, pattern=datetime),
         MessageHandler(filters.COMMAND, unknown_command),
     ]
@@ -262,6 +266,10 @@ def main() -> None:
     inline_caps_handler = InlineQueryHandler(inline_funcs)
     datetime_type_handler = CallbackQueryHandler(handle_datetime_type, pattern=datetime)
     res_handler = CommandHandler("res", res)
+    days_handler = CommandHandler("days", days)
+    expand_handler = CommandHandler("expand", expand)
+    fastlock_handler = CommandHandler("fastlock", fastlock)
+    snipe_handler = CommandHandler("snipe", snipe)
     unknown_command_handler = MessageHandler(filters.COMMAND, unknown_command)
 
     app.add_handlers(
@@ -269,6 +277,10 @@ def main() -> None:
             main_conv_handler,
             inline_caps_handler,
             res_handler,
+            days_handler,
+            expand_handler,
+            fastlock_handler,
+            snipe_handler,
             datetime_type_handler,
             unknown_command_handler,
         ]
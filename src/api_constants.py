@@ -25,6 +25,143 @@ MERNIS_DOGRULAMA_ENDPOINT = (
     "https://api-yebsp.tcddtasimacilik.gov.tr/yebsp/tcNoMernisDogrula"
 )
 
+# per endpoint request timeouts in seconds, DEFAULT_TIMEOUT is used for the rest
+DEFAULT_TIMEOUT = 10
+ENDPOINT_TIMEOUTS = {
+    STATION_LIST_ENDPOINT: 10,
+    TRIP_SEARCH_ENDPOINT: 10,
+    VAGON_SEARCH_ENDPOINT: 3,
+    VAGON_HARITA_ENDPOINT: 3,
+    SEAT_CHECK_ENDPOINT: 5,
+    SELECT_EMPTY_SEAT_ENDPOINT: 10,
+    RELEASE_SEAT_ENDPOINT: 5,
+    MERNIS_DOGRULAMA_ENDPOINT: 30,
+}
+
+# cevapKodu values known to be transient, any other non zero code is terminal.
+# 999 is the generic "unexpected system error" answer the backend gives while
+# it is overloaded, e.g. right after the sales of a day open.
+RETRYABLE_RESPONSE_CODES = frozenset({"999"})
+# cevapKodu values of klSec meaning the seat is already locked by someone else
+SEAT_TAKEN_RESPONSE_CODES = frozenset({"604"})
+
+# maximum number of concurrent async requests sent to a single host
+MAX_CONCURRENT_REQUESTS_PER_HOST = 6
+
+# (initial, maximum) in flight requests of the fanned out endpoints, adapted
+# to the upstream health instead of MAX_CONCURRENT_REQUESTS_PER_HOST, see
+# tasks.adaptive_limiter. Their ENDPOINT_TIMEOUTS become upper bounds.
+ADAPTIVE_CONCURRENCY = {
+    VAGON_SEARCH_ENDPOINT: (2, 16),
+    VAGON_HARITA_ENDPOINT: (4, 32),
+}
+
+# cluster wide request rates as (requests per second, burst), shared by every
+# process through redis, see tasks.rate_limiter. HOST_RATE_LIMIT applies to all
+# the requests sent to a host, ENDPOINT_RATE_LIMITS to the polled endpoints.
+HOST_RATE_LIMIT = (10, 20)
+ENDPOINT_RATE_LIMITS = {
+    TRIP_SEARCH_ENDPOINT: (1, 3),
+    VAGON_SEARCH_ENDPOINT: (3, 6),
+    VAGON_HARITA_ENDPOINT: (5, 10),
+}
+# separate request lanes of an endpoint as lane -> (requests per second, burst).
+# The requests of a lane take from its cluster wide bucket instead of the
+# ENDPOINT_RATE_LIMITS one, so the seferSorgula bursts of the sales sniper,
+# see tasks.sales_sniper, never starve the regular searches.
+SNIPER_LANE = "sniper"
+LANE_RATE_LIMITS = {SNIPER_LANE: (2, 4)}
+# seat lock, renewal and payment requests may use the last PRIORITY_RESERVE
+# tokens of the host bucket, search polling may not
+PRIORITY_ENDPOINTS = frozenset(
+    {
+        SEAT_CHECK_ENDPOINT,
+        SELECT_EMPTY_SEAT_ENDPOINT,
+        RELEASE_SEAT_ENDPOINT,
+        VB_ENROLL_CONTROL_ENDPOINT,
+        VB_ODEME_SORGU,
+        TICKET_RESERVATION_ENDPOINT,
+    }
+)
+PRIORITY_RESERVE = 5
+
+# idempotent reads that are duplicated when slower than their p90 latency,
+# at most MAX_HEDGE_RATIO of the requests are hedged, see tasks.hedging
+HEDGED_ENDPOINTS = frozenset(
+    {VAGON_HARITA_ENDPOINT, SEAT_CHECK_ENDPOINT, TRIP_SEARCH_ENDPOINT}
+)
+MAX_HEDGE_RATIO = 0.1
+
+# vagon requests (empty seat counts and vagon maps) per minute a single search
+# may spend over all of its trips, see tasks.poll_scheduler. The cluster wide
+# rate is capped by HOST_RATE_LIMIT.
+POLL_REQUEST_BUDGET = 200
+
+# seconds to share identical responses between the users watching the same
+# route and date, see tasks.response_cache
+RESPONSE_CACHE_TTLS = {
+    TRIP_SEARCH_ENDPOINT: 2,
+    VAGON_HARITA_ENDPOINT: 1,
+}
+# per lane ttls, shorter than the polls of the lane, cached apart from the
+# regular responses so a lane never reads an older one
+LANE_CACHE_TTLS = {SNIPER_LANE: 0.4}
+
+# station order of the YHT lines, used to search the segments around the
+# user's one, see tasks.station_expansion. The names are matched to the station
+# registry ignoring case, punctuation and the YHT and GAR suffixes, stations
+# missing from the registry are skipped.
+YHT_LINES = (
+    (
+        "İSTANBUL(HALKALI)",
+        "İSTANBUL(BAKIRKÖY)",
+        "İSTANBUL(SÖĞÜTLÜÇEŞME)",
+        "İSTANBUL(BOSTANCI)",
+        "İSTANBUL(PENDİK)",
+        "GEBZE",
+        "İZMİT YHT",
+        "ARİFİYE",
+        "BİLECİK YHT",
+        "BOZÜYÜK YHT",
+        "ESKİŞEHİR",
+        "POLATLI YHT",
+        "ERYAMAN YHT",
+        "ANKARA GAR",
+    ),
+    (
+        "ANKARA GAR",
+        "ERYAMAN YHT",
+        "POLATLI YHT",
+        "KONYA",
+        "KARAMAN",
+    ),
+    (
+        "İSTANBUL(HALKALI)",
+        "İSTANBUL(BAKIRKÖY)",
+        "İSTANBUL(SÖĞÜTLÜÇEŞME)",
+        "İSTANBUL(BOSTANCI)",
+        "İSTANBUL(PENDİK)",
+        "GEBZE",
+        "İZMİT YHT",
+        "ARİFİYE",
+        "BİLECİK YHT",
+        "BOZÜYÜK YHT",
+        "ESKİŞEHİR",
+        "KONYA",
+        "KARAMAN",
+    ),
+    (
+        "ANKARA GAR",
+        "ELMADAĞ",
+        "KIRIKKALE YHT",
+        "YERKÖY",
+        "YOZGAT YHT",
+        "SORGUN YHT",
+        "AKDAĞMADENİ YHT",
+        "SİVAS",
+    ),
+)
+
 DISABLED_SEAT_IDS = [
     13485128303,
     13029825502,
@@ -91,6 +228,15 @@ koltuk_sec_req_body = {
     "huawei": False,
 }
 
+koltuk_birak_req_body = {
+    "kanalKodu": "3",
+    "dil": 0,
+    "seferId": None,
+    "vagonSiraNo": None,
+    "koltukNo": None,
+    "koltukLockId": None,
+}
+
 trip_search_req_body = {
     "kanalKodu": 3,
     "dil": 0,
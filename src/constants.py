@@ -61,6 +61,13 @@ FEATURE_HELP_MESSAGES = {
     "seat_type": "Select your seat type",
 }
 
+DAYS_USAGE = (
+    "Usage: /days <days>, e.g. /days Oct 20, Oct 22 - Oct 24 or /days Mon - Fri.\n"
+    "Separate the days with commas and give a range as <first> - <last>. "
+    "Weekdays are searched between the from and the to date of your trip. "
+    "Without days every day from the from date to the to date is searched."
+)
+
 MAIN_MENU_BUTTONS = [
     [
         InlineKeyboardButton("Personal Info", callback_data=str(ADDING_PERSONAL_INFO)),
@@ -39,7 +39,7 @@ def query(from_, to_, from_date=None):
     """Search for trips from from_ to to_ on from_date."""
     try:
         station_list = trip.list_stations()
-    except requests.exceptions.HTTPError as e:
+    except requests.exceptions.RequestException as e:
         logging.error("Error while listing stations: %s", e)
         return [
             InlineQueryResultArticle(
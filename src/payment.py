@@ -2,13 +2,10 @@
 
 import json
 import logging
-import time
 from datetime import datetime
 
-import requests
-from requests.exceptions import RequestException
-
 import api_constants
+from tasks.http_client import get_client
 from tasks.trip_search import TripSearchApi
 
 logger = logging.getLogger(__name__)
@@ -70,9 +67,8 @@ class Payment:
 
         self.enroll_reference = None
         self.vpos_ref = None
-        self.timeout = 10
-        self.retry_delay = 30
-        self.max_retries = 10
+        # None uses the per endpoint timeout of the http client
+        self.timeout = None
         self.odeme_sorgu = {
             "kanalKodu": "3",
             "dil": 0,
@@ -136,22 +132,9 @@ class Payment:
         logger.info("Price request: %s", json.dumps(req_body))
         # send request
 
-        retries = 0
-        while retries < self.max_retries:
-            try:
-                response = requests.post(
-                    api_constants.PRICE_ENDPOINT,
-                    headers=api_constants.REQUEST_HEADER,
-                    data=json.dumps(req_body),
-                    timeout=self.timeout,
-                )
-            except RequestException as e:
-                retries += 1
-                logger.error("Price request failed: %s, retry: %s", e, retries)
-                time.sleep(self.retry_delay)
-            break
-
-        response_json = response.json()
+        response_json = get_client().post(
+            api_constants.PRICE_ENDPOINT, req_body, timeout=self.timeout
+        )
         logger.info("Price response: %s", response_json["anahatFiyatHesSonucDVO"])
         self.normal_price = int(
             response_json["anahatFiyatHesSonucDVO"]["indirimsizToplamUcret"]
@@ -190,27 +173,12 @@ class Payment:
         for seat in self.trip.seat_lock_response["koltuklarimListesi"]:
             self.vb_enroll_control_req["koltukLockList"].append(seat["koltukLockId"])
 
-        retries = 0
-        while retries < self.max_retries:
-            try:
-                response = requests.post(
-                    api_constants.VB_ENROLL_CONTROL_ENDPOINT,
-                    headers=api_constants.REQUEST_HEADER,
-                    data=json.dumps(self.vb_enroll_control_req),
-                    timeout=self.timeout,
-                )
-            except RequestException as e:
-                retries += 1
-                logger.error("Payment request failed: %s, retry: %s", e, retries)
-                time.sleep(self.retry_delay)
-            break
-
-        response_json = response.json()
-        if response_json["cevapBilgileri"]["cevapKodu"] != "000":
-            logger.error("Payment failed: %s", response_json["cevapBilgileri"])
-            raise ValueError(
-                f"{response_json['cevapBilgileri']['cevapMsj']} {response_json['cevapBilgileri']['detay']}"
-            )
+        # raises TcddApiError with the server message if the payment fails
+        response_json = get_client().post(
+            api_constants.VB_ENROLL_CONTROL_ENDPOINT,
+            self.vb_enroll_control_req,
+            timeout=self.timeout,
+        )
 
         acs_url = response_json["paymentAuthRequest"]["acsUrl"]
         pareq = response_json["paymentAuthRequest"]["pareq"]
@@ -242,35 +210,15 @@ class Payment:
 
     def is_payment_success(self):
         """set_is_payment_success"""
-        retries = 1
         self.odeme_sorgu["enrollReference"] = self.enroll_reference
         logger.info("self.ode_sorgu: %s", self.odeme_sorgu)
-        while retries < self.max_retries:
-            try:
-                odeme_sorgu_response = requests.post(
-                    api_constants.VB_ODEME_SORGU,
-                    headers=api_constants.REQUEST_HEADER,
-                    data=json.dumps(self.odeme_sorgu),
-                    timeout=self.timeout,
-                )
-                odeme_sorgu_response.raise_for_status()
-            except RequestException as e:
-                retries += 1
-                logger.error("Odeme sorgu request failed: %s, retry: %s", e, retries)
-                time.sleep(self.retry_delay)
-            break
-
-        odeme_sorgu_response_json = odeme_sorgu_response.json()
-
-        if odeme_sorgu_response_json["cevapBilgileri"]["cevapKodu"] != "000":
-            logger.error("Response: %s", odeme_sorgu_response.text)
-            raise ValueError(
-                f"{odeme_sorgu_response_json['cevapBilgileri']['cevapMsj']} {odeme_sorgu_response_json['cevapBilgileri']['detay']}"
-            )
-        else:
-            logger.info("Response: %s", odeme_sorgu_response_json["vposReference"])
-            self.vpos_ref = odeme_sorgu_response_json["vposReference"]
-            return True
+        # raises TcddApiError with the server message if the payment is not done
+        odeme_sorgu_response_json = get_client().post(
+            api_constants.VB_ODEME_SORGU, self.odeme_sorgu, timeout=self.timeout
+        )
+        logger.info("Response: %s", odeme_sorgu_response_json["vposReference"])
+        self.vpos_ref = odeme_sorgu_response_json["vposReference"]
+        return True
 
     def ticket_reservation(self, date_format="%d/%m/%Y"):
         """ticket_reservation"""
@@ -316,35 +264,11 @@ class Payment:
         logger.info("Ticket reservation request: %s", req_body)
         # send request
 
-        retries = 0
-        while retries < self.max_retries:
-            try:
-                response = requests.post(
-                    api_constants.TICKET_RESERVATION_ENDPOINT,
-                    headers=api_constants.REQUEST_HEADER,
-                    data=json.dumps(req_body),
-                    timeout=self.timeout,
-                )
-                response.raise_for_status()
-            except requests.exceptions.RequestException as e:
-                retries += 1
-                logger.error(
-                    "Ticket reservation request failed: %s, retry: %s", e, retries
-                )
-                time.sleep(self.retry_delay)
-            break
-
-        response_json = response.json()
-
-        if response_json["cevapBilgileri"]["cevapKodu"] != "000":
-            logger.error(
-                "Ticket reservation failed: %s", response_json["cevapBilgileri"]
-            )
-            raise ValueError(
-                f"{response_json['cevapBilgileri']['cevapMsj']} {response_json['cevapBilgileri']['detay']}"
-            )
-        else:
-            logger.info("Ticket reservation successful.")
-            self.ticket_reservation_info = response_json
-            logger.debug("Ticket reservation response: %s", response_json)
-            return True
+        # raises TcddApiError with the server message if the reservation fails
+        response_json = get_client().post(
+            api_constants.TICKET_RESERVATION_ENDPOINT, req_body, timeout=self.timeout
+        )
+        logger.info("Ticket reservation successful.")
+        self.ticket_reservation_info = response_json
+        logger.debug("Ticket reservation response: %s", response_json)
+        return True
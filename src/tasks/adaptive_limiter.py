@@ -0,0 +1,149 @@
+"""AIMD concurrency limits for the fanned out TCDD API requests.
+
+The number of in flight vagon count and vagon map requests is not fixed. The
+limit grows by one every `limit` successful requests while the p95 latency and
+the error rate stay healthy, and is cut in half on a timeout, a 5xx or a 429
+response. So the search uses the spare upstream capacity at night and backs
+off at peak hours before getting throttled. The current limit is exposed as
+the limiter.<name>.limit gauge in tasks.metrics.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import aiohttp
+
+from tasks.metrics import LatencyStats, metrics
+
+logger = logging.getLogger(__name__)
+
+
+def is_overload(exc):
+    """Check if the exception means the upstream is overloaded."""
+    if isinstance(exc, asyncio.TimeoutError):
+        return True
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status >= 500 or exc.status == 429
+    return False
+
+
+class AdaptiveLimiter:
+    """Additive increase, multiplicative decrease limit of in flight requests."""
+
+    def __init__(
+        self,
+        name,
+        initial=4,
+        min_limit=1,
+        max_limit=32,
+        target_latency=1.0,
+        max_error_rate=0.05,
+        backoff=0.5,
+        window=100,
+    ):
+        """
+        Args:
+            name (str): The name the metrics are recorded under.
+            initial (int): The limit to start with.
+            min_limit (int): Lower bound of the limit.
+            max_limit (int): Upper bound of the limit.
+            target_latency (float): p95 latency in seconds above which the limit
+                is not raised.
+            max_error_rate (float): Error rate above which the limit is not raised.
+            backoff (float): Factor the limit is multiplied with on overload.
+            window (int): Number of recent requests the p95 and the error rate
+                are computed on.
+        """
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.backoff = backoff
+        self.latencies = LatencyStats(window)
+        self.errors = deque(maxlen=window)
+        self.in_flight = 0
+        self._last_decrease = 0
+        self._condition = None
+        self._loop = None
+        self._publish()
+
+    @property
+    def error_rate(self):
+        """Share of the recent requests that failed with an overload error."""
+        return sum(self.errors) / len(self.errors) if self.errors else 0
+
+    def timeout(self, ceiling, floor=1.0):
+        """
+        Return a request timeout derived from the recent latencies.
+
+        Args:
+            ceiling (float): The configured timeout, never exceeded.
+            floor (float): Lower bound of the timeout.
+        """
+        if len(self.latencies.samples) < 20:
+            return ceiling
+        return min(max(self.latencies.percentile(95) * 3, floor), ceiling)
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the in flight slots for the duration of a request."""
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            self.on_error(e)
+            raise
+        else:
+            self.on_success(time.monotonic() - start)
+        finally:
+            async with condition:
+                self.in_flight -= 1
+                condition.notify_all()
+
+    def on_success(self, latency):
+        """Record a successful request, raise the limit if the upstream is healthy."""
+        self.latencies.record(latency)
+        self.errors.append(False)
+        if (
+            self.latencies.percentile(95) <= self.target_latency
+            and self.error_rate <= self.max_error_rate
+        ):
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self._publish()
+
+    def on_error(self, exc):
+        """Record a failed request, cut the limit if it is an overload error."""
+        if not is_overload(exc):
+            return
+        self.errors.append(True)
+        now = time.monotonic()
+        # the requests in flight fail together, cut once per burst
+        if now - self._last_decrease < (self.latencies.percentile(95) or 1):
+            return
+        self._last_decrease = now
+        self.limit = max(self.limit * self.backoff, self.min_limit)
+        logger.warning(
+            "%s overloaded (%r), limit lowered to %s", self.name, exc, int(self.limit)
+        )
+        self._publish()
+
+    def _get_condition(self):
+        # asyncio primitives are bound to the loop they are first used on
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._condition = asyncio.Condition()
+            self._loop = loop
+            self.in_flight = 0
+        return self._condition
+
+    def _publish(self):
+        metrics.set_gauge(f"limiter.{self.name}.limit", int(self.limit))
@@ -0,0 +1,113 @@
+"""Stop signals of the running celery tasks.
+
+The bot asks a task to stop with request_stop, which sets the stop key of the
+task and publishes on its channel. Blocking tasks check the single key between
+iterations, async tasks run under run_until_stopped and are cancelled as soon
+as the message arrives. Neither scans the keyspace, so the cost of a check
+does not grow with the number of keys in the Redis instance shared with the
+broker and the result backend.
+
+Redis layout:
+    stop:{task_id}   key set while the task is asked to stop, and the pub/sub
+                     channel the stop is announced on
+"""
+
+import asyncio
+import logging
+
+import redis
+
+from tasks.redis_pool import async_redis_client, redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class TaskStopped(Exception):
+    """Raised when a task is stopped through its stop signal."""
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        super().__init__(f"Task: {task_id} is stopped")
+
+
+class Cancellation:
+    """Stop signals of the tasks, by task id."""
+
+    key_prefix = "stop:"
+
+    def __init__(self, client=redis_client, ttl=600, poll_interval=1.0):
+        """
+        Args:
+            client (redis.Redis): Redis client holding the stop keys.
+            ttl (int): Seconds a stop request is kept.
+            poll_interval (float): Seconds between the key checks of a waiting
+                task while pub/sub is unavailable.
+        """
+        self.client = client
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+
+    def key(self, task_id):
+        """Return the stop key and channel of the task."""
+        return f"{self.key_prefix}{task_id}"
+
+    def request_stop(self, task_id):
+        """Ask the task to stop."""
+        key = self.key(task_id)
+        pipe = self.client.pipeline()
+        pipe.set(key, 1, ex=self.ttl)
+        pipe.publish(key, 1)
+        pipe.execute()
+        logger.info("Requested stop of task: %s", task_id)
+
+    def is_stop_requested(self, task_id):
+        """Check if the task is asked to stop."""
+        return bool(self.client.exists(self.key(task_id)))
+
+    async def wait(self, task_id):
+        """Return once the task is asked to stop."""
+        client = async_redis_client()
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(self.key(task_id))
+            # a stop requested before the subscription is only in the key
+            if await client.exists(self.key(task_id)):
+                return
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    return
+        except redis.exceptions.RedisError as e:
+            logger.error("Stop channel is unavailable, polling instead: %s", e)
+            while not self.is_stop_requested(task_id):
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+    async def run_until_stopped(self, coro, task_id):
+        """
+        Run the coroutine, cancelling it once the task is asked to stop.
+
+        Raises:
+            TaskStopped: If the task is asked to stop before the coroutine is done.
+
+        Returns:
+            The result of the coroutine.
+        """
+        work = asyncio.ensure_future(coro)
+        stop = asyncio.ensure_future(self.wait(task_id))
+        try:
+            await asyncio.wait({work, stop}, return_when=asyncio.FIRST_COMPLETED)
+            if work.done():
+                return work.result()
+            # raises the exception of the waiter if there is one
+            stop.result()
+            logger.info("Stopping task: %s", task_id)
+            raise TaskStopped(task_id)
+        finally:
+            for task in (work, stop):
+                task.cancel()
+            await asyncio.gather(work, stop, return_exceptions=True)
+
+
+cancellation = Cancellation()
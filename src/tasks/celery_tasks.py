@@ -1,14 +1,19 @@
 from datetime import datetime
-import asyncio
 import json
 import pprint
 import time
 import logging
-import pickle
-import redis
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown
 from celery.utils.log import get_task_logger
-from tasks.trip import Trip
+from tasks import worker_loop
+from tasks.cancellation import TaskStopped, cancellation
+from tasks.metrics import metrics
+from tasks.redis_pool import redis_client
+from tasks.route_watch import RoutePoller, route_key, route_watch
+from tasks.sales_sniper import SalesSniper, parse_opens_at
+from tasks.trip import SearchExpired, Trip
+from tasks.trip_codec import decode_trip, encode_trip
 
 logger = get_task_logger(__name__)
 logger.setLevel(logging.INFO)
@@ -28,62 +33,76 @@ celery_app = Celery(
     worker_prefetch_multiplier=1,  # see https://docs.celeryq.dev/en/stable/userguide/optimizing.html
 )
 
-redis_client = redis.Redis(host="redis", port=6379, db=0)
+# every worker process runs the coroutines of its tasks on a single long lived
+# event loop, see tasks.worker_loop
+worker_process_init.connect(worker_loop.init_worker_process)
+worker_process_shutdown.connect(worker_loop.shutdown_worker_process)
 
 
 @celery_app.task(bind=True, max_retries=None)
-def find_trip_and_reserve(self, my_trip: Trip):
-    """Search for trips with empty seats."""
-    count = 0
-    my_trip = pickle.loads(my_trip)
+def watch_route(self, key: str):
+    """Poll a route for all of its subscribers, see tasks.route_watch."""
     try:
-        trips = asyncio.run(my_trip.find_trips())
-        logger.info("Trips found: %s", len(trips))
-        my_trip.trip_json = trips[0]
-        logger.info("Reserving: %s", trips[0].get("binisTarih"))
-        my_trip.reserve_seat()
+        worker_loop.run(RoutePoller(key, self.request.id).run())
+        metrics.log_snapshot()
     except Exception as e:  # pylint: disable=broad-except
-        logger.error("Error while reserving seat: %s", e)
-        count += 1
-        logger.info("Retrying... %s", count)
-        self.retry(countdown=60)
-
-    logger.info("Seat is reserved: %s", my_trip.empty_seat_json.get("koltukNo"))
-    if my_trip.lock_end_time:
-        logger.info("Seat is reserved")
-        return pickle.dumps(my_trip)
+        logger.error("Error while watching route %s: %s", key, e)
+        # the retry runs with the same task id and takes the route back, unless
+        # another poller took it over in the meantime
+        self.retry(countdown=5)
 
 
 @celery_app.task(bind=True, max_retries=None)
-def keep_reserving_seat(self, my_trip: Trip, chat_id: int):
-    """Reserve a seat for a trip."""
-    my_trip = pickle.loads(my_trip)
-    text = f"Reserving seat for trip: {my_trip.trip_json.get('binisTarih')}, {
-        my_trip.empty_seat_json.get('koltukNo')}"
-    logger.info(text)
+def snipe_trip(self, my_trip: Trip, sefer_ids: list, opens_at: str = None):
+    """Lock a seat of the trips as soon as their sales open, see tasks.sales_sniper."""
+    my_trip = decode_trip(my_trip)
+    # raises ValueError on an invalid time, not worth a retry
+    sniper = SalesSniper(
+        my_trip, sefer_ids, parse_opens_at(opens_at) if opens_at else None
+    )
+    try:
+        locked = worker_loop.run(
+            cancellation.run_until_stopped(sniper.run(), self.request.id)
+        )
+        if not locked:
+            # the sales are open but the burst found no seat, search as usual
+            search = my_trip.find_and_lock_seat()
+            locked = worker_loop.run(
+                cancellation.run_until_stopped(search, self.request.id)
+            )
+        metrics.log_snapshot()
+    except (TaskStopped, SearchExpired) as e:
+        logger.info("%s", e)
+        return None
+    except Exception as e:  # pylint: disable=broad-except
+        logger.error("Error while sniping trips %s: %s", sefer_ids, e)
+        self.retry(countdown=5)
+
+    if locked:
+        logger.info("Seat is reserved: %s", my_trip.empty_seat_json.get("koltukNo"))
+        return encode_trip(my_trip)
+    return None
 
-    while True:
-        if should_stop(self):
-            return pickle.dumps(my_trip)
 
-        if datetime.now().second % 60 == 0:
-            logger.info("lock_end_time: %s", my_trip.lock_end_time)
+def watch_trip(my_trip: Trip):
+    """
+    Subscribe the trip to the watch of its route and start a poller for the route
+    if it has none.
 
-        try:
-            if my_trip.reserve_seat():
-                logger.info("Seat reserve operation is successful.")
-                time_ = datetime.strftime(my_trip.lock_end_time, my_trip.time_format)
-                chat_id_data = {"lock_end_time": time_}
-                logger.info("chat_id_data: %s", chat_id_data)
-                logger.info("Setting redis keys...")
-                redis_client.set(chat_id, json.dumps(chat_id_data), ex=600)
+    Returns:
+        str: The subscription id, see route_watch.pop_result.
+    """
+    sub_id = route_watch.subscribe(my_trip)
+    ensure_route_poller(route_key(my_trip))
+    return sub_id
 
-        except Exception as e:  # pylint: disable=broad-except
-            logger.error("Error while reserving seat: %s", e)
-            # retry indefinitely
-            self.retry(countdown=0)
 
-        time.sleep(1)
+def ensure_route_poller(key: str):
+    """Start a poller for the route if it has none."""
+    poller_id = route_watch.claim_poller(key)
+    if poller_id:
+        logger.info("Starting poller for route: %s", key)
+        watch_route.apply_async(args=[key], task_id=poller_id)
 
 
 @celery_app.task(bind=True)
@@ -105,11 +124,8 @@ def test_task_(self, chat_id: int):
 
 
 def should_stop(task_instance):
-    """Check if the task should be stopped."""
-    request_id = str(task_instance.request.id).encode()
-    if request_id in redis_client.keys():
-        return True
-    return False
+    """Check if the task should be stopped, see tasks.cancellation."""
+    return cancellation.is_stop_requested(task_instance.request.id)
 
 
 @celery_app.task(bind=True)
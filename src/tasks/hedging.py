@@ -0,0 +1,89 @@
+"""Hedged requests against the tail latency of idempotent reads.
+
+When a request to one of api_constants.HEDGED_ENDPOINTS takes longer than the
+p90 latency observed for its endpoint, a duplicate is sent and whichever
+answers first wins, the other one is cancelled. The duplicate shares the rate
+limit token and the concurrency slot of the request, and the delay only starts
+once they are acquired, see TcddClient.apost. A HedgeBudget caps the share
+of hedged requests so the extra load stays bounded. Seat locks (klSec) and the
+payment calls are never hedged.
+"""
+
+import asyncio
+import logging
+from collections import deque
+
+from tasks.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class HedgeBudget:
+    """Caps the share of the recent requests that were hedged."""
+
+    def __init__(self, max_ratio, window=200):
+        """
+        Args:
+            max_ratio (float): Maximum share of hedged requests, 0 disables hedging.
+            window (int): Number of recent requests and hedges the share is
+                computed on.
+        """
+        self.max_ratio = max_ratio
+        # False for a request, True for a hedge
+        self.recent = deque(maxlen=window)
+
+    def record_request(self):
+        """Record a hedgeable request."""
+        self.recent.append(False)
+
+    def try_hedge(self):
+        """Take a hedge from the budget, False if the budget is used up."""
+        hedges = sum(self.recent)
+        requests = len(self.recent) - hedges
+        if not requests or (hedges + 1) / requests > self.max_ratio:
+            return False
+        self.recent.append(True)
+        return True
+
+
+async def hedged(name, send, delay, budget: HedgeBudget):
+    """
+    Send a request and hedge it if it is slower than the delay.
+
+    Args:
+        name (str): The name the hedge counters are recorded under.
+        send (callable): Returns a coroutine sending the request.
+        delay (float): Seconds to wait before hedging, None to never hedge.
+        budget (HedgeBudget): The budget the hedge is taken from.
+
+    Returns:
+        The result of the first successful request. If both fail, the exception
+        of the first request is raised.
+    """
+    budget.record_request()
+    first = asyncio.ensure_future(send())
+    tasks = [first]
+    try:
+        if delay is None:
+            return await first
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done or not budget.try_hedge():
+            return await first
+
+        metrics.incr(f"{name}.hedge.sent")
+        tasks.append(asyncio.ensure_future(send()))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        metrics.incr(f"{name}.hedge.won")
+                    return task.result()
+        return first.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,327 @@
+"""Pooled HTTP client shared by every TCDD API call in a process.
+
+Every celery worker process and the bot process get a single TcddClient (see
+get_client) which owns a keep-alive requests.Session for blocking calls and an
+aiohttp.ClientSession for the async ones, so seat checks, seat locks and wagon
+maps reuse already established TCP+TLS connections. Every request goes through
+the retry policy and the circuit breaker of its endpoint, see tasks.retry_policy,
+and takes a token from the cluster wide rate limiter, see tasks.rate_limiter.
+Polled endpoints can opt into the shared response cache, see
+tasks.response_cache. Async requests to the idempotent read endpoints are
+hedged when they are slower than usual, see tasks.hedging. The Date headers of
+the responses feed the server clock estimate, see tasks.server_clock.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+import api_constants
+from tasks.adaptive_limiter import AdaptiveLimiter
+from tasks.hedging import HedgeBudget, hedged
+from tasks.metrics import metrics
+from tasks.rate_limiter import RateLimiter
+from tasks.response_cache import ResponseCache
+from tasks.retry_policy import CircuitBreaker, TcddApiError, get_policy
+from tasks.server_clock import server_clock
+
+logger = logging.getLogger(__name__)
+
+
+class TcddClient:
+    """Long-lived sync and async HTTP sessions for the TCDD API."""
+
+    def __init__(
+        self,
+        pool_size=20,
+        dns_cache_ttl=300,
+        keepalive_timeout=60,
+        host_limit=api_constants.MAX_CONCURRENT_REQUESTS_PER_HOST,
+    ):
+        """
+        Args:
+            pool_size (int): Maximum number of pooled connections per session.
+            dns_cache_ttl (int): Seconds to cache resolved addresses (async session).
+            keepalive_timeout (int): Seconds to keep an idle connection open (async session).
+            host_limit (int): Maximum number of concurrent async requests per host.
+        """
+        self.pool_size = pool_size
+        self.host_limit = host_limit
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.headers = api_constants.REQUEST_HEADER.copy()
+        # br is not decodable without extra packages, gzip is enough
+        self.headers["Accept-Encoding"] = "gzip, deflate"
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+
+        self._async_session = None
+        self._async_loop = None
+        self._host_semaphores = {}
+        self.breakers = defaultdict(CircuitBreaker)
+        self.rate_limiter = RateLimiter()
+        limits = api_constants.ADAPTIVE_CONCURRENCY
+        self.limiters = {
+            endpoint: AdaptiveLimiter(
+                self.endpoint_name(endpoint), initial=initial, max_limit=max_limit
+            )
+            for endpoint, (initial, max_limit) in limits.items()
+        }
+        self.hedge_budget = HedgeBudget(api_constants.MAX_HEDGE_RATIO)
+        self.response_cache = ResponseCache()
+
+    def timeout(self, endpoint):
+        """Return the request timeout for the given endpoint.
+
+        The timeouts of the adaptively limited endpoints follow their recent
+        latencies, bounded by the configured timeout.
+        """
+        timeout = api_constants.ENDPOINT_TIMEOUTS.get(
+            endpoint, api_constants.DEFAULT_TIMEOUT
+        )
+        if endpoint in self.limiters:
+            return self.limiters[endpoint].timeout(timeout)
+        return timeout
+
+    @staticmethod
+    def endpoint_name(endpoint):
+        """Return the name the metrics of the endpoint are recorded under."""
+        return f"http.{urlsplit(endpoint).path.rsplit('/', 1)[-1]}"
+
+    @staticmethod
+    @contextmanager
+    def track(endpoint):
+        """Record the latency of a request to the endpoint, or its failure."""
+        name = TcddClient.endpoint_name(endpoint)
+        start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            metrics.incr(f"{name}.error")
+            raise
+        metrics.observe(name, time.monotonic() - start)
+
+    @staticmethod
+    def _encode(body):
+        return body if isinstance(body, str) else json.dumps(body)
+
+    @staticmethod
+    def check_response(endpoint, response_json):
+        """Raise TcddApiError if the response has a non zero response code."""
+        cevap = response_json.get("cevapBilgileri")
+        if cevap and cevap.get("cevapKodu") != "000":
+            logger.error("Non zero response code from %s: %s", endpoint, cevap)
+            raise TcddApiError(endpoint, response_json)
+
+    def post(self, endpoint, body, timeout=None, check=True, cache=False):
+        """
+        Send a blocking POST request to the given endpoint.
+
+        Args:
+            endpoint (str): The endpoint url.
+            body (dict | str): The request body, dicts are JSON encoded.
+            timeout (float, optional): Overrides the endpoint timeout.
+            check (bool, optional): Whether to raise TcddApiError on a non zero
+                response code. Defaults to True.
+            cache (bool, optional): Whether to share the response through the
+                response cache for api_constants.RESPONSE_CACHE_TTLS seconds.
+                Defaults to False.
+
+        Raises:
+            TcddApiError: If check is set and the response code is not zero.
+            requests.RequestException: If the request fails after the retries.
+
+        Returns:
+            dict: The decoded JSON response.
+        """
+        data = self._encode(body)
+
+        def send():
+            self.rate_limiter.acquire(endpoint)
+            with self.track(endpoint):
+                sent = time.time()
+                response = self.session.post(
+                    endpoint, data=data, timeout=timeout or self.timeout(endpoint)
+                )
+                server_clock.observe(response.headers.get("Date"), sent, time.time())
+                response.raise_for_status()
+                response_json = response.json()
+            if check:
+                self.check_response(endpoint, response_json)
+            return response_json
+
+        def fetch():
+            return get_policy(endpoint).call(endpoint, send, self.breakers[endpoint])
+
+        ttl = api_constants.RESPONSE_CACHE_TTLS.get(endpoint)
+        if not cache or not ttl:
+            return fetch()
+        response_json = self.response_cache.get_or_fetch(endpoint, data, fetch, ttl)
+        if check:
+            self.check_response(endpoint, response_json)
+        return response_json
+
+    def async_session(self):
+        """Return the aiohttp session bound to the running event loop."""
+        loop = asyncio.get_running_loop()
+        if (
+            self._async_session is None
+            or self._async_session.closed
+            or self._async_loop is not loop
+        ):
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                ttl_dns_cache=self.dns_cache_ttl,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._async_session = aiohttp.ClientSession(
+                connector=connector, headers=self.headers, auto_decompress=True
+            )
+            self._async_loop = loop
+            # semaphores are bound to the loop they are first used on
+            self._host_semaphores = {}
+            logger.info("Created new aiohttp session.")
+        return self._async_session
+
+    def host_semaphore(self, endpoint):
+        """Return the semaphore limiting concurrent requests to the endpoint's host."""
+        host = urlsplit(endpoint).netloc
+        if host not in self._host_semaphores:
+            self._host_semaphores[host] = asyncio.Semaphore(self.host_limit)
+        return self._host_semaphores[host]
+
+    def hedge_delay(self, endpoint):
+        """Return the seconds after which a request to the endpoint is hedged.
+
+        None if the endpoint is not hedged or too few latencies are recorded yet.
+        """
+        if endpoint not in api_constants.HEDGED_ENDPOINTS:
+            return None
+        stats = metrics.latency(self.endpoint_name(endpoint))
+        if len(stats.samples) < 20:
+            return None
+        return stats.percentile(90)
+
+    def concurrency_slot(self, endpoint):
+        """Return the context manager limiting the in flight requests to the endpoint.
+
+        The fanned out endpoints have adaptive limits of their own, the rest
+        share the fixed limit of their host.
+        """
+        if endpoint in self.limiters:
+            return self.limiters[endpoint].slot()
+        return self.host_semaphore(endpoint)
+
+    async def apost(
+        self, endpoint, body, timeout=None, check=True, cache=False, lane=None
+    ):
+        """
+        Send a POST request to the given endpoint on the running event loop.
+
+        Args:
+            endpoint (str): The endpoint url.
+            body (dict | str): The request body, dicts are JSON encoded.
+            timeout (float, optional): Overrides the endpoint timeout.
+            check (bool, optional): Whether to raise TcddApiError on a non zero
+                response code. Defaults to True.
+            cache (bool, optional): Whether to share the response through the
+                response cache for api_constants.RESPONSE_CACHE_TTLS seconds.
+                Defaults to False.
+            lane (str, optional): Sends the request in a lane of
+                api_constants.LANE_RATE_LIMITS, cached for its LANE_CACHE_TTLS.
+
+        Raises:
+            TcddApiError: If check is set and the response code is not zero.
+            aiohttp.ClientError, asyncio.TimeoutError: If the request fails after
+                the retries.
+
+        Returns:
+            dict: The decoded JSON response.
+        """
+        data = self._encode(body)
+
+        async def request():
+            with self.track(endpoint):
+                sent = time.time()
+                async with self.async_session().post(
+                    endpoint,
+                    data=data,
+                    timeout=aiohttp.ClientTimeout(
+                        total=timeout or self.timeout(endpoint)
+                    ),
+                ) as resp:
+                    server_clock.observe(resp.headers.get("Date"), sent, time.time())
+                    resp.raise_for_status()
+                    return await resp.json()
+
+        async def send():
+            await self.rate_limiter.aacquire(endpoint, lane)
+            # wait for a slot before the timeout starts ticking
+            async with self.concurrency_slot(endpoint):
+                # the hedge delay starts once the token and the slot are
+                # acquired, a hedge shares them with the request it duplicates
+                response_json = await hedged(
+                    self.endpoint_name(endpoint),
+                    request,
+                    self.hedge_delay(endpoint),
+                    self.hedge_budget,
+                )
+            if check:
+                self.check_response(endpoint, response_json)
+            return response_json
+
+        def fetch():
+            return get_policy(endpoint).acall(endpoint, send, self.breakers[endpoint])
+
+        ttl = api_constants.RESPONSE_CACHE_TTLS.get(endpoint)
+        if lane is not None:
+            ttl = api_constants.LANE_CACHE_TTLS.get(lane)
+        if not cache or not ttl:
+            return await fetch()
+        response_json = await self.response_cache.aget_or_fetch(
+            endpoint, data, fetch, ttl, lane
+        )
+        if check:
+            self.check_response(endpoint, response_json)
+        return response_json
+
+    async def aclose(self):
+        """Close the async session, it is recreated on the next request."""
+        if self._async_session is not None and not self._async_session.closed:
+            await self._async_session.close()
+        self._async_session = None
+        self._async_loop = None
+        self._host_semaphores = {}
+
+    def close(self):
+        """Close the blocking session."""
+        self.session.close()
+
+
+_client = None
+_client_pid = None
+
+
+def get_client():
+    """Return the TcddClient of the current process.
+
+    Celery forks its worker processes, so a client inherited from the parent
+    process is replaced instead of sharing its sockets.
+    """
+    global _client, _client_pid  # pylint: disable=global-statement
+    if _client is None or _client_pid != os.getpid():
+        _client = TcddClient()
+        _client_pid = os.getpid()
+    return _client
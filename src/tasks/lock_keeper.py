@@ -0,0 +1,300 @@
+"""Seat lock keeper holding the seat locks of every user in a single process.
+
+A held seat used to occupy a celery worker running keep_reserving_seat, which
+woke up every second only to find that nothing was due. The keeper holds all
+the locks on one event loop instead: the locks sit in a heap keyed on their
+renewal time and the loop sleeps until the next renewal is due or a lock is
+added or released. The server releases an expired lock some seconds after its
+lock_end_time, so the renewal is aimed at the release window estimated by
+tasks.server_clock, on the server's clock. Within the window a short burst of
+attempts is sent, after it the attempts slow down. The new lock_end_time is
+written to the chat_id key the bot reads.
+
+The bot hands a locked Trip over with hold and takes it back with release. The
+keeper runs as its own service:
+
+    python -m tasks.lock_keeper
+
+Redis layout:
+    locks:held            set of the chat ids with a held lock
+    locks:trip:{chat_id}  encoded Trip of the held lock, see tasks.trip_codec
+    locks:changed         pub/sub channel announcing added and released locks
+    {chat_id}             JSON with the lock_end_time of the held lock
+"""
+
+import asyncio
+import heapq
+import json
+import logging
+import time
+from datetime import datetime
+
+import aiohttp
+import redis
+
+from tasks.metrics import metrics
+from tasks.redis_pool import async_redis_client, redis_client
+from tasks.server_clock import server_clock
+from tasks.trip import Trip
+from tasks.trip_codec import decode_trip, encode_trip
+from tasks.trip_search import SeatLockedException, TripSearchApi
+
+logger = logging.getLogger(__name__)
+
+
+class LockKeeper:
+    """Held seat locks and their renewals."""
+
+    held_key = "locks:held"
+    trip_key_prefix = "locks:trip:"
+    channel = "locks:changed"
+
+    def __init__(
+        self,
+        client=redis_client,
+        burst_interval=0.5,
+        retry_interval=5,
+        resync_interval=60,
+        state_ttl=600,
+    ):
+        """
+        Args:
+            client (redis.Redis): Redis client holding the locks.
+            burst_interval (float): Seconds between the renewal attempts within the
+                release window.
+            retry_interval (float): Seconds between the renewal attempts after the
+                release window.
+            resync_interval (float): Seconds between the full reloads of the held
+                locks, in case a change announcement is lost.
+            state_ttl (int): Seconds the chat_id lock state is kept.
+        """
+        self.client = client
+        self.burst_interval = burst_interval
+        self.retry_interval = retry_interval
+        self.resync_interval = resync_interval
+        self.state_ttl = state_ttl
+        # chat_id -> Trip of the locks held by the running keeper
+        self.trips = {}
+        # chat_id -> renewal time, the heap entries that do not match are stale
+        self.due = {}
+        self.heap = []
+        self._changed = set()
+        self._wakeup = None
+
+    def trip_key(self, chat_id):
+        """Return the key of the held Trip of the chat."""
+        return f"{self.trip_key_prefix}{chat_id}"
+
+    def hold(self, chat_id, trip: Trip):
+        """Hand the locked seat of the trip over to the keeper."""
+        pipe = self.client.pipeline()
+        pipe.set(self.trip_key(chat_id), encode_trip(trip))
+        pipe.sadd(self.held_key, chat_id)
+        pipe.publish(self.channel, chat_id)
+        pipe.execute()
+        self.write_state(chat_id, trip)
+        logger.info("Holding seat lock for chat: %s", chat_id)
+
+    def release(self, chat_id):
+        """
+        Stop renewing the lock of the chat.
+
+        Returns:
+            bool: True if a lock was held.
+        """
+        pipe = self.client.pipeline()
+        pipe.delete(self.trip_key(chat_id))
+        pipe.srem(self.held_key, chat_id)
+        pipe.publish(self.channel, chat_id)
+        held = bool(pipe.execute()[0])
+        if held:
+            logger.info("Released seat lock of chat: %s", chat_id)
+        return held
+
+    def is_held(self, chat_id):
+        """Check if the keeper holds a lock for the chat."""
+        return bool(self.client.exists(self.trip_key(chat_id)))
+
+    def get_trip(self, chat_id, passenger=None):
+        """Return the held Trip of the chat with its latest lock, None if none."""
+        payload = self.client.get(self.trip_key(chat_id))
+        return decode_trip(payload, passenger) if payload else None
+
+    def write_state(self, chat_id, trip: Trip):
+        """Write the lock_end_time of the trip to the chat_id key the bot reads."""
+        time_ = datetime.strftime(trip.lock_end_time, trip.time_format)
+        self.client.set(
+            chat_id, json.dumps({"lock_end_time": time_}), ex=self.state_ttl
+        )
+
+    def renewal_time(self, trip: Trip):
+        """Return the local epoch time the lock of the trip is due for renewal."""
+        if trip.lock_end_time is None:
+            return time.time()
+        start, _ = server_clock.release_window()
+        return server_clock.to_local(server_clock.timestamp(trip.lock_end_time) + start)
+
+    def retry_time(self, trip: Trip):
+        """Return the local epoch time of the next attempt after a failed renewal."""
+        if trip.lock_end_time is not None:
+            _, end = server_clock.release_window()
+            release_end = server_clock.timestamp(trip.lock_end_time) + end
+            if server_clock.now() < release_end:
+                return time.time() + self.burst_interval
+        return time.time() + self.retry_interval
+
+    def schedule(self, chat_id, due):
+        """Schedule the renewal of the chat's lock."""
+        self.due[chat_id] = due
+        heapq.heappush(self.heap, (due, chat_id))
+        if self._wakeup is not None:
+            # the keeper may be sleeping until a later renewal
+            self._wakeup.set()
+
+    def load(self, chat_id):
+        """Load the held Trip of the chat, or forget it if it is released."""
+        trip = self.get_trip(chat_id)
+        if trip is None:
+            self.trips.pop(chat_id, None)
+            self.due.pop(chat_id, None)
+            return
+        self.trips[chat_id] = trip
+        self.schedule(chat_id, self.renewal_time(trip))
+
+    def resync(self):
+        """Load the held locks that are not known yet, forget the released ones."""
+        held = {c.decode() for c in self.client.smembers(self.held_key)}
+        # the known locks are kept, a renewal of theirs may be in flight
+        for chat_id in held.symmetric_difference(self.trips):
+            self.load(chat_id)
+        logger.info("Holding %s seat locks.", len(self.trips))
+
+    def pop_due(self, now):
+        """Return the chat ids due for renewal, removing them from the heap."""
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            when, chat_id = heapq.heappop(self.heap)
+            if self.due.get(chat_id) == when:
+                del self.due[chat_id]
+                due.append(chat_id)
+        return due
+
+    async def renew(self, chat_id):
+        """Renew the lock of the chat, retrying shortly if it fails."""
+        trip = self.trips.get(chat_id)
+        if trip is None:
+            return
+        try:
+            lock_end_time, empty_seat, seat_lock_response = (
+                await TripSearchApi.lock_seat(trip.trip_json, trip.empty_seat_json)
+            )
+        except (
+            SeatLockedException,
+            ValueError,
+            asyncio.TimeoutError,
+            aiohttp.ClientError,
+        ) as e:
+            logger.info("Lock of chat %s is not renewed yet: %s", chat_id, e)
+            if self.trips.get(chat_id) is trip:
+                self.schedule(chat_id, self.retry_time(trip))
+            return
+        except Exception:  # pylint: disable=broad-except
+            # an unexpected response must not drop the lock for good
+            logger.exception("Error while renewing the lock of chat %s", chat_id)
+            if self.trips.get(chat_id) is trip:
+                self.schedule(chat_id, self.retry_time(trip))
+            return
+        if self.trips.get(chat_id) is not trip:
+            # released or replaced while the renewal was in flight
+            return
+        if trip.lock_end_time is not None:
+            delay = server_clock.now() - server_clock.timestamp(trip.lock_end_time)
+            if delay > 0:
+                server_clock.record_release(delay)
+                logger.info(
+                    "Lock of chat %s renewed %.1fs after expiry.", chat_id, delay
+                )
+        trip.set_lock_state(
+            trip.trip_json, empty_seat, lock_end_time, seat_lock_response
+        )
+        try:
+            # only kept if the lock is still held
+            self.client.set(self.trip_key(chat_id), encode_trip(trip), xx=True)
+            self.write_state(chat_id, trip)
+        except redis.exceptions.RedisError as e:
+            logger.error("Error while storing the lock of chat %s: %s", chat_id, e)
+        self.schedule(chat_id, self.renewal_time(trip))
+
+    async def listen(self):
+        """Collect the announced lock changes and wake the keeper up."""
+        client = async_redis_client()
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(self.channel)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    self._changed.add(message["data"].decode())
+                    self._wakeup.set()
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+    async def run(self):
+        """Renew the held locks as they come due, until cancelled."""
+        self._wakeup = asyncio.Event()
+        listener = asyncio.create_task(self.listen())
+        renewals = set()
+        next_resync = 0
+        try:
+            while True:
+                self._wakeup.clear()
+                now = time.time()
+                if now >= next_resync or listener.done():
+                    if listener.done():
+                        logger.error("Lock change listener stopped, restarting.")
+                        listener = asyncio.create_task(self.listen())
+                    self.resync()
+                    next_resync = now + self.resync_interval
+                while self._changed:
+                    self.load(self._changed.pop())
+                metrics.log_periodic_snapshot()
+
+                for chat_id in self.pop_due(now):
+                    task = asyncio.create_task(self.renew(chat_id))
+                    renewals.add(task)
+                    task.add_done_callback(renewals.discard)
+
+                wake_at = next_resync
+                if self.heap:
+                    wake_at = min(self.heap[0][0], wake_at)
+                try:
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), timeout=max(wake_at - time.time(), 0)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for task in (listener, *renewals):
+                task.cancel()
+            await asyncio.gather(listener, *renewals, return_exceptions=True)
+
+
+lock_keeper = LockKeeper()
+
+
+async def main():
+    """Run the lock keeper, restarting it after Redis errors."""
+    while True:
+        try:
+            await lock_keeper.run()
+        except redis.exceptions.RedisError as e:
+            logger.error("Lock keeper lost Redis, restarting: %s", e)
+            await asyncio.sleep(5)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(name)s - %(funcName)s - %(levelname)s - %(message)s",
+    )
+    asyncio.run(main())
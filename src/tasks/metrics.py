@@ -0,0 +1,119 @@
+"""In-process counters, gauges and latency statistics.
+
+The long running loops, the trip search rounds, the sales sniper and the lock
+keeper, call log_periodic_snapshot on every round, so the metrics of pollers
+and services that never complete are logged every snapshot_interval seconds.
+"""
+
+import logging
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyStats:
+    """Latency samples of the recent requests of a single operation."""
+
+    def __init__(self, window=500):
+        """
+        Args:
+            window (int): Number of recent samples the percentiles are computed on.
+        """
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, seconds):
+        """Record a latency sample in seconds."""
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    @property
+    def mean(self):
+        """Mean latency of all recorded samples, None if there is none."""
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percent):
+        """Return the given percentile of the recent samples, None if there is none."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(int(len(ordered) * percent / 100), len(ordered) - 1)
+        return ordered[index]
+
+    def summary(self):
+        """Return a dict of the count, mean, p50, p90 and p95 latencies."""
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p95": self.percentile(95),
+        }
+
+
+class Metrics:
+    """Registry of named counters, gauges and latency statistics."""
+
+    def __init__(self, snapshot_interval=60):
+        """
+        Args:
+            snapshot_interval (float): Seconds between the snapshots logged by
+                log_periodic_snapshot.
+        """
+        self.counters = defaultdict(int)
+        self.gauges = {}
+        self.latencies = defaultdict(LatencyStats)
+        self.snapshot_interval = snapshot_interval
+        self._last_snapshot = time.monotonic()
+
+    def incr(self, name, value=1):
+        """Increment the named counter."""
+        self.counters[name] += value
+
+    def set_gauge(self, name, value):
+        """Set the named gauge."""
+        self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        """Record a latency sample for the named operation."""
+        self.latencies[name].record(seconds)
+
+    def latency(self, name):
+        """Return the LatencyStats of the named operation."""
+        return self.latencies[name]
+
+    @contextmanager
+    def timer(self, name):
+        """Record the time spent in the with block as a latency sample."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start)
+
+    def snapshot(self):
+        """Return all the metrics as a dict."""
+        return {
+            "counters": dict(self.counters),
+            "gauges": dict(self.gauges),
+            "latencies": {
+                name: stats.summary() for name, stats in self.latencies.items()
+            },
+        }
+
+    def log_snapshot(self):
+        """Log all the metrics."""
+        self._last_snapshot = time.monotonic()
+        logger.info("metrics: %s", self.snapshot())
+
+    def log_periodic_snapshot(self):
+        """Log all the metrics if snapshot_interval passed since the last log."""
+        if time.monotonic() - self._last_snapshot >= self.snapshot_interval:
+            self.log_snapshot()
+
+
+metrics = Metrics()
@@ -0,0 +1,195 @@
+"""Per trip poll intervals for the vagon map checks of Trip.find_trips.
+
+Every search round refreshes the trip summaries with a single seferSorgula
+request, but checking a trip's vagons costs a request per vagon. The scheduler
+decides which trips are due for a vagon check in a round:
+
+* trips departing soon are polled faster, trips days away slower,
+* trips whose seat counts changed recently (cancellations, returned locks) are
+  polled faster, trips that stayed quiet for long slower,
+* everything slows down while the upstream is slow or failing, based on the
+  http.* latencies and errors recorded in tasks.metrics,
+* the intervals are stretched so that the requests of all the checks stay
+  within the request budget. A check costs the vagon empty seat count request
+  plus a vagon map request per vagon of the fetched vagon types.
+"""
+
+import logging
+import time
+from datetime import datetime
+
+import api_constants
+from tasks.http_client import TcddClient
+from tasks.metrics import metrics
+from tasks.server_clock import server_clock
+
+logger = logging.getLogger(__name__)
+
+
+class PollScheduler:
+    """Poll intervals and due times of the trips of a search."""
+
+    time_format = "%b %d, %Y %I:%M:%S %p"
+
+    def __init__(
+        self,
+        budget=api_constants.POLL_REQUEST_BUDGET,
+        base_interval=15,
+        min_interval=2,
+        max_interval=300,
+        churn_window=300,
+        quiet_after=1800,
+        target_latency=1.0,
+    ):
+        """
+        Args:
+            budget (float): Maximum number of vagon requests per minute over all
+                the trip checks.
+            base_interval (float): Seconds between the checks of an ordinary trip.
+            min_interval (float): Lower bound of a trip's interval in seconds.
+            max_interval (float): Upper bound of a trip's interval in seconds,
+                before the budget is applied.
+            churn_window (float): Seconds a seat count change speeds a trip up.
+            quiet_after (float): Seconds without a change after which a trip
+                slows down.
+            target_latency (float): p90 vagon map latency in seconds above which
+                the upstream is considered slow.
+        """
+        self.budget = budget
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.churn_window = churn_window
+        self.quiet_after = quiet_after
+        self.target_latency = target_latency
+        # seferId -> monotonic time of the last check of the trip
+        self.last_check = {}
+        # seferId -> monotonic time the trip was first seen
+        self.first_seen = {}
+        self.health = 1.0
+        self._last_counts = (0, 0)
+
+    def departure_factor(self, trip):
+        """Scale of the interval by the time left until departure."""
+        departure = datetime.strptime(trip["binisTarih"], self.time_format)
+        hours = (departure - server_clock.wall_time()).total_seconds() / 3600
+        if hours < 3:
+            return 0.3
+        if hours < 24:
+            return 0.6
+        if hours > 24 * 7:
+            return 2
+        return 1
+
+    @staticmethod
+    def check_cost(trip, vagon_types=None):
+        """
+        Return the number of requests a check of the trip sends at most.
+
+        Args:
+            trip (dict): The trip to check.
+            vagon_types (set, optional): The vagonTipIds whose vagon maps are
+                fetched. Defaults to None, all vagon types.
+        """
+        vagons = [
+            vagon
+            for vagon in trip.get("vagons", [])
+            if vagon_types is None or vagon["vagonTipId"] in vagon_types
+        ]
+        # the vagon empty seat count request and a vagon map request per vagon
+        return 1 + len(vagons)
+
+    def churn_factor(self, trip, changed_at, now):
+        """Scale of the interval by how recently the seat counts changed."""
+        if changed_at is not None and now - changed_at < self.churn_window:
+            return 0.3
+        quiet_since = changed_at or self.first_seen.setdefault(trip["seferId"], now)
+        if now - quiet_since > self.quiet_after:
+            return 2
+        return 1
+
+    def update_health(self):
+        """Update the upstream health factor from the vagon map request metrics."""
+        name = TcddClient.endpoint_name(api_constants.VAGON_HARITA_ENDPOINT)
+        stats = metrics.latency(name)
+        counts = (stats.count, metrics.counters[f"{name}.error"])
+        successes = counts[0] - self._last_counts[0]
+        errors = counts[1] - self._last_counts[1]
+        self._last_counts = counts
+
+        error_rate = errors / (successes + errors) if successes + errors else 0
+        p90 = stats.percentile(90)
+        latency_factor = min(max(p90 / self.target_latency, 1), 4) if p90 else 1
+        self.health = latency_factor * (1 + 4 * error_rate)
+
+    def intervals(self, trips, changed_at, costs=None):
+        """
+        Return the poll interval of every trip, within the budget.
+
+        Args:
+            trips (list): The trips to check.
+            changed_at (dict): seferId -> monotonic time the seat counts of the
+                trip last changed, None if they did not change.
+            costs (dict, optional): seferId -> requests of a check of the trip.
+                Defaults to check_cost of every vagon of the trip.
+
+        Returns:
+            dict: seferId -> interval in seconds.
+        """
+        now = time.monotonic()
+        intervals = {}
+        for trip in trips:
+            interval = (
+                self.base_interval
+                * self.departure_factor(trip)
+                * self.churn_factor(trip, changed_at.get(trip["seferId"]), now)
+                * self.health
+            )
+            intervals[trip["seferId"]] = min(
+                max(interval, self.min_interval), self.max_interval
+            )
+
+        costs = costs or {}
+        rate = sum(
+            costs.get(trip["seferId"], self.check_cost(trip))
+            * 60
+            / intervals[trip["seferId"]]
+            for trip in trips
+        )
+        if rate > self.budget:
+            scale = rate / self.budget
+            intervals = {sefer: i * scale for sefer, i in intervals.items()}
+        return intervals
+
+    def due(self, trips, changed_at, costs=None):
+        """
+        Return the trips due for a check and schedule their next check.
+
+        Args:
+            trips (list): The trips worth checking in this round.
+            changed_at (dict): See intervals.
+            costs (dict, optional): See intervals.
+
+        Returns:
+            list: The due trips.
+        """
+        self.update_health()
+        now = time.monotonic()
+        intervals = self.intervals(trips, changed_at, costs)
+        due = []
+        for trip in trips:
+            sefer_id = trip["seferId"]
+            last_check = self.last_check.get(sefer_id)
+            changed = changed_at.get(sefer_id)
+            if (
+                last_check is None
+                or now - last_check >= intervals[sefer_id]
+                # a change of the seat counts makes the trip due right away
+                or (changed is not None and changed > last_check)
+            ):
+                self.last_check[sefer_id] = now
+                due.append(trip)
+        logger.info(
+            "%s of %s trips due, health: %.2f", len(due), len(trips), self.health
+        )
+        return due
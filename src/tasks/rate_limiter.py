@@ -0,0 +1,163 @@
+"""Cluster wide token bucket rate limiter for the TCDD API.
+
+Every bot and celery worker process takes a token from the same Redis backed
+buckets before sending a request, so adding workers does not multiply the
+request rate seen by the TCDD servers. Each request takes a token from the
+bucket of its host and, if the endpoint has a limit of its own, from the bucket
+of the endpoint. The last api_constants.PRIORITY_RESERVE tokens of the host
+bucket are kept for the priority endpoints (seat check, lock, release and
+payment), so search polling can never starve a seat lock or its renewal. A
+request sent in a lane of api_constants.LANE_RATE_LIMITS takes from the bucket
+of the lane instead of the bucket of its endpoint.
+
+The buckets are refilled and taken from atomically by a Lua script using the
+Redis server clock, so the clocks of the workers do not matter. If Redis is
+unreachable the limiter lets the requests through.
+"""
+
+import asyncio
+import logging
+import time
+from urllib.parse import urlsplit
+
+import redis
+
+import api_constants
+from tasks.metrics import metrics
+from tasks.redis_pool import redis_client
+
+logger = logging.getLogger(__name__)
+
+# KEYS: bucket keys, ARGV: rate, capacity and reserve of every bucket.
+# Takes a token from every bucket if each of them keeps its reserve, otherwise
+# takes nothing. Returns the seconds to wait before the next try, 0 on success.
+TOKEN_BUCKET_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    local reserve = tonumber(ARGV[i * 3])
+    local bucket = redis.call('HMGET', key, 'tokens', 'ts')
+    local available = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    available = math.min(capacity, available + math.max(0, now - ts) * rate)
+    tokens[i] = available
+    if available - 1 < reserve then
+        wait = math.max(wait, (reserve + 1 - available) / rate)
+    end
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 3 - 2])
+    local capacity = tonumber(ARGV[i * 3 - 1])
+    if wait == 0 then
+        tokens[i] = tokens[i] - 1
+    end
+    redis.call('HSET', key, 'tokens', tokens[i], 'ts', now)
+    redis.call('EXPIRE', key, math.ceil(capacity / rate) + 1)
+end
+return tostring(wait)
+"""
+
+
+class RateLimiter:
+    """Token buckets per host and per endpoint, shared through Redis."""
+
+    key_prefix = "ratelimit:"
+
+    def __init__(
+        self,
+        client=redis_client,
+        host_limit=api_constants.HOST_RATE_LIMIT,
+        endpoint_limits=None,
+        priority_endpoints=api_constants.PRIORITY_ENDPOINTS,
+        priority_reserve=api_constants.PRIORITY_RESERVE,
+        lane_limits=api_constants.LANE_RATE_LIMITS,
+    ):
+        """
+        Args:
+            client (redis.Redis): Redis client holding the buckets.
+            host_limit (tuple): (requests per second, burst) of every host.
+            endpoint_limits (dict): endpoint -> (requests per second, burst).
+                Defaults to api_constants.ENDPOINT_RATE_LIMITS.
+            priority_endpoints (frozenset): Endpoints allowed to use the reserve.
+            priority_reserve (int): Tokens of the host bucket kept for the
+                priority endpoints.
+            lane_limits (dict): lane -> (requests per second, burst).
+        """
+        self.client = client
+        self.host_limit = host_limit
+        self.endpoint_limits = (
+            api_constants.ENDPOINT_RATE_LIMITS
+            if endpoint_limits is None
+            else endpoint_limits
+        )
+        self.priority_endpoints = priority_endpoints
+        self.priority_reserve = priority_reserve
+        self.lane_limits = lane_limits
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def is_priority(self, endpoint):
+        """Check if the endpoint is in the priority lane."""
+        return endpoint in self.priority_endpoints
+
+    def buckets(self, endpoint, lane=None):
+        """Return the bucket keys and the script arguments of the endpoint."""
+        parts = urlsplit(endpoint)
+        rate, capacity = self.host_limit
+        reserve = 0 if self.is_priority(endpoint) else self.priority_reserve
+        keys = [f"{self.key_prefix}{parts.netloc}"]
+        args = [rate, capacity, reserve]
+        if lane in self.lane_limits:
+            rate, capacity = self.lane_limits[lane]
+            keys.append(f"{self.key_prefix}{parts.netloc}{parts.path}:{lane}")
+            args.extend([rate, capacity, 0])
+        elif endpoint in self.endpoint_limits:
+            rate, capacity = self.endpoint_limits[endpoint]
+            keys.append(f"{self.key_prefix}{parts.netloc}{parts.path}")
+            args.extend([rate, capacity, 0])
+        return keys, args
+
+    def try_acquire(self, endpoint, lane=None):
+        """
+        Try to take a token for a request to the endpoint, in the given lane.
+
+        Returns:
+            float: 0 if a token is taken, otherwise the seconds to wait before
+            trying again.
+        """
+        keys, args = self.buckets(endpoint, lane)
+        try:
+            return float(self.script(keys=keys, args=args))
+        except redis.exceptions.RedisError as e:
+            logger.error("Rate limiter is unavailable, not limiting: %s", e)
+            return 0
+
+    def acquire(self, endpoint, lane=None):
+        """Block until a token for a request to the endpoint is taken."""
+        start = time.monotonic()
+        throttled = False
+        while wait := self.try_acquire(endpoint, lane):
+            throttled = True
+            time.sleep(wait)
+        if throttled:
+            self._record(endpoint, time.monotonic() - start)
+
+    async def aacquire(self, endpoint, lane=None):
+        """Wait on the running event loop until a token for the endpoint is taken."""
+        start = time.monotonic()
+        # the script runs in well under a millisecond on the local redis, a
+        # blocking call is cheaper than handing it to a thread
+        throttled = False
+        while wait := self.try_acquire(endpoint, lane):
+            throttled = True
+            await asyncio.sleep(wait)
+        if throttled:
+            self._record(endpoint, time.monotonic() - start)
+
+    def _record(self, endpoint, waited):
+        lane = "priority" if self.is_priority(endpoint) else "normal"
+        metrics.incr(f"ratelimit.{lane}.throttled")
+        metrics.observe(f"ratelimit.{lane}.wait", waited)
@@ -0,0 +1,12 @@
+"""Shared Redis connection pool for the bot and the celery workers."""
+
+import redis
+import redis.asyncio
+
+redis_pool = redis.ConnectionPool(host="redis", port=6379, db=0)
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+
+def async_redis_client():
+    """Return a new asyncio Redis client, bound to the loop it is first used on."""
+    return redis.asyncio.Redis(host="redis", port=6379, db=0)
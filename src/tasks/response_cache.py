@@ -0,0 +1,196 @@
+"""Short lived response cache shared by every process through Redis.
+
+Users watching the same route and date poll identical seferSorgula and
+vagonHarita requests. The responses are cached in Redis for a second or two,
+keyed by the endpoint and the request body, and concurrent identical requests
+share a single upstream call: the first caller takes a lock and fetches, the
+others wait for its response, whether they run in the same process or in
+another worker. If Redis is unreachable every caller fetches on its own.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from urllib.parse import urlsplit
+
+import redis
+
+from tasks.metrics import metrics
+from tasks.redis_pool import redis_client
+
+logger = logging.getLogger(__name__)
+
+# KEYS: value key, lock key, ARGV: lock ttl in milliseconds.
+# Returns {1, value} on a hit, {2, ""} if the caller took the lock and should
+# fetch, {0, ""} if another caller is fetching.
+CLAIM_SCRIPT = """
+local value = redis.call('GET', KEYS[1])
+if value then
+    return {1, value}
+end
+if redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[1]) then
+    return {2, ''}
+end
+return {0, ''}
+"""
+
+HIT, FETCH, WAIT = 1, 2, 0
+
+
+class FetchCancelled(Exception):
+    """Set on the shared future when the caller fetching for it is cancelled."""
+
+
+class ResponseCache:
+    """Redis response cache with single flight fetches."""
+
+    key_prefix = "cache:"
+
+    def __init__(self, client=redis_client, lock_timeout=10, poll_interval=0.05):
+        """
+        Args:
+            client (redis.Redis): Redis client holding the responses.
+            lock_timeout (float): Seconds after which a fetch is assumed lost and
+                the waiting callers fetch on their own.
+            poll_interval (float): Seconds between the checks of a waiting caller.
+        """
+        self.client = client
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+        self.script = client.register_script(CLAIM_SCRIPT)
+        self._inflight = {}
+
+    def key(self, endpoint, data, lane=None):
+        """Return the cache key of a request, the lanes are cached apart."""
+        digest = hashlib.sha1(data.encode()).hexdigest()
+        path = urlsplit(endpoint).path
+        if lane:
+            path = f"{path}:{lane}"
+        return f"{self.key_prefix}{path}:{digest}"
+
+    @staticmethod
+    def metric_name(endpoint):
+        """Return the name the counters of the endpoint are recorded under."""
+        return f"cache.{urlsplit(endpoint).path.rsplit('/', 1)[-1]}"
+
+    def get_or_fetch(self, endpoint, data, fetch, ttl, lane=None):
+        """
+        Return the cached response of the request or fetch and cache it.
+
+        Args:
+            endpoint (str): The endpoint url.
+            data (str): The encoded request body.
+            fetch (callable): Sends the request and returns the response JSON.
+            ttl (float): Seconds to keep the response.
+            lane (str, optional): The lane of the request, see
+                api_constants.LANE_CACHE_TTLS.
+
+        Returns:
+            dict: The response JSON.
+        """
+        key = self.key(endpoint, data, lane)
+        name = self.metric_name(endpoint)
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            state, value = self._claim(key)
+            if state == HIT:
+                metrics.incr(f"{name}.hit")
+                return value
+            if state == FETCH or time.monotonic() >= deadline:
+                metrics.incr(f"{name}.miss")
+                return self._fetch_and_store(key, fetch, ttl)
+            time.sleep(self.poll_interval)
+
+    async def aget_or_fetch(self, endpoint, data, fetch, ttl, lane=None):
+        """
+        Async counterpart of get_or_fetch, fetch returns a coroutine.
+
+        Identical requests of the same process wait on a single future instead
+        of polling Redis each. If the caller fetching for them is cancelled, the
+        next waiter takes the fetch over.
+        """
+        key = self.key(endpoint, data, lane)
+        while key in self._inflight:
+            try:
+                result = await asyncio.shield(self._inflight[key])
+            except FetchCancelled:
+                continue
+            metrics.incr(f"{self.metric_name(endpoint)}.hit")
+            return result
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await self._aget_or_fetch(endpoint, key, fetch, ttl)
+        except asyncio.CancelledError:
+            # only this caller is cancelled, not the ones waiting on it
+            future.set_exception(FetchCancelled())
+            future.exception()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # retrieved here so an unawaited future does not log the error
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._inflight[key]
+
+    async def _aget_or_fetch(self, endpoint, key, fetch, ttl):
+        name = self.metric_name(endpoint)
+        deadline = time.monotonic() + self.lock_timeout
+        while True:
+            # the script runs in well under a millisecond on the local redis
+            state, value = self._claim(key)
+            if state == HIT:
+                metrics.incr(f"{name}.hit")
+                return value
+            if state == FETCH or time.monotonic() >= deadline:
+                metrics.incr(f"{name}.miss")
+                try:
+                    response_json = await fetch()
+                except BaseException:
+                    self._release(key)
+                    raise
+                self._store(key, response_json, ttl)
+                return response_json
+            await asyncio.sleep(self.poll_interval)
+
+    def _fetch_and_store(self, key, fetch, ttl):
+        try:
+            response_json = fetch()
+        except BaseException:
+            self._release(key)
+            raise
+        self._store(key, response_json, ttl)
+        return response_json
+
+    def _claim(self, key):
+        try:
+            state, value = self.script(
+                keys=[key, f"{key}:lock"], args=[int(self.lock_timeout * 1000)]
+            )
+        except redis.exceptions.RedisError as e:
+            logger.error("Response cache is unavailable: %s", e)
+            return FETCH, None
+        return state, json.loads(value) if state == HIT else None
+
+    def _store(self, key, response_json, ttl):
+        try:
+            pipe = self.client.pipeline()
+            pipe.set(key, json.dumps(response_json), px=int(ttl * 1000))
+            pipe.delete(f"{key}:lock")
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logger.error("Error while caching response: %s", e)
+
+    def _release(self, key):
+        # lets the waiting callers fetch on their own right away
+        try:
+            self.client.delete(f"{key}:lock")
+        except redis.exceptions.RedisError as e:
+            logger.error("Error while releasing response cache lock: %s", e)
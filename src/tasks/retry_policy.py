@@ -0,0 +1,320 @@
+"""Retry, backoff and circuit breaker policy for the TCDD API calls.
+
+Every request sent by TcddClient goes through a RetryPolicy: transient errors
+(connection errors, timeouts, 5xx and 429 responses, unparsable bodies and the
+response codes listed in api_constants.RETRYABLE_RESPONSE_CODES) are retried
+with jittered exponential backoff until the attempts or the total deadline run
+out. Everything else, like a definitive "wrong identity" answer, is raised
+right away. A CircuitBreaker per endpoint fails calls fast while the endpoint
+is down.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import time
+
+import aiohttp
+import requests
+import urllib3
+
+import api_constants
+
+logger = logging.getLogger(__name__)
+
+
+class TcddApiError(ValueError):
+    """Exception raised when the API responds with a non zero response code."""
+
+    def __init__(self, endpoint, response_json):
+        cevap = response_json.get("cevapBilgileri") or {}
+        self.endpoint = endpoint
+        self.response_json = response_json
+        self.code = cevap.get("cevapKodu")
+        self.message = f"{cevap.get('cevapMsj')} {cevap.get('detay')}"
+        super().__init__(self.message)
+
+    @property
+    def retryable(self):
+        """Whether the response code is known to be transient."""
+        return self.code in api_constants.RETRYABLE_RESPONSE_CODES
+
+
+# subclass of both so the handlers of the sync and the async call sites catch it
+class CircuitOpenError(requests.exceptions.RequestException, aiohttp.ClientError):
+    """Exception raised when the circuit breaker of an endpoint is open."""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        super().__init__(f"Circuit breaker is open for {endpoint}")
+
+
+class CircuitBreaker:
+    """Fails calls fast after consecutive transient failures of an endpoint.
+
+    The breaker opens after failure_threshold consecutive failures. Once
+    reset_timeout seconds passed a single trial call is let through, which
+    closes the breaker on success and opens it again on failure.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    @property
+    def state(self):
+        """closed, open or half_open."""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        """Check if a call may be sent."""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.trial_in_progress:
+            self.trial_in_progress = True
+            return True
+        return False
+
+    def record_success(self):
+        """Record a call that reached the server."""
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def record_cancelled(self):
+        """Record a trial call that was cancelled before it completed."""
+        # a cancelled call tells nothing about the endpoint, let the next one try
+        self.trial_in_progress = False
+
+    def record_failure(self):
+        """Record a transient failure."""
+        self.failures += 1
+        self.trial_in_progress = False
+        if self.failures >= self.failure_threshold or self.opened_at is not None:
+            if self.opened_at is None:
+                logger.error("Opening circuit breaker after %s failures", self.failures)
+            self.opened_at = time.monotonic()
+
+
+def is_connect_failure(exc):
+    """Check if the request failed while connecting, before anything was sent."""
+    if isinstance(
+        exc, (requests.exceptions.ConnectTimeout, aiohttp.ClientConnectorError)
+    ):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError) and exc.args:
+        # requests wraps the urllib3 MaxRetryError, whose reason is the cause
+        reason = getattr(exc.args[0], "reason", exc.args[0])
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def is_retryable(exc, idempotent=True):
+    """
+    Classify an exception of a request as retryable or terminal.
+
+    Args:
+        exc (Exception): The exception raised while sending the request.
+        idempotent (bool): Whether the request may be sent again after it may
+            have reached the server. Otherwise only the failures to connect are
+            retried, a connection dropped after the request was sent or a
+            transient response code is not.
+
+    Returns:
+        bool: True if the request should be retried.
+    """
+    if isinstance(exc, CircuitOpenError):
+        return False
+    if is_connect_failure(exc):
+        return True
+    if not idempotent:
+        return False
+    if isinstance(exc, TcddApiError):
+        return exc.retryable
+    if isinstance(exc, requests.exceptions.HTTPError):
+        status = exc.response.status_code if exc.response is not None else None
+        return status is None or status >= 500 or status == 429
+    if isinstance(exc, aiohttp.ClientResponseError) and not isinstance(
+        exc, aiohttp.ContentTypeError
+    ):
+        return exc.status >= 500 or exc.status == 429
+    return isinstance(
+        exc,
+        (
+            requests.exceptions.RequestException,
+            aiohttp.ClientError,
+            asyncio.TimeoutError,
+            json.JSONDecodeError,
+        ),
+    )
+
+
+class RetryPolicy:
+    """Jittered exponential backoff with a total deadline."""
+
+    def __init__(
+        self,
+        max_attempts=4,
+        base_delay=0.5,
+        max_delay=8,
+        deadline=30,
+        idempotent=True,
+    ):
+        """
+        Args:
+            max_attempts (int): Maximum number of attempts, including the first one.
+            base_delay (float): Backoff of the first retry in seconds.
+            max_delay (float): Upper bound of a single backoff in seconds.
+            deadline (float): Seconds after which no retry is started anymore.
+            idempotent (bool): See is_retryable.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.idempotent = idempotent
+
+    def backoff(self, attempt):
+        """Return a full jitter backoff in seconds for the given attempt."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def next_delay(self, exc, attempt, start):
+        """
+        Return the backoff before the next attempt, None if the call should give up.
+
+        Args:
+            exc (Exception): The exception of the last attempt.
+            attempt (int): The number of attempts made so far.
+            start (float): time.monotonic() of the first attempt.
+        """
+        if not is_retryable(exc, self.idempotent) or attempt >= self.max_attempts:
+            return None
+        delay = self.backoff(attempt)
+        if time.monotonic() - start + delay > self.deadline:
+            logger.error("Deadline of %ss exceeded, giving up.", self.deadline)
+            return None
+        return delay
+
+    def call(self, endpoint, send, breaker):
+        """
+        Send a blocking request with retries.
+
+        Args:
+            endpoint (str): The endpoint url, used for logging.
+            send (callable): Sends the request and returns the result.
+            breaker (CircuitBreaker): The circuit breaker of the endpoint.
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            trial = breaker.state != "closed"
+            if not breaker.allow():
+                raise CircuitOpenError(endpoint)
+            attempt += 1
+            try:
+                result = send()
+            except Exception as e:  # pylint: disable=broad-except
+                delay = self._on_error(endpoint, e, attempt, start, breaker)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # cancelled, the trial call did not run
+                if trial:
+                    breaker.record_cancelled()
+                raise
+            breaker.record_success()
+            return result
+
+    async def acall(self, endpoint, send, breaker):
+        """
+        Send a request with retries on the running event loop.
+
+        Args:
+            endpoint (str): The endpoint url, used for logging.
+            send (callable): Returns a coroutine which sends the request.
+            breaker (CircuitBreaker): The circuit breaker of the endpoint.
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            trial = breaker.state != "closed"
+            if not breaker.allow():
+                raise CircuitOpenError(endpoint)
+            attempt += 1
+            try:
+                result = await send()
+            except Exception as e:  # pylint: disable=broad-except
+                delay = self._on_error(endpoint, e, attempt, start, breaker)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # cancelled, the trial call did not run
+                if trial:
+                    breaker.record_cancelled()
+                raise
+            breaker.record_success()
+            return result
+
+    def _on_error(self, endpoint, exc, attempt, start, breaker):
+        if is_retryable(exc, self.idempotent):
+            breaker.record_failure()
+        else:
+            # the server answered, it is up
+            breaker.record_success()
+        delay = self.next_delay(exc, attempt, start)
+        if delay is None:
+            logger.error(
+                "Request to %s failed after %s attempts: %r", endpoint, attempt, exc
+            )
+        else:
+            logger.warning(
+                "Request to %s failed: %r, retrying in %.2fs (attempt %s)",
+                endpoint,
+                exc,
+                delay,
+                attempt,
+            )
+        return delay
+
+
+DEFAULT_POLICY = RetryPolicy()
+ENDPOINT_POLICIES = {
+    api_constants.STATION_LIST_ENDPOINT: RetryPolicy(max_attempts=5, deadline=60),
+    api_constants.TRIP_SEARCH_ENDPOINT: RetryPolicy(max_attempts=5, deadline=60),
+    # polled again in the next search round anyway
+    api_constants.VAGON_SEARCH_ENDPOINT: RetryPolicy(max_attempts=2, deadline=5),
+    api_constants.VAGON_HARITA_ENDPOINT: RetryPolicy(max_attempts=2, deadline=5),
+    api_constants.SEAT_CHECK_ENDPOINT: RetryPolicy(
+        max_attempts=3, base_delay=0.2, deadline=10
+    ),
+    api_constants.SELECT_EMPTY_SEAT_ENDPOINT: RetryPolicy(
+        max_attempts=3, base_delay=0.2, deadline=10
+    ),
+    api_constants.RELEASE_SEAT_ENDPOINT: RetryPolicy(max_attempts=3, deadline=10),
+    api_constants.MERNIS_DOGRULAMA_ENDPOINT: RetryPolicy(max_attempts=3, deadline=45),
+    # payments must not be sent twice
+    api_constants.VB_ENROLL_CONTROL_ENDPOINT: RetryPolicy(
+        max_attempts=3, idempotent=False
+    ),
+    api_constants.TICKET_RESERVATION_ENDPOINT: RetryPolicy(
+        max_attempts=3, idempotent=False
+    ),
+}
+
+
+def get_policy(endpoint):
+    """Return the retry policy of the given endpoint."""
+    return ENDPOINT_POLICIES.get(endpoint, DEFAULT_POLICY)
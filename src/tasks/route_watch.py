@@ -0,0 +1,349 @@
+"""Route watches shared by every user searching the same route and date window.
+
+A user's search is a subscription to a route key, made of the stations and the
+date window of the search. A single poller per route key (the watch_route celery
+task) runs the trip search and hands the empty seats it finds to the
+subscribers in arrival order, each subscriber locking only the seats of its
+seat type. A subscriber's locked Trip is published as its result and the
+subscription ends. So the number of busy workers grows with the number of
+distinct routes being watched, not with the number of users.
+
+Redis layout:
+    watch:subs:{route_key}     sorted set of subscription ids by subscribe time
+    watch:sub:{sub_id}         encoded Trip of a subscription, see tasks.trip_codec
+    watch:result:{sub_id}      encoded Trip with the locked seat
+    watch:expired:{sub_id}     set once every trip of the subscription departed
+    watch:poller:{route_key}   id of the poller task, kept alive by heartbeats
+"""
+
+import asyncio
+import copy
+import dataclasses
+import logging
+import time
+import uuid
+
+from tasks.redis_pool import redis_client
+from tasks.trip import SearchExpired, Trip
+from tasks.trip_search import TripSearchApi
+from tasks.trip_codec import decode_trip, encode_trip
+
+logger = logging.getLogger(__name__)
+
+# KEYS: poller key, ARGV: poller id, ttl in seconds.
+# Extends the poller key if it is owned by the poller or free, returns 1 if so.
+HEARTBEAT_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner and owner ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+# KEYS: subscription key, result key, subscriptions key of the route,
+# ARGV: encoded Trip, result ttl in seconds, subscription id.
+# Stores the result only if the subscription is still active, returns 1 if so.
+PUBLISH_SCRIPT = """
+redis.call('ZREM', KEYS[3], ARGV[3])
+if redis.call('DEL', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+
+def route_key(trip: Trip):
+    """Return the route key of the trip's search."""
+    key = f"{trip.from_station}:{trip.to_station}:{trip.from_date}:{trip.to_date}"
+    if trip.days:
+        key += ":" + ",".join(sorted(trip.days))
+    if trip.expand_stations:
+        key += ":expanded"
+    return key
+
+
+class RouteWatch:
+    """Subscriptions, results and poller ownership of the route watches."""
+
+    def __init__(self, client=redis_client, poller_ttl=30, result_ttl=600):
+        """
+        Args:
+            client (redis.Redis): Redis client holding the watches.
+            poller_ttl (int): Seconds a poller is considered alive after its last
+                heartbeat.
+            result_ttl (int): Seconds a locked Trip waits to be picked up.
+        """
+        self.client = client
+        self.poller_ttl = poller_ttl
+        self.result_ttl = result_ttl
+        self.heartbeat_script = client.register_script(HEARTBEAT_SCRIPT)
+        self.publish_script = client.register_script(PUBLISH_SCRIPT)
+
+    def subscribe(self, trip: Trip):
+        """
+        Subscribe the trip to the watch of its route.
+
+        Returns:
+            str: The subscription id.
+        """
+        sub_id = uuid.uuid4().hex
+        key = route_key(trip)
+        pipe = self.client.pipeline()
+        pipe.set(f"watch:sub:{sub_id}", encode_trip(trip))
+        pipe.zadd(f"watch:subs:{key}", {sub_id: time.time()})
+        pipe.execute()
+        logger.info("Subscribed %s to route: %s", sub_id, key)
+        return sub_id
+
+    def unsubscribe(self, sub_id):
+        """
+        End the subscription, if it is still waiting for a seat.
+
+        Returns:
+            bool: True if the subscription was active.
+        """
+        trip = self.get_trip(sub_id)
+        if trip is None:
+            return False
+        pipe = self.client.pipeline()
+        pipe.zrem(f"watch:subs:{route_key(trip)}", sub_id)
+        pipe.delete(f"watch:sub:{sub_id}")
+        pipe.execute()
+        logger.info("Unsubscribed %s from route: %s", sub_id, route_key(trip))
+        return True
+
+    def is_subscribed(self, sub_id):
+        """Check if the subscription is still waiting for a seat."""
+        return bool(sub_id) and bool(self.client.exists(f"watch:sub:{sub_id}"))
+
+    def get_trip(self, sub_id):
+        """Return the Trip of the subscription or None."""
+        payload = self.client.get(f"watch:sub:{sub_id}") if sub_id else None
+        return decode_trip(payload) if payload else None
+
+    def has_subscribers(self, key):
+        """Check if the route has any subscription left."""
+        return bool(self.client.zcard(f"watch:subs:{key}"))
+
+    def subscribers(self, key):
+        """Return the (sub_id, Trip) tuples of the route, in arrival order."""
+        sub_ids = [s.decode() for s in self.client.zrange(f"watch:subs:{key}", 0, -1)]
+        if not sub_ids:
+            return []
+        payloads = self.client.mget([f"watch:sub:{s}" for s in sub_ids])
+        subscribers = []
+        for sub_id, payload in zip(sub_ids, payloads):
+            if payload is None:
+                # the subscription data is gone, drop the stale entry
+                self.client.zrem(f"watch:subs:{key}", sub_id)
+                continue
+            subscribers.append((sub_id, decode_trip(payload)))
+        return subscribers
+
+    def publish_result(self, sub_id, trip: Trip):
+        """
+        Store the locked Trip of the subscription and end the subscription.
+
+        Returns:
+            bool: False if the subscription ended meanwhile, the lock is then
+            not stored and is left to the caller to release.
+        """
+        published = self.publish_script(
+            keys=[
+                f"watch:sub:{sub_id}",
+                f"watch:result:{sub_id}",
+                f"watch:subs:{route_key(trip)}",
+            ],
+            args=[encode_trip(trip), self.result_ttl, sub_id],
+        )
+        if published:
+            logger.info("Published locked seat for %s", sub_id)
+        return bool(published)
+
+    def pop_result(self, sub_id):
+        """Return and remove the locked Trip of the subscription, None if not ready."""
+        payload = self.client.getdel(f"watch:result:{sub_id}") if sub_id else None
+        return decode_trip(payload) if payload else None
+
+    def expire(self, key):
+        """End every subscription of the route, marking them expired."""
+        sub_ids = [s.decode() for s in self.client.zrange(f"watch:subs:{key}", 0, -1)]
+        pipe = self.client.pipeline()
+        for sub_id in sub_ids:
+            pipe.set(f"watch:expired:{sub_id}", 1, ex=self.result_ttl)
+            pipe.delete(f"watch:sub:{sub_id}")
+        pipe.delete(f"watch:subs:{key}")
+        pipe.execute()
+        logger.info("Expired %s subscriptions of route: %s", len(sub_ids), key)
+
+    def pop_expired(self, sub_id):
+        """Check if the subscription ended because its trips departed."""
+        return bool(sub_id) and bool(self.client.getdel(f"watch:expired:{sub_id}"))
+
+    def is_watched(self, key):
+        """Check if the route has a live poller."""
+        return bool(self.client.exists(f"watch:poller:{key}"))
+
+    def claim_poller(self, key):
+        """
+        Reserve the poller of the route, if it has none.
+
+        Returns:
+            str: The id to start the poller task with, None if the route already
+            has a poller.
+        """
+        poller_id = uuid.uuid4().hex
+        claimed = self.client.set(
+            f"watch:poller:{key}", poller_id, nx=True, ex=self.poller_ttl
+        )
+        return poller_id if claimed else None
+
+    def heartbeat(self, key, poller_id):
+        """Keep the poller of the route alive, False if another poller owns it."""
+        return bool(
+            self.heartbeat_script(
+                keys=[f"watch:poller:{key}"], args=[poller_id, self.poller_ttl]
+            )
+        )
+
+    def release_poller(self, key, poller_id):
+        """Release the poller of the route if it is owned by the poller."""
+        if self.client.get(f"watch:poller:{key}") == poller_id.encode():
+            self.client.delete(f"watch:poller:{key}")
+
+
+class RoutePoller:
+    """Searches a route and hands the empty seats out to its subscribers."""
+
+    def __init__(
+        self, key, poller_id, watch=None, refresh_interval=10, stop_interval=1
+    ):
+        """
+        Args:
+            key (str): The route key.
+            poller_id (str): The id the poller owns the route with.
+            watch (RouteWatch, optional): Defaults to the shared route_watch.
+            refresh_interval (int): Seconds between the heartbeats, the
+                subscribers are reloaded at the same time.
+            stop_interval (float): Seconds between the checks whether any
+                subscriber is left, between the heartbeats.
+        """
+        self.key = key
+        self.poller_id = poller_id
+        self.watch = watch or route_watch
+        self.refresh_interval = refresh_interval
+        self.stop_interval = stop_interval
+        self.subscribers = []
+
+    def search_trip(self):
+        """
+        Return the Trip the route is searched with.
+
+        It is a copy of the first subscriber's Trip, with the common seat type of
+        all the subscribers or any seat type if they differ.
+        """
+        trip = copy.deepcopy(self.subscribers[0][1])
+        seat_types = {t.passenger.seat_type for _, t in self.subscribers}
+        seat_type = seat_types.pop() if len(seat_types) == 1 else None
+        trip.passenger = dataclasses.replace(trip.passenger, seat_type=seat_type)
+        return trip
+
+    def refresh(self):
+        """
+        Renew the poller ownership and reload the subscribers.
+
+        Returns:
+            bool: False if the poller should stop.
+        """
+        if not self.watch.heartbeat(self.key, self.poller_id):
+            logger.warning("Route %s is owned by another poller.", self.key)
+            return False
+        self.subscribers = self.watch.subscribers(self.key)
+        return bool(self.subscribers)
+
+    async def run(self):
+        """Poll the route until no subscriber is left or all of its trips departed."""
+        if not self.refresh():
+            self.watch.release_poller(self.key, self.poller_id)
+            return
+        logger.info(
+            "Watching route: %s for %s subscribers", self.key, len(self.subscribers)
+        )
+        search_trip = self.search_trip()
+        queue = asyncio.Queue()
+        event = asyncio.Event()
+        failed_seats = {}
+        discovery = asyncio.create_task(
+            search_trip.find_trips(queue=queue, event=event)
+        )
+        next_refresh = time.monotonic() + self.refresh_interval
+        try:
+            while True:
+                getter = asyncio.create_task(queue.get())
+                done, _ = await asyncio.wait(
+                    {getter, discovery},
+                    timeout=self.stop_interval,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if getter not in done:
+                    getter.cancel()
+                    if discovery in done:
+                        # raises the exception of the search if there is one
+                        discovery.result()
+                        return
+                    if time.monotonic() < next_refresh:
+                        # the last subscriber stopped, no need to wait for the
+                        # heartbeat
+                        if not self.watch.has_subscribers(self.key):
+                            return
+                        continue
+                    if not self.refresh():
+                        return
+                    next_refresh = time.monotonic() + self.refresh_interval
+                    # applies from the next search round on
+                    search_trip.passenger = self.search_trip().passenger
+                    continue
+                trip, empty_seats = getter.result()
+                await self.fan_out(trip, empty_seats, failed_seats)
+                if not self.refresh():
+                    return
+                next_refresh = time.monotonic() + self.refresh_interval
+        except SearchExpired as e:
+            logger.info("%s, expiring route: %s", e, self.key)
+            self.watch.expire(self.key)
+        finally:
+            event.set()
+            discovery.cancel()
+            await asyncio.gather(discovery, return_exceptions=True)
+            self.watch.release_poller(self.key, self.poller_id)
+            logger.info("Stopped watching route: %s", self.key)
+
+    async def fan_out(self, trip, empty_seats, failed_seats):
+        """
+        Lock the empty seats for the subscribers in arrival order.
+
+        Every subscriber only tries the seats of its seat type, a seat locked for
+        a subscriber is not offered to the next ones.
+        """
+        remaining = list(empty_seats)
+        for sub_id, sub_trip in self.subscribers:
+            if not remaining:
+                break
+            if not self.watch.is_subscribed(sub_id):
+                continue
+            if not await sub_trip.lock_first_of(trip, remaining, failed_seats):
+                continue
+            if not self.watch.publish_result(sub_id, sub_trip):
+                # stopped while the seat was being locked
+                logger.info("Releasing the seat of ended subscription %s", sub_id)
+                await TripSearchApi.release_seat(
+                    trip, sub_trip.empty_seat_json, sub_trip.seat_lock_response
+                )
+                continue
+            locked = Trip.seat_key(trip, sub_trip.empty_seat_json)
+            remaining = [s for s in remaining if Trip.seat_key(trip, s) != locked]
+
+
+route_watch = RouteWatch()
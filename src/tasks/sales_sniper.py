@@ -0,0 +1,211 @@
+"""Seat lock on trips the moment their sales open.
+
+The regular search skips the trips whose satisDurum is not 1, so a seat on a
+train that is not on sale yet is only found by a later search round after the
+sales opened, when the other buyers are already on it. The sniper watches the
+seferIds picked by the user instead. Their seferSorgula summary is polled
+slowly until shortly before the expected open time, the worker's connections
+and the station registry are warmed up a little earlier, and around the open
+time the summary is polled at a high rate. As soon as a watched trip is on sale
+with vagon map seat selection, its vagon maps are fetched and the empty seats
+are locked in the same burst, which stops at the first lock. The latency from
+the poll that saw the sales open to the lock is recorded as
+sniper.open_to_lock in tasks.metrics.
+
+The polls are sent in the sniper lane of seferSorgula, see
+api_constants.LANE_RATE_LIMITS: the snipers share a cluster wide bucket of
+their own, so their bursts never starve the regular searches, and the snipers
+watching the same trips share cached responses younger than their poll
+interval.
+"""
+
+import asyncio
+import logging
+import time
+
+import aiohttp
+import dateparser
+
+import api_constants
+from tasks import worker_loop
+from tasks.metrics import metrics
+from tasks.server_clock import server_clock
+from tasks.trip import SearchExpired, Trip
+from tasks.trip_search import TripSearchApi
+
+logger = logging.getLogger(__name__)
+
+
+class SalesSniper:
+    """Watches the sales status of some trips and locks a seat once they open."""
+
+    def __init__(
+        self,
+        trip: Trip,
+        sefer_ids,
+        opens_at=None,
+        watch_interval=30,
+        warm_up_lead=60,
+        burst_lead=5,
+        burst_interval=0.5,
+        burst_duration=300,
+    ):
+        """
+        Args:
+            trip (Trip): The search and the passenger the seat is locked for.
+            sefer_ids (Iterable): The seferIds of the trips to watch.
+            opens_at (float, optional): Local epoch time the sales are expected to
+                open at. Without it the trips are polled at watch_interval and the
+                burst starts once the sales are seen open.
+            watch_interval (float): Seconds between the polls outside the burst.
+            warm_up_lead (float): Seconds before opens_at the worker is warmed up.
+            burst_lead (float): Seconds before opens_at the burst starts.
+            burst_interval (float): Seconds between the polls of the burst.
+            burst_duration (float): Seconds after the sales open, or are expected
+                to, the burst goes on for.
+        """
+        self.trip = trip
+        self.sefer_ids = set(sefer_ids)
+        self.opens_at = opens_at
+        self.watch_interval = watch_interval
+        self.warm_up_lead = warm_up_lead
+        self.burst_lead = burst_lead
+        self.burst_interval = burst_interval
+        self.burst_duration = burst_duration
+        # local epoch and monotonic times of the poll that first saw a trip on sale
+        self.opened_at = None
+        self.opened_monotonic = None
+
+    def burst_window(self):
+        """Return the local epoch start and end of the burst, None if unknown."""
+        starts = [t for t in (self.opens_at, self.opened_at) if t is not None]
+        if not starts:
+            return None
+        start = min(starts)
+        return start - self.burst_lead, start + self.burst_duration
+
+    def poll_interval(self, now):
+        """Return the seconds to wait before the next poll."""
+        window = self.burst_window()
+        if window is not None and window[0] <= now < window[1]:
+            return self.burst_interval
+        if window is not None and now < window[0]:
+            return min(self.watch_interval, max(window[0] - now, 0))
+        return self.watch_interval
+
+    async def poll(self):
+        """
+        Return the watched trips that are on sale, an empty list on errors.
+
+        Raises:
+            SearchExpired: Once every watched trip has departed.
+        """
+        try:
+            trips = await self.trip.asearch_windows(
+                check_satis_durum=False, lane=api_constants.SNIPER_LANE
+            )
+        except (ValueError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.error("Error while polling the sales status: %s", e)
+            return []
+        watched = [trip for trip in trips if trip["seferId"] in self.sefer_ids]
+        pending = self.trip.pending_trips(watched)
+        if watched and not pending:
+            raise SearchExpired(
+                self.trip.from_station, self.trip.to_station, self.trip.to_date
+            )
+        opened = [trip for trip in pending if trip["satisDurum"] == 1]
+        if opened and self.opened_at is None:
+            self.opened_at = time.time()
+            self.opened_monotonic = time.monotonic()
+            metrics.incr("sniper.opened")
+            logger.info(
+                "Sales opened for trips: %s", [trip["seferId"] for trip in opened]
+            )
+        return opened
+
+    async def lock(self, trips, failed_seats):
+        """
+        Fetch the vagon maps of the trips on sale and lock the first empty seat.
+
+        Returns:
+            bool: True if a seat is locked, the lock state is set on the trip.
+        """
+        queue = asyncio.Queue()
+        event = asyncio.Event()
+        # right after the sales open every vagon has empty seats, the vagon
+        # empty seat count round trip is skipped
+        discovery = asyncio.gather(
+            *[
+                TripSearchApi.get_empty_seats_trip(
+                    trip,
+                    trip["binisIstasyonu"],
+                    trip["inisIstasyonu"],
+                    self.trip.passenger.seat_type,
+                    event=event,
+                    pre_check=False,
+                    queue=queue,
+                )
+                for trip in trips
+            ]
+        )
+        return await self.trip.lock_streamed_seats(
+            discovery, queue, event, failed_seats
+        )
+
+    async def run(self):
+        """
+        Watch the trips until a seat is locked.
+
+        Raises:
+            SearchExpired: Once every watched trip has departed.
+
+        Returns:
+            bool: True if a seat is locked, False if the burst after the sales
+            opened ended without one.
+        """
+        logger.info(
+            "Sniping trips: %s, sales expected at: %s", self.sefer_ids, self.opens_at
+        )
+        warmed_up = self.opens_at is None
+        failed_seats = {}
+        while True:
+            metrics.log_periodic_snapshot()
+            if not warmed_up and time.time() >= self.opens_at - self.warm_up_lead:
+                await worker_loop.warm_up()
+                warmed_up = True
+                logger.info("Warmed up for the sales opening.")
+
+            opened = await self.poll()
+            if opened and await self.lock(opened, failed_seats):
+                latency = time.monotonic() - self.opened_monotonic
+                metrics.observe("sniper.open_to_lock", latency)
+                logger.info("Seat locked %.3fs after the sales opened.", latency)
+                return True
+
+            now = time.time()
+            if self.opened_at is not None and now >= self.burst_window()[1]:
+                logger.info("No seat locked in the burst after the sales opened.")
+                return False
+            interval = self.poll_interval(now)
+            if not warmed_up:
+                interval = min(interval, self.opens_at - self.warm_up_lead - now)
+            await asyncio.sleep(max(interval, 0))
+
+
+def parse_opens_at(opens_at):
+    """
+    Parse the time the sales open at, given in Turkish time like the trip dates.
+
+    Args:
+        opens_at (str): The time in a human readable format.
+
+    Raises:
+        ValueError: If the time cannot be parsed.
+
+    Returns:
+        float: The local epoch time, see tasks.server_clock.
+    """
+    parsed = dateparser.parse(opens_at)
+    if parsed is None:
+        raise ValueError(f"Invalid sales opening time: {opens_at}")
+    return server_clock.to_local(server_clock.timestamp(parsed.replace(tzinfo=None)))
@@ -0,0 +1,112 @@
+"""Estimate of the TCDD server clock and of its seat lock release delay.
+
+Seat locks end at the bitisZamani of the server, which used to be compared with
+the local clock. The offset between the two clocks is estimated from the Date
+headers of the responses: a header with the whole second s, received between
+the local times sent and received, bounds the offset to
+
+    s - received <= offset < s + 1 - sent
+
+and the bounds of the recent responses are intersected, which narrows the
+estimate well below the one second resolution of the header.
+
+The server also releases an expired lock some seconds after its bitisZamani.
+The delay at which renewals succeed is recorded, and the release window the
+renewals are aimed at is derived from the recent delays.
+"""
+
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from zoneinfo import ZoneInfo
+
+logger = logging.getLogger(__name__)
+
+SERVER_TIMEZONE = ZoneInfo("Europe/Istanbul")
+
+
+class ServerClock:
+    """Offset of the server clock and release window of the expired locks."""
+
+    def __init__(self, window=50, release_window=(15, 20), release_samples=20):
+        """
+        Args:
+            window (int): Number of recent Date headers the offset is estimated on.
+            release_window (tuple): Default seconds after the bitisZamani within
+                which an expired lock is released, until delays are recorded.
+            release_samples (int): Number of recent release delays kept.
+        """
+        self.bounds = deque(maxlen=window)
+        self.default_release_window = release_window
+        self.release_delays = deque(maxlen=release_samples)
+
+    def observe(self, date_header, sent, received):
+        """
+        Record the Date header of a response.
+
+        Args:
+            date_header (str): The Date header, ignored if None or malformed.
+            sent (float): Epoch time the request was sent.
+            received (float): Epoch time the response was received.
+        """
+        if not date_header:
+            return
+        try:
+            server_time = parsedate_to_datetime(date_header).timestamp()
+        except (TypeError, ValueError):
+            return
+        self.bounds.append((server_time - received, server_time + 1 - sent))
+
+    @property
+    def offset(self):
+        """Seconds the server clock is ahead of the local clock."""
+        if not self.bounds:
+            return 0.0
+        low = max(b[0] for b in self.bounds)
+        high = min(b[1] for b in self.bounds)
+        if low > high:
+            # the clocks drifted, the latest response is the best estimate
+            low, high = self.bounds[-1]
+            self.bounds.clear()
+            self.bounds.append((low, high))
+            logger.info("Server clock estimate reset.")
+        return (low + high) / 2
+
+    def now(self):
+        """Return the current server time as epoch seconds."""
+        return time.time() + self.offset
+
+    def wall_time(self):
+        """Return the current server time as a naive datetime, like the trip dates."""
+        return datetime.fromtimestamp(self.now(), SERVER_TIMEZONE).replace(tzinfo=None)
+
+    def to_local(self, server_time):
+        """Return the local epoch time of the given server epoch time."""
+        return server_time - self.offset
+
+    @staticmethod
+    def timestamp(server_datetime: datetime):
+        """Return the epoch time of a naive server datetime like bitisZamani."""
+        return server_datetime.replace(tzinfo=SERVER_TIMEZONE).timestamp()
+
+    def record_release(self, delay):
+        """Record the seconds after the bitisZamani an expired lock was renewed at."""
+        self.release_delays.append(delay)
+
+    def release_window(self):
+        """
+        Return the seconds after the bitisZamani an expired lock is released within.
+
+        Returns:
+            tuple: The start and the end of the window.
+        """
+        if len(self.release_delays) < 3:
+            return self.default_release_window
+        delays = sorted(self.release_delays)
+        # start slightly before the earliest recent release
+        return max(delays[0] - 1, 0), delays[-1] + 1
+
+
+server_clock = ServerClock()
@@ -0,0 +1,105 @@
+"""Alternate boarding and alighting stations on the same YHT line.
+
+Seats are sold from quotas per segment, so a train sold out between the
+stations the user typed often still has seats on a slightly longer segment,
+boarding a stop earlier or alighting a stop later. The expansion walks the
+station order of the lines in api_constants.YHT_LINES and returns the segments
+covering the user's one, ranked by their detour cost: every stop boarded
+earlier costs BOARDING_COST, as the user has to get to another station, every
+stop alighted later costs ALIGHTING_COST, as the user only stays on board.
+
+The segments are searched by Trip.asearch_windows when the trip opts in with
+expand_stations, see tasks.trip.
+"""
+
+import logging
+import re
+import unicodedata
+
+import api_constants
+from tasks.trip_search import station_registry
+
+logger = logging.getLogger(__name__)
+
+BOARDING_COST = 2
+ALIGHTING_COST = 1
+
+# suffixes the station names are listed with or without
+NAME_SUFFIXES = re.compile(r"\b(YHT|GAR)\b")
+
+
+def normalize_station_name(name):
+    """Return the name uppercased, without diacritics, punctuation and suffixes."""
+    name = name.replace("i", "İ").replace("ı", "I").upper()
+    name = unicodedata.normalize("NFKD", name)
+    name = "".join(c for c in name if not unicodedata.combining(c))
+    name = NAME_SUFFIXES.sub("", name)
+    return re.sub(r"[^A-Z]", "", name)
+
+
+class StationExpansion:
+    """Segments of the YHT lines around a station pair."""
+
+    def __init__(self, lines=api_constants.YHT_LINES, registry=station_registry):
+        """
+        Args:
+            lines (tuple): The station names of every line, in order.
+            registry (StationRegistry): Resolves the names to the station names
+                the api knows.
+        """
+        self.line_names = lines
+        self.registry = registry
+
+    def lines(self):
+        """Return the lines as lists of registry station names, in order."""
+        by_name = {
+            normalize_station_name(name): name for name in self.registry.names()
+        }
+        lines = []
+        for line in self.line_names:
+            stations = []
+            for name in line:
+                station = by_name.get(normalize_station_name(name))
+                if station is None:
+                    logger.debug("Line station is not in the registry: %s", name)
+                    continue
+                stations.append(station)
+            lines.append(stations)
+        return lines
+
+    def pairs(self, from_station, to_station, max_extra_stops=2):
+        """
+        Return the segments covering the given one on the same line.
+
+        Args:
+            from_station (str): The boarding station of the user.
+            to_station (str): The alighting station of the user.
+            max_extra_stops (int): Maximum number of stops to board earlier and
+                to alight later each.
+
+        Returns:
+            list: (from_station, to_station, detour cost) tuples ranked by the
+            cost, without the given segment.
+        """
+        costs = {}
+        for line in self.lines():
+            if from_station not in line or to_station not in line:
+                continue
+            start, end = line.index(from_station), line.index(to_station)
+            if start > end:
+                # travelling the line backwards
+                line = line[::-1]
+                start, end = len(line) - 1 - start, len(line) - 1 - end
+            for earlier in range(min(max_extra_stops, start) + 1):
+                for later in range(min(max_extra_stops, len(line) - 1 - end) + 1):
+                    if not earlier and not later:
+                        continue
+                    pair = (line[start - earlier], line[end + later])
+                    cost = earlier * BOARDING_COST + later * ALIGHTING_COST
+                    costs[pair] = min(cost, costs.get(pair, cost))
+        return sorted(
+            ((*pair, cost) for pair, cost in costs.items()), key=lambda p: p[2]
+        )
+
+
+station_expansion = StationExpansion()
@@ -0,0 +1,191 @@
+"""Process wide YHT station registry.
+
+The station list barely changes, so it is loaded once and kept in process
+memory, in Redis (shared between the bot and the celery workers) and in a disk
+snapshot under bot_data for instant cold starts. Stale data keeps being served
+while a background thread refreshes it.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import redis
+
+from tasks.redis_pool import redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class StationRegistry:
+    """Station list with name, id and code indexes."""
+
+    redis_key = "stations:yht"
+
+    def __init__(
+        self,
+        fetch,
+        ttl=6 * 60 * 60,
+        snapshot_path="../bot_data/stations.json",
+        client=redis_client,
+    ):
+        """
+        Args:
+            fetch (callable): Returns a fresh list of station dicts from the API.
+            ttl (int): Seconds after which the station list is refreshed.
+            snapshot_path (str): Disk snapshot location.
+            client (redis.Redis): Redis client used for the shared copy.
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.client = client
+        self.loaded_at = 0
+        self._stations = []
+        self._by_name = {}
+        self._by_id = {}
+        self._by_code = {}
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def is_stale(self):
+        """Check if the loaded station list is older than the ttl."""
+        return time.time() - self.loaded_at > self.ttl
+
+    def stations(self):
+        """Return the list of station dicts."""
+        self._ensure_loaded()
+        return self._stations
+
+    def names(self):
+        """Return the list of station names."""
+        self._ensure_loaded()
+        return list(self._by_name)
+
+    def get(self, station_name):
+        """Return the station dict for the given name or None."""
+        self._ensure_loaded()
+        return self._by_name.get(station_name)
+
+    def station_id(self, station_name):
+        """Return the station id for the given station name.
+
+        Raises:
+            ValueError: If the station name is not a valid station.
+        """
+        station = self.get(station_name)
+        if station is None:
+            logger.error("%s is not a valid station", station_name)
+            raise ValueError(f"{station_name} is not a valid station")
+        return station["station_id"]
+
+    def station_name(self, station_id):
+        """Return the station name for the given station id or None."""
+        self._ensure_loaded()
+        station = self._by_id.get(station_id)
+        return station["station_name"] if station else None
+
+    def by_code(self, station_code):
+        """Return the station dict for the given station code or None."""
+        self._ensure_loaded()
+        return self._by_code.get(station_code)
+
+    def refresh(self, stations=None):
+        """Fetch the station list from the API and store it everywhere.
+
+        Args:
+            stations (list, optional): An already fetched station list, fetched
+                with fetch if None.
+        """
+        stations = stations or self.fetch()
+        if not stations:
+            logger.error("Station list refresh returned no stations.")
+            return False
+        loaded_at = time.time()
+        self._set(stations, loaded_at)
+        payload = json.dumps({"loaded_at": loaded_at, "stations": stations})
+        self._write_redis(payload)
+        self._write_snapshot(payload)
+        logger.info("Station registry refreshed: %s stations", len(stations))
+        return True
+
+    def _ensure_loaded(self):
+        if self._stations:
+            if self.is_stale():
+                self._refresh_in_background()
+            return
+
+        with self._lock:
+            if self._stations:
+                return
+            for source in (self._read_redis, self._read_snapshot):
+                payload = source()
+                if payload:
+                    self._set(payload["stations"], payload["loaded_at"])
+                    break
+            if self._stations:
+                if self.is_stale():
+                    self._refresh_in_background()
+                return
+            logger.info("No cached station list found, fetching.")
+            self.refresh()
+
+    def _refresh_in_background(self):
+        if self._refreshing:
+            return
+        self._refreshing = True
+
+        def run():
+            try:
+                # another process may have refreshed the shared copy already
+                payload = self._read_redis()
+                if payload and time.time() - payload["loaded_at"] < self.ttl:
+                    self._set(payload["stations"], payload["loaded_at"])
+                else:
+                    self.refresh()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error("Error while refreshing station registry: %s", e)
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="station-registry", daemon=True).start()
+
+    def _set(self, stations, loaded_at):
+        self._by_name = {s["station_name"]: s for s in stations}
+        self._by_id = {s["station_id"]: s for s in stations}
+        self._by_code = {s["station_code"]: s for s in stations}
+        self._stations = stations
+        self.loaded_at = loaded_at
+
+    def _read_redis(self):
+        try:
+            payload = self.client.get(self.redis_key)
+        except redis.exceptions.RedisError as e:
+            logger.error("Error while reading station list from redis: %s", e)
+            return None
+        return json.loads(payload) if payload else None
+
+    def _write_redis(self, payload):
+        try:
+            self.client.set(self.redis_key, payload, ex=self.ttl)
+        except redis.exceptions.RedisError as e:
+            logger.error("Error while writing station list to redis: %s", e)
+
+    def _read_snapshot(self):
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            logger.info("No usable station snapshot: %s", e)
+            return None
+
+    def _write_snapshot(self, payload):
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as file:
+                file.write(payload)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError as e:
+            logger.error("Error while writing station snapshot: %s", e)
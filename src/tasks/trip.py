@@ -1,17 +1,37 @@
 """This script is used to automate the ticket purchase process from TCDD website."""
 
 import asyncio
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
 import random
+import time
+import dateparser
 import requests
+import api_constants
+from tasks import worker_loop
+from tasks.metrics import metrics
+from tasks.poll_scheduler import PollScheduler
+from tasks.server_clock import server_clock
+from tasks.station_expansion import station_expansion
 from tasks.trip_search import TripSearchApi
 from tasks.trip_search import SeatLockedException
+from tasks.trip_search import station_registry
 from passenger import Passenger, Seat
 
 logger = logging.getLogger(__name__)
 
 
+class SearchExpired(Exception):
+    """Exception raised when every trip of the search window has departed."""
+
+    def __init__(self, from_station, to_station, to_date):
+        self.message = (
+            f"Every trip from {from_station} to {to_station} until {to_date} "
+            "has departed"
+        )
+        super().__init__(self.message)
+
+
 class Trip:
     """Trip class to store trip details."""
 
@@ -35,7 +55,35 @@ class Trip:
         self.seat_lock_response = None
         self.koltuk_lock_id_list = []
         self.lock_end_time = None
-        self.semaphore_count = 2
+        # seconds to wait between search rounds that found no empty seats
+        self.poll_interval = 3
+        # vagon requests per minute over all the trips, see tasks.poll_scheduler
+        self.poll_budget = api_constants.POLL_REQUEST_BUDGET
+        # seconds to skip a seat after a failed lock attempt
+        self.failed_seat_ttl = 60
+        # number of seats to race lock attempts on, 1 tries the seats one by one
+        self.lock_race_size = 3
+        # lock with klSec only, falling back to klCheck on ambiguous responses
+        self.fast_lock = False
+        # seconds a trip stays eligible for vagon map fetches after its seat
+        # counts changed, the counts are updated a little late on server side
+        self.count_change_window = 120
+        # seferId -> (vagon_type_counts, monotonic time of the last change)
+        self.seat_counts = {}
+        # seconds before its departure a trip is dropped from the search
+        self.departure_cutoff = 300
+        # days to search between the times of day of from_date and to_date,
+        # None searches every day from from_date to to_date
+        self.days = None
+        # search the segments around the trip's one on the same line too, and
+        # how many of the cheapest ones, see tasks.station_expansion
+        self.expand_stations = False
+        self.max_station_pairs = 4
+
+    def __setstate__(self, state):
+        # trips pickled by an older version lack the newer attributes
+        defaults = Trip(None, None, None).__dict__
+        self.__dict__.update({**defaults, **state})
 
     def is_reservation_expired(self):
         """Check if the seat reservation is expired."""
@@ -64,6 +112,15 @@ class Trip:
             self.koltuk_lock_id_list.append(seat["koltukLockId"])
         logger.info("koltuk_lock_id_list: %s", self.koltuk_lock_id_list)
 
+    def set_lock_state(self, trip, empty_seat, lock_end_time, seat_lock_response):
+        """Store the state of a successful seat lock."""
+        logger.info("Seat is reserved, setting lock_end_time: %s", lock_end_time)
+        self.trip_json = trip
+        self.empty_seat_json = empty_seat
+        self.seat_lock_response = seat_lock_response
+        self.lock_end_time = datetime.strptime(lock_end_time, self.time_format)
+        self.set_seat_lock_id()
+
     def reserve_seat(self):
         """Reserve a seat for the given trip."""
 
@@ -94,11 +151,12 @@ class Trip:
             elif self.lock_end_time:
                 if datetime.now().second % 30 == 0:
                     logger.info("Seat is already reserved.")
-                time_diff = self.lock_end_time - datetime.now()
-                # server doesnt seem to release the lock at least 15-20 seconds
-                # after the lock_end_time so we are starting to reserve
-                #  the seat again 10 seconds after the lock_end_time
-                if time_diff.total_seconds() < -10:
+                # server doesnt release the lock until some seconds after the
+                # lock_end_time, reserve the seat again once the release window
+                # starts on the server's clock, see tasks.server_clock
+                start, _ = server_clock.release_window()
+                release_start = server_clock.timestamp(self.lock_end_time) + start
+                if server_clock.now() >= release_start:
                     logger.info("Lock time expired, setting lock_end_time to None")
                     self.lock_end_time = None
 
@@ -107,10 +165,207 @@ class Trip:
 
     def get_trips(self, **kwargs):
         """Get the trips based on the given parameters."""
-        trips = []
         trips = TripSearchApi.search_trips(
             self.from_station, self.to_station, self.from_date, self.to_date, **kwargs
         )
+        return self._found_trips(trips)
+
+    async def aget_trips(self, **kwargs):
+        """Async counterpart of get_trips, does not block the event loop."""
+        trips = await TripSearchApi.asearch_trips(
+            self.from_station, self.to_station, self.from_date, self.to_date, **kwargs
+        )
+        return self._found_trips(trips)
+
+    def departure_deadline(self):
+        """Return the earliest departure still searched for, on the server's clock."""
+        return server_clock.wall_time() + timedelta(seconds=self.departure_cutoff)
+
+    def day_windows(self):
+        """
+        Return the (start, end) datetimes of every day of the search.
+
+        With days, every day is searched between the times of day of from_date
+        and to_date. Otherwise every day from from_date to to_date is searched,
+        without a to_date the search ends with the day of the from_date.
+
+        Returns:
+            list: The windows, in date order.
+        """
+        start = (
+            dateparser.parse(self.from_date)
+            if self.from_date
+            else self.departure_deadline()
+        )
+        end = dateparser.parse(self.to_date) if self.to_date else None
+        end_of_day = datetime.max.time().replace(microsecond=0)
+        if self.days:
+            end_time = end.time() if end else end_of_day
+            days = sorted({dateparser.parse(day).date() for day in self.days})
+            return [
+                (
+                    datetime.combine(day, start.time()),
+                    datetime.combine(day, end_time),
+                )
+                for day in days
+            ]
+        if end is None:
+            return [(start, datetime.combine(start.date(), end_of_day))]
+        windows = []
+        day = start.date()
+        while day <= end.date():
+            windows.append(
+                (
+                    max(start, datetime.combine(day, datetime.min.time())),
+                    min(end, datetime.combine(day, end_of_day)),
+                )
+            )
+            day += timedelta(days=1)
+        return windows
+
+    def search_windows(self):
+        """
+        Return the dates to search every day with, narrowed to the trips not
+        departed yet.
+
+        Raises:
+            SearchExpired: If every window ends before the departure deadline.
+
+        Returns:
+            list: The (from_date, to_date) tuple of every day, see day_windows.
+        """
+        deadline = self.departure_deadline()
+        # rounded to the minute, so the narrowed searches of the users watching
+        # the same route still share the response cache
+        earliest = deadline.replace(second=0, microsecond=0)
+        day_windows = self.day_windows()
+        windows = [
+            (
+                datetime.strftime(max(start, earliest), self.time_format),
+                datetime.strftime(end, self.time_format),
+            )
+            for start, end in day_windows
+            if end >= deadline
+        ]
+        if not windows:
+            raise SearchExpired(
+                self.from_station, self.to_station, day_windows[-1][1]
+            )
+        return windows
+
+    def is_expired(self):
+        """Check if every trip of the search window has departed."""
+        try:
+            self.search_windows()
+        except SearchExpired:
+            return True
+        return False
+
+    def pending_trips(self, trips):
+        """Return the trips departing after the departure deadline."""
+        deadline = self.departure_deadline()
+        pending = [
+            trip
+            for trip in trips
+            if datetime.strptime(trip["binisTarih"], self.time_format) >= deadline
+        ]
+        if len(pending) < len(trips):
+            logger.info("Dropped %s departed trips.", len(trips) - len(pending))
+        return pending
+
+    def station_pairs(self):
+        """
+        Return the (from_station, to_station, detour cost) segments to search.
+
+        The segment of the trip comes first, with expand_stations the segments
+        around it on the same line follow, see tasks.station_expansion.
+        """
+        pairs = [(self.from_station, self.to_station, 0)]
+        if self.expand_stations:
+            pairs += station_expansion.pairs(self.from_station, self.to_station)[
+                : self.max_station_pairs
+            ]
+        return pairs
+
+    def has_reported_seats(self, trip):
+        """Check if the trip summary reports empty seats of the passenger's type."""
+        seat_type = self.passenger.seat_type if self.passenger else None
+        return any(
+            count > 0
+            for vagon_type, count in trip.get("vagon_type_counts", {}).items()
+            if not seat_type or vagon_type == seat_type
+        )
+
+    async def asearch_windows(self, **kwargs):
+        """
+        Search every day and segment of the search concurrently and merge the
+        trips.
+
+        A trip found on several segments is kept once, on the cheapest segment
+        reporting empty seats, so its vagon maps are not fetched twice.
+
+        Raises:
+            SearchExpired: If every trip of the search window has departed.
+
+        Returns:
+            list: The trips ranked by their detour cost, then in departure order,
+            see search_trips. The trips of another segment carry their cost as
+            'detour'. The errors of a search are logged as long as another search
+            succeeds.
+        """
+        windows = self.search_windows()
+        searches = [
+            (pair, window) for pair in self.station_pairs() for window in windows
+        ]
+        results = await asyncio.gather(
+            *[
+                TripSearchApi.asearch_trips(
+                    from_station, to_station, from_date, to_date, **kwargs
+                )
+                for (from_station, to_station, _), (from_date, to_date) in searches
+            ],
+            return_exceptions=True,
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors and len(errors) == len(results):
+            raise errors[0]
+        for error in errors:
+            logger.error("Error while searching the trip: %s", error)
+
+        def rank(trip):
+            # the cheapest segment reporting empty seats wins
+            return not self.has_reported_seats(trip), trip["detour"]
+
+        trips = {}
+        for ((_, _, detour), _), result in zip(searches, results):
+            if isinstance(result, BaseException):
+                continue
+            for trip in result:
+                trip["detour"] = detour
+                kept = trips.get(trip["seferId"])
+                if kept is None or rank(trip) < rank(kept):
+                    trips[trip["seferId"]] = trip
+        return sorted(
+            trips.values(),
+            key=lambda trip: (
+                trip["detour"],
+                datetime.strptime(trip["binisTarih"], self.time_format),
+            ),
+        )
+
+    async def aget_pending_trips(self, **kwargs):
+        """
+        aget_trips over every day of the search, narrowed to the trips not
+        departed yet, see search_windows.
+
+        Raises:
+            SearchExpired: If every trip of the search window has departed.
+        """
+        trips = await self.asearch_windows(**kwargs)
+        return self._found_trips(self.pending_trips(trips))
+
+    @staticmethod
+    def _found_trips(trips):
         # return none if no trips are found
         if len(trips) == 0:
             logger.info("No trips found. Returning None.")
@@ -119,71 +374,317 @@ class Trip:
         logger.info("returning trips")
         return trips
 
-    async def find_trips(self):
+    async def find_trips(
+        self, queue: asyncio.Queue = None, event: asyncio.Event = None
+    ):
         """Find a trip based on the given parameters.
         This function will keep searching for trips until it finds a trip with empty seats.
+
+        If a queue is given, the empty seats are streamed into it as (trip, empty_seats)
+        tuples and the search goes on until the event is set by the consumer.
+
+        The trip summaries are refreshed every round, the vagons of a trip are only
+        checked when the poll scheduler finds the trip due. The days of a multi-day
+        search are searched concurrently and their trips polled as a single set.
+        The departed trips are dropped and the search window narrowed as time
+        advances.
+
+        Raises:
+            SearchExpired: Once every trip of the search window has departed.
         """
         trips_with_empty_seats = []
-        event = asyncio.Event()
-        # lock for shared resource trips_with_empty_seats
-        sem = asyncio.Semaphore(self.semaphore_count)
+        event = event or asyncio.Event()
+        self.seat_counts = {}
+        scheduler = PollScheduler(budget=self.poll_budget)
+        # lock for shared resource trips_with_empty_seats, the number of vagon
+        # requests in flight is limited by the adaptive limiters of the client
         lock = asyncio.Lock()
         logger.info("Searching for trips with empty seat.")
+        first_poll = True
 
         # if trips_with_empty_seats is empty keep searching for trips
-        while len(trips_with_empty_seats) == 0:
+        while len(trips_with_empty_seats) == 0 and not event.is_set():
             logger.info("trips_with_empty_seats is empty, Getting trips.")
-            trips = self.get_trips()
+            metrics.log_periodic_snapshot()
+            start = time.monotonic()
+            trips = await self.aget_pending_trips() or []
+            if first_poll:
+                # cold connections show up here, see tasks.worker_loop
+                metrics.observe("search.first_poll", time.monotonic() - start)
+                first_poll = False
+            vagon_types = {}
+            for trip in trips:
+                trip_vagon_types = self.vagon_types_to_fetch(trip)
+                if trip_vagon_types:
+                    vagon_types[trip["seferId"]] = trip_vagon_types
+            changed_at = {
+                sefer_id: changed for sefer_id, (_, changed) in self.seat_counts.items()
+            }
+            costs = {
+                trip["seferId"]: scheduler.check_cost(
+                    trip, vagon_types[trip["seferId"]]
+                )
+                for trip in trips
+                if trip["seferId"] in vagon_types
+            }
+            due_trips = scheduler.due(
+                [trip for trip in trips if trip["seferId"] in vagon_types],
+                changed_at,
+                costs,
+            )
             tasks = [
                 self.check_trip_for_empty_seats(
-                    trip, trips_with_empty_seats, lock, sem, event
+                    trip,
+                    trips_with_empty_seats,
+                    lock,
+                    event,
+                    queue=queue,
+                    vagon_types=vagon_types[trip["seferId"]],
                 )
-                for trip in trips
+                for trip in due_trips
             ]
             logger.info("Waiting for tasks to complete: len: %s", len(tasks))
             await asyncio.gather(*tasks)
             logger.info("All tasks completed.")
+            if not trips_with_empty_seats and not event.is_set():
+                # most trips are sold out and skipped without any vagon map
+                # request, dont hammer the trip search endpoint
+                await asyncio.sleep(self.poll_interval)
         logger.info(
             " YUPPI! Trips with empty seats len: %s", len(trips_with_empty_seats)
         )
         return trips_with_empty_seats
 
     async def check_trip_for_empty_seats(
-        self, trip, trips_with_empty_seats, lock, sem, event
+        self,
+        trip,
+        trips_with_empty_seats,
+        lock,
+        event,
+        queue=None,
+        vagon_types=None,
     ):
-        """Check if the given trip has empty seats."""
+        """Check if the given trip has empty seats.
+
+        With a queue the empty seats are only streamed into it, setting the event
+        is left to the consumer. vagon_types defaults to vagon_types_to_fetch.
+        """
         # await asyncio.sleep(100)
         # logger.info("Checking trip for empty seats: %s", trip.get("binisTarih"))
 
-        # lock for running only a certain amount of tasks concurrently
         if event.is_set():
             logger.info("-------------Event is set returning-----------------")
             return
-        async with sem:
-            # sleep random first before starting, because of concurrent requests
-            # we dont want to start all requests at the same time
-            sleep = random.uniform(0, 1)
-            logger.info("Sleeping: %s before getting empty seats for trip", sleep)
-            await asyncio.sleep(sleep)
-            # while not event.is_set():
-            trip = await TripSearchApi.get_empty_seats_trip(
-                trip,
-                self.from_station,
-                self.to_station,
-                self.passenger.seat_type,
-                event=event,
-            )
-            empty_seat_count = await self.get_trip_empty_seat_count(trip)
-            if empty_seat_count > 0:
-                # onyl one  task should access the shared resources below at a time
-                async with lock:
-                    # while not event.is_set():
-                    if not event.is_set():
-                        logger.info(
-                            "Empty seat found setting EVENT. Appending trip to trips_with_empty_seats"
+        if vagon_types is None:
+            vagon_types = self.vagon_types_to_fetch(trip)
+        if not vagon_types:
+            logger.debug("No empty seats reported for trip: %s", trip["seferId"])
+            return
+        # sleep random first before starting, because of concurrent requests
+        # we dont want to start all requests at the same time
+        sleep = random.uniform(0, 1)
+        logger.info("Sleeping: %s before getting empty seats for trip", sleep)
+        await asyncio.sleep(sleep)
+        # while not event.is_set():
+        trip = await TripSearchApi.get_empty_seats_trip(
+            trip,
+            trip["binisIstasyonu"],
+            trip["inisIstasyonu"],
+            self.passenger.seat_type,
+            event=event,
+            vagon_types=vagon_types,
+            queue=queue,
+        )
+        if queue is None and len(trip["empty_seats"]) > 0:
+            # onyl one  task should access the shared resources below at a time
+            async with lock:
+                # while not event.is_set():
+                if not event.is_set():
+                    logger.info(
+                        "Empty seat found setting EVENT. Appending trip to trips_with_empty_seats"
+                    )
+                    event.set()
+                    trips_with_empty_seats.append(trip)
+
+    async def find_and_lock_seat(self):
+        """Search for trips with empty seats and lock a seat as soon as it shows up.
+
+        The vagon maps stream into a queue while the search keeps running, every
+        batch of empty seats is tried right away on the same event loop and the
+        search is cancelled once a lock succeeds.
+
+        Returns:
+            bool: True if a seat is locked.
+        """
+        queue = asyncio.Queue()
+        event = asyncio.Event()
+        return await self.lock_streamed_seats(
+            self.find_trips(queue=queue, event=event), queue, event
+        )
+
+    async def lock_streamed_seats(self, discovery, queue, event, failed_seats=None):
+        """
+        Lock a seat of the empty seats the discovery streams into the queue.
+
+        Args:
+            discovery (Coroutine): Puts (trip, empty_seats) tuples into the queue,
+                it is cancelled once a lock succeeds or the queue is drained after
+                it finished.
+            queue (asyncio.Queue): The queue the discovery streams into.
+            event (asyncio.Event): Set once a lock succeeds.
+            failed_seats (dict, optional): See lock_first_of.
+
+        Returns:
+            bool: True if a seat is locked.
+        """
+        failed_seats = {} if failed_seats is None else failed_seats
+        discovery = asyncio.ensure_future(discovery)
+        try:
+            while True:
+                getter = asyncio.create_task(queue.get())
+                done, _ = await asyncio.wait(
+                    {getter, discovery}, return_when=asyncio.FIRST_COMPLETED
+                )
+                if getter not in done:
+                    getter.cancel()
+                    # raises the exception of the search if there is one
+                    discovery.result()
+                    return False
+                trip, empty_seats = getter.result()
+                if await self.lock_first_of(trip, empty_seats, failed_seats):
+                    event.set()
+                    return True
+        finally:
+            discovery.cancel()
+            await asyncio.gather(discovery, return_exceptions=True)
+
+    async def lock_first_of(self, trip, empty_seats, failed_seats):
+        """
+        Try to lock the given seats until a lock succeeds.
+
+        Lock attempts are fired concurrently on lock_race_size seats at a time, the
+        first successful lock is kept and returned as soon as it lands. The other
+        attempts of the race are left to release_late_lock in the background,
+        see tasks.worker_loop.spawn.
+
+        Args:
+            trip (dict): The trip of the seats.
+            empty_seats (list): The empty seats of a vagon.
+            failed_seats (dict): (seferId, vagonSiraNo, koltukNo) -> monotonic time
+                of the last failed attempt, these seats are skipped for a while.
+
+        Returns:
+            bool: True if a seat is locked, the lock state is set on the trip.
+        """
+        candidates = []
+        for empty_seat in empty_seats:
+            if (
+                self.passenger.seat_type
+                and empty_seat.get("vagonTipId") != self.passenger.seat_type
+            ):
+                continue
+            last_failed = failed_seats.get(self.seat_key(trip, empty_seat))
+            if last_failed and time.monotonic() - last_failed < self.failed_seat_ttl:
+                continue
+            candidates.append(empty_seat)
+
+        race_size = max(self.lock_race_size, 1)
+        for i in range(0, len(candidates), race_size):
+            attempts = {
+                asyncio.ensure_future(
+                    TripSearchApi.lock_seat(trip, empty_seat, fast=self.fast_lock)
+                ): empty_seat
+                for empty_seat in candidates[i : i + race_size]
+            }
+            pending = set(attempts)
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    winner = next((t for t in done if t.exception() is None), None)
+                    late = done
+                    if winner is not None:
+                        # the other attempts are released as they land
+                        late = (done | pending) - {winner}
+                    for task in late:
+                        worker_loop.spawn(
+                            self.release_late_lock(
+                                trip, task, attempts[task], failed_seats
+                            )
                         )
-                        event.set()
-                        trips_with_empty_seats.append(trip)
+                    if winner is not None:
+                        lock_end_time, empty_seat, seat_lock_response = winner.result()
+                        self.set_lock_state(
+                            trip, empty_seat, lock_end_time, seat_lock_response
+                        )
+                        return True
+            except BaseException:
+                for task in pending:
+                    task.cancel()
+                    failed_seats[self.seat_key(trip, attempts[task])] = time.monotonic()
+                raise
+        return False
+
+    async def release_late_lock(self, trip, attempt, empty_seat, failed_seats):
+        """
+        Release the seat of a lock attempt of a race that is already decided.
+
+        Args:
+            trip (dict): The trip of the seat.
+            attempt (asyncio.Future): The lock_seat attempt of the seat.
+            empty_seat (dict): The seat of the attempt.
+            failed_seats (dict): See lock_first_of, a failed attempt is added.
+        """
+        try:
+            _, empty_seat, seat_lock_response = await attempt
+        except Exception as e:  # pylint: disable=broad-except
+            logger.error("Error while locking the seat: %s", e)
+            failed_seats[self.seat_key(trip, empty_seat)] = time.monotonic()
+            return
+        logger.info("Releasing extra lock: %s", empty_seat)
+        await TripSearchApi.release_seat(trip, empty_seat, seat_lock_response)
+
+    @staticmethod
+    def seat_key(trip, empty_seat):
+        """Return a hashable key identifying the seat of the trip."""
+        return (trip["seferId"], empty_seat["vagonSiraNo"], empty_seat["koltukNo"])
+
+    def vagon_types_to_fetch(self, trip):
+        """
+        Return the vagon types worth fetching the vagon maps for.
+
+        The seat counts of the trip summary are used as a gate, only the vagon
+        types with empty seats are returned. All vagon types are returned for a
+        while after the counts of the trip changed, the summary may lag behind.
+
+        Args:
+            trip (dict): The trip returned by get_trips.
+
+        Returns:
+            set: The vagonTipIds, filtered by the passenger's seat type.
+        """
+        now = time.monotonic()
+        counts = trip.get("vagon_type_counts", {})
+        previous = self.seat_counts.get(trip["seferId"])
+        if previous is None:
+            self.seat_counts[trip["seferId"]] = (counts, None)
+        elif previous[0] != counts:
+            logger.info("Seat counts changed for trip: %s", trip["seferId"])
+            self.seat_counts[trip["seferId"]] = (counts, now)
+
+        changed_at = self.seat_counts[trip["seferId"]][1]
+        recently_changed = (
+            changed_at is not None and now - changed_at < self.count_change_window
+        )
+        vagon_types = {
+            vagon_type
+            for vagon_type, count in counts.items()
+            if count > 0 or recently_changed
+        }
+        if self.passenger.seat_type:
+            vagon_types &= {self.passenger.seat_type}
+        return vagon_types
 
     async def get_trip_empty_seat_count(self, trip):
         """Get the empty seat count for the given trip."""
@@ -205,11 +706,7 @@ def list_stations():
     """List all the stations that support high-speed train."""
     logger.info("Listing stations")
     try:
-        stations_json = TripSearchApi.get_station_list()
-        stations = []
-        for station in stations_json:
-            stations.append(station["station_name"])
-        return stations
+        return station_registry.names()
     except requests.exceptions.HTTPError as e:
         logger.error("Error while listing stations: %s", e)
         raise
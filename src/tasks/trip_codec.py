@@ -0,0 +1,252 @@
+"""Compact, versioned serialization of Trip objects.
+
+Trips are passed to the celery tasks, returned through the result backend and
+stored in the route watches. Pickling them carried the whole seferSorgula
+summary, every empty seat found and the passenger's card data. The codec keeps
+only the search parameters and settings, the ids the seat lock and the payment
+need, the segment of the trip and the lock state, and encodes them with msgpack:
+
+    [version, {field: value, ...}]
+
+Passengers are stored without their card data, the bot sets the full passenger
+again before the payment. The search state rebuilt on every search, like
+seat_counts, is not preserved. Pickled payloads of an older version are still
+decoded, so tasks queued before an upgrade keep working.
+
+Run the module to compare the payload size and speed with pickle:
+
+    python -m tasks.trip_codec
+"""
+
+import logging
+import pickle
+from datetime import datetime
+
+import msgpack
+
+from passenger import Passenger
+from tasks.trip import Trip
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 1
+
+# the keys of trip_json, empty_seat_json and the klSec seats that are kept
+TRIP_KEYS = (
+    "seferId",
+    "binisIstasyonId",
+    "inisIstasyonId",
+    "binisTarih",
+    "inisTarih",
+    "trenTuruTktId",
+    "binisIstasyonu",
+    "inisIstasyonu",
+    "detour",
+)
+SEAT_KEYS = ("vagonSiraNo", "koltukNo", "vagonTipId")
+# the Trip attributes tuning the search and the seat lock, the payloads encoded
+# by older versions lack some of them and decode with the defaults of Trip
+SETTINGS = (
+    "days",
+    "expand_stations",
+    "max_station_pairs",
+    "poll_interval",
+    "poll_budget",
+    "count_change_window",
+    "departure_cutoff",
+    "failed_seat_ttl",
+    "lock_race_size",
+    "fast_lock",
+)
+LOCK_KEYS = ("koltukLockId", "vagonSiraNo", "koltukNo", "bitisZamani")
+PASSENGER_FIELDS = (
+    "tckn",
+    "name",
+    "surname",
+    "birthday",
+    "email",
+    "phone",
+    "sex",
+    "tariff",
+    "seat_type",
+)
+
+# first byte of a pickle of protocol 2 or higher, msgpack arrays never start with it
+PICKLE_PROTOCOL_OPCODE = b"\x80"
+
+
+def _pick(data, keys):
+    if data is None:
+        return None
+    return {key: data[key] for key in keys if key in data}
+
+
+def encode_trip(trip: Trip) -> bytes:
+    """Encode the trip and its reservation state."""
+    passenger = trip.passenger
+    lock_response = None
+    if trip.seat_lock_response is not None:
+        lock_response = {
+            "cevapBilgileri": trip.seat_lock_response.get("cevapBilgileri"),
+            "koltuklarimListesi": [
+                _pick(seat, LOCK_KEYS)
+                for seat in trip.seat_lock_response.get("koltuklarimListesi") or []
+            ],
+        }
+    fields = {
+        "from": trip.from_station,
+        "to": trip.to_station,
+        "from_date": trip.from_date,
+        "to_date": trip.to_date,
+        **{name: getattr(trip, name) for name in SETTINGS},
+        "passenger": (
+            [getattr(passenger, f) for f in PASSENGER_FIELDS] if passenger else None
+        ),
+        "trip": _pick(trip.trip_json, TRIP_KEYS),
+        "seat": _pick(trip.empty_seat_json, SEAT_KEYS),
+        "lock": lock_response,
+        "lock_end": (
+            trip.lock_end_time.timestamp() if trip.lock_end_time else None
+        ),
+    }
+    return msgpack.packb([SCHEMA_VERSION, fields], use_bin_type=True)
+
+
+def decode_trip(payload: bytes, passenger: Passenger = None) -> Trip:
+    """
+    Decode a trip encoded by encode_trip.
+
+    Args:
+        payload (bytes): The encoded trip, or a pickled Trip of an older version.
+        passenger (Passenger, optional): Replaces the stored passenger, which
+            lacks the card data.
+
+    Raises:
+        ValueError: If the payload has an unknown schema version.
+
+    Returns:
+        Trip: The decoded trip.
+    """
+    if payload[:1] == PICKLE_PROTOCOL_OPCODE:
+        logger.info("Decoding a pickled trip.")
+        trip = pickle.loads(payload)
+    else:
+        version, fields = msgpack.unpackb(payload, raw=False)
+        if version != SCHEMA_VERSION:
+            raise ValueError(f"Unknown trip schema version: {version}")
+        trip = Trip(fields["from"], fields["to"], fields["from_date"])
+        trip.to_date = fields["to_date"]
+        for name in SETTINGS:
+            if name in fields:
+                setattr(trip, name, fields[name])
+        if fields["passenger"] is not None:
+            trip.passenger = Passenger(
+                **dict(zip(PASSENGER_FIELDS, fields["passenger"]))
+            )
+        trip.trip_json = fields["trip"]
+        trip.empty_seat_json = fields["seat"]
+        trip.seat_lock_response = fields["lock"]
+        if fields["lock_end"]:
+            trip.lock_end_time = datetime.fromtimestamp(fields["lock_end"])
+        if trip.seat_lock_response:
+            trip.koltuk_lock_id_list = [
+                seat["koltukLockId"]
+                for seat in trip.seat_lock_response["koltuklarimListesi"]
+            ]
+    if passenger is not None:
+        trip.passenger = passenger
+    return trip
+
+
+def benchmark(rounds=10000):
+    """Print the payload size, encode and decode times of pickle and the codec."""
+    # pylint: disable=import-outside-toplevel
+    import timeit
+    from functools import partial
+
+    seat = {
+        "koltukNo": "12A",
+        "vagonSiraNo": 3,
+        "vagonTipId": 17002,
+        "durum": 0,
+        "nesneTanimId": 11750000009,
+        "nesneTipId": 1,
+        "koltukBilgi": "Koltuk",
+        "yon": "ileri",
+        "x": 4,
+        "y": 12,
+    }
+    trip_json = {
+        "seferId": 123456789,
+        "binisIstasyonId": 98,
+        "inisIstasyonId": 48,
+        "binisTarih": "Oct 20, 2026 06:00:00 AM",
+        "inisTarih": "Oct 20, 2026 10:15:00 AM",
+        "trenAdi": "YHT 81004",
+        "seferAdi": "ANKARA GAR - İSTANBUL(SÖĞÜTLÜÇEŞME)",
+        "trenTuruTktId": 1,
+        "seyahatTuru": 1,
+        "eco_empty_seat_count": 42,
+        "buss_empty_seat_count": 3,
+        "empty_seat_count": 45,
+        "vagon_type_counts": {17002: 42, 17001: 3},
+        "vagons": [
+            {"vagonBaslikId": 1000 + i, "vagonSiraNo": i, "vagonTipId": 17002}
+            for i in range(1, 9)
+        ],
+        "empty_seats": [dict(seat, koltukNo=f"{i}A") for i in range(40)],
+    }
+    trip = Trip(
+        "Ankara Gar",
+        "İstanbul(Söğütlüçeşme)",
+        "Oct 20, 2026 05:00:00 AM",
+        passenger=Passenger(
+            tckn="12345678901",
+            name="Ad",
+            surname="Soyad",
+            birthday="01/01/1990",
+            email="ad@example.com",
+            phone="05000000000",
+            sex="E",
+            credit_card_no="4111111111111111",
+            credit_card_ccv="123",
+            credit_card_exp="1230",
+            seat_type=17002,
+        ),
+        to_date="Oct 20, 2026 09:00:00 PM",
+    )
+    trip.set_lock_state(
+        trip_json,
+        seat,
+        "Oct 20, 2026 05:10:00 AM",
+        {
+            "cevapBilgileri": {"cevapKodu": "000", "cevapMsj": "BAŞARILI"},
+            "koltuklarimListesi": [
+                {
+                    "koltukLockId": 555,
+                    "vagonSiraNo": 3,
+                    "koltukNo": "12A",
+                    "bitisZamani": "Oct 20, 2026 05:10:00 AM",
+                    "seferBaslikId": 123456789,
+                    "binisIst": 98,
+                    "inisIst": 48,
+                }
+            ],
+        },
+    )
+
+    for name, encode, decode in (
+        ("pickle", pickle.dumps, pickle.loads),
+        ("msgpack", encode_trip, decode_trip),
+    ):
+        payload = encode(trip)
+        encode_time = timeit.timeit(partial(encode, trip), number=rounds) / rounds
+        decode_time = timeit.timeit(partial(decode, payload), number=rounds) / rounds
+        print(
+            f"{name:8} {len(payload):6} bytes  "
+            f"encode {encode_time * 1e6:7.1f} us  decode {decode_time * 1e6:7.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    benchmark()
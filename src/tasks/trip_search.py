@@ -1,18 +1,29 @@
-""" This module contains the functions for searching for trips and selecting empty seats."""
+""" This module contains the functions for searching for trips and selecting empty
+seats.
+
+Every request method has an async counterpart (asearch_trips, afetch_station_list,
+ais_mernis_correct, lock_seat for select_first_empty_seat) running on the async
+session of the shared http client, so a search never blocks its event loop. The
+blocking versions are kept for the callers without an event loop.
+"""
 
 import asyncio
-import json
-import random
-import aiohttp
+import copy
 import logging
-from datetime import datetime, timedelta
 import time
-import requests
+from datetime import datetime, timedelta
+
+import aiohttp
 import dateparser
 from requests.exceptions import RequestException
+
 import api_constants
 from _utils import find_value
 from passenger import Passenger
+from tasks.http_client import get_client
+from tasks.metrics import metrics
+from tasks.retry_policy import TcddApiError
+from tasks.station_registry import StationRegistry
 
 logger = logging.getLogger(__name__)
 
@@ -26,6 +37,50 @@ class SeatLockedException(Exception):
         super().__init__(self.message)
 
 
+async def gather_until_set(aws, event: asyncio.Event = None):
+    """
+    Run the awaitables concurrently until all of them finish or the event is set.
+
+    Args:
+        aws (list): The awaitables to run.
+        event (asyncio.Event, optional): Cancels the unfinished awaitables when set.
+
+    Returns:
+        list: The results of the awaitables that finished, in the given order.
+    """
+    tasks = [asyncio.ensure_future(aw) for aw in aws]
+    if not tasks:
+        return []
+    waiter = asyncio.ensure_future(event.wait()) if event else None
+    try:
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending | {waiter} if waiter else pending,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if waiter in done:
+                logger.info("Event is set. Cancelling %s pending tasks.", len(pending))
+                break
+            pending.discard(waiter)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if waiter:
+            waiter.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    results = []
+    for task in tasks:
+        if task.cancelled():
+            continue
+        if task.exception():
+            logger.error("Task failed: %s", task.exception())
+            continue
+        results.append(task.result())
+    return results
+
+
 class TripSearchApi:
     """Class for searching for trips and selecting empty seats."""
 
@@ -102,88 +157,202 @@ class TripSearchApi:
         return active_vagons
 
     @staticmethod
-    def select_first_empty_seat(trip, empty_seat=None):
+    def seat_lock_requests(trip, empty_seat):
         """
-        Selects the first empty seat for a given trip.
+        Builds the request bodies for checking and locking the given seat.
 
         Args:
             trip (dict): The trip information. trip_json
+            empty_seat (dict): The seat to lock.
 
         Returns:
-            dict: The response JSON containing the selected seat information
-            if the response code is 200.
-        """
-        retries = 0
-        max_retries = 3
-        sleep = 3
-        timeout = 10
-        # Select the first empty seat
-        seat_select_req = api_constants.koltuk_sec_req_body.copy()
+            tuple: The seat check (klCheck) and the seat select (klSec) request bodies.
+        """
         s_check = api_constants.seat_check.copy()
-        if trip.get("empty_seats"):
-            empty_seat = trip["empty_seats"][0] if empty_seat is None else empty_seat
+        s_check["seferId"] = trip["seferId"]
+        s_check["seciliVagonSiraNo"] = empty_seat["vagonSiraNo"]
+        s_check["koltukNo"] = empty_seat["koltukNo"]
 
-            seat_select_req["seferId"] = trip["seferId"]
-            seat_select_req["vagonSiraNo"] = empty_seat["vagonSiraNo"]
-            seat_select_req["koltukNo"] = empty_seat["koltukNo"]
-            seat_select_req["binisIst"] = trip["binisIstasyonId"]
-            seat_select_req["inisIst"] = trip["inisIstasyonId"]
-            s_check["seferId"] = trip["seferId"]
-            s_check["seciliVagonSiraNo"] = empty_seat["vagonSiraNo"]
-            s_check["koltukNo"] = empty_seat["koltukNo"]
+        seat_select_req = api_constants.koltuk_sec_req_body.copy()
+        seat_select_req["seferId"] = trip["seferId"]
+        seat_select_req["vagonSiraNo"] = empty_seat["vagonSiraNo"]
+        seat_select_req["koltukNo"] = empty_seat["koltukNo"]
+        seat_select_req["binisIst"] = trip["binisIstasyonId"]
+        seat_select_req["inisIst"] = trip["inisIstasyonId"]
+        return s_check, seat_select_req
 
-            # for test purposes throw connectiontimeout exception
+    @staticmethod
+    def seat_lock_end_time(response_json, empty_seat):
+        """
+        Returns the lock end time of the seat from a klSec response.
 
-            while retries < max_retries:
-                try:
-                    s_response = requests.post(
-                        api_constants.SEAT_CHECK_ENDPOINT,
-                        headers=api_constants.REQUEST_HEADER,
-                        data=json.dumps(s_check),
-                        timeout=timeout,
+        Args:
+            response_json (dict): The klSec response JSON.
+            empty_seat (dict): The seat that is locked.
+
+        Returns:
+            str: The bitisZamani of the lock, None if the response does not confirm
+            that the seat is locked.
+        """
+        if response_json.get("cevapBilgileri", {}).get("cevapKodu") != "000":
+            return None
+        for seat in response_json.get("koltuklarimListesi") or []:
+            if seat.get("koltukNo", empty_seat["koltukNo"]) == empty_seat["koltukNo"]:
+                return seat.get("bitisZamani")
+        return None
+
+    @staticmethod
+    async def lock_seat(trip, empty_seat, fast=False):
+        """
+        Locks the given seat on the running event loop, async counterpart of
+        select_first_empty_seat.
+
+        In fast mode klSec is sent right away and the outcome is read from its
+        response, saving the klCheck round trip. A response code of
+        api_constants.SEAT_TAKEN_RESPONSE_CODES raises SeatLockedException and
+        any other definite non zero code raises TcddApiError. Only an unknown
+        outcome, a transient response code or a success without the lock in it,
+        falls back to the check first flow. Lock latencies are recorded per mode
+        in tasks.metrics as lock.fast and lock.check_first.
+
+        Args:
+            trip (dict): The trip information. trip_json
+            empty_seat (dict): The seat to lock.
+            fast (bool, optional): Whether to skip klCheck. Defaults to False.
+
+        Raises:
+            SeatLockedException: If the seat is already locked.
+            TcddApiError: If the server responds with a non zero response code.
+
+        Returns:
+            tuple: The lock end time, the locked seat and the klSec response JSON.
+        """
+        mode = "fast" if fast else "check_first"
+        start = time.monotonic()
+        client = get_client()
+        s_check, seat_select_req = TripSearchApi.seat_lock_requests(trip, empty_seat)
+
+        try:
+            end_time = None
+            if fast:
+                response_json = await client.apost(
+                    api_constants.SELECT_EMPTY_SEAT_ENDPOINT,
+                    seat_select_req,
+                    check=False,
+                )
+                code = response_json.get("cevapBilgileri", {}).get("cevapKodu")
+                if code in api_constants.SEAT_TAKEN_RESPONSE_CODES:
+                    raise SeatLockedException(empty_seat)
+                if code != "000" and code not in api_constants.RETRYABLE_RESPONSE_CODES:
+                    client.check_response(
+                        api_constants.SELECT_EMPTY_SEAT_ENDPOINT, response_json
+                    )
+                end_time = TripSearchApi.seat_lock_end_time(response_json, empty_seat)
+                if end_time is None:
+                    logger.info(
+                        "Unknown klSec outcome, checking the seat: %s", response_json
                     )
-                    s_response.raise_for_status()
-                    s_response_json = s_response.json()
+                    metrics.incr("lock.fast.fallback")
 
-                    if s_response_json["cevapBilgileri"]["cevapKodu"] != "000":
-                        logger.error("response_json: %s", s_response_json)
-                        raise ValueError(
-                            f"Non zero response code: s_response_json: {s_response_json}"
-                        )
+            if end_time is None:
+                s_response_json = await client.apost(
+                    api_constants.SEAT_CHECK_ENDPOINT, s_check
+                )
+                if s_response_json["koltukLocked"]:
+                    raise SeatLockedException(empty_seat)
 
-                    if not s_response_json["koltukLocked"]:
-                        response = requests.post(
-                            api_constants.SELECT_EMPTY_SEAT_ENDPOINT,
-                            headers=api_constants.REQUEST_HEADER,
-                            data=json.dumps(seat_select_req),
-                            timeout=timeout,
-                        )
+                response_json = await client.apost(
+                    api_constants.SELECT_EMPTY_SEAT_ENDPOINT, seat_select_req
+                )
+                end_time = response_json["koltuklarimListesi"][0]["bitisZamani"]
+        except (
+            SeatLockedException,
+            ValueError,
+            asyncio.TimeoutError,
+            aiohttp.ClientError,
+        ):
+            metrics.incr(f"lock.{mode}.failure")
+            raise
+
+        elapsed = time.monotonic() - start
+        metrics.observe(f"lock.{mode}", elapsed)
+        metrics.incr(f"lock.{mode}.success")
+        logger.info(
+            "Seat locked in %.3fs (%s): sefer: %s, vagon: %s, seat: %s",
+            elapsed,
+            mode,
+            trip["seferId"],
+            empty_seat["vagonSiraNo"],
+            empty_seat["koltukNo"],
+        )
+        return end_time, empty_seat, response_json
 
-                        response.raise_for_status()
-                        response_json = response.json()
+    @staticmethod
+    async def release_seat(trip, empty_seat, seat_lock_response):
+        """
+        Releases a seat locked by lock_seat.
 
-                        if response_json["cevapBilgileri"]["cevapKodu"] != "000":
-                            logger.error(
-                                "Non zero response code: response_json: %s",
-                                response_json,
-                            )
-                            raise ValueError(
-                                f"Non zero response code: response_json: {response_json}"
-                            )
-                        end_time = response_json["koltuklarimListesi"][0]["bitisZamani"]
-                        logger.info(
-                            "Breaking, Response status code: %s", response.status_code
-                        )
-                        break
-                    else:
-                        raise SeatLockedException(empty_seat)
-                except RequestException as e:
-                    logger.error("Request exception: %s", e)
-                    retries += 1
-                    logger.error("Retrying seat selection. Retry count: %s", retries)
-                    time.sleep(sleep)
+        Args:
+            trip (dict): The trip information. trip_json
+            empty_seat (dict): The locked seat.
+            seat_lock_response (dict): The klSec response of the lock.
 
-            return end_time, empty_seat, response_json
+        Returns:
+            bool: True if the seat is released.
+        """
+        release_req = api_constants.koltuk_birak_req_body.copy()
+        release_req["seferId"] = trip["seferId"]
+        release_req["vagonSiraNo"] = empty_seat["vagonSiraNo"]
+        release_req["koltukNo"] = empty_seat["koltukNo"]
+        release_req["koltukLockId"] = seat_lock_response["koltuklarimListesi"][0][
+            "koltukLockId"
+        ]
+        try:
+            response_json = await get_client().apost(
+                api_constants.RELEASE_SEAT_ENDPOINT, release_req, check=False
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.error("Error while releasing seat: %s", e)
+            return False
+        if response_json["cevapBilgileri"]["cevapKodu"] != "000":
+            logger.error("Non zero response code: response_json: %s", response_json)
+            return False
+        logger.info(
+            "Seat released: sefer: %s, vagon: %s, seat: %s",
+            trip["seferId"],
+            empty_seat["vagonSiraNo"],
+            empty_seat["koltukNo"],
+        )
+        return True
+
+    @staticmethod
+    def select_first_empty_seat(trip, empty_seat=None):
+        """
+        Selects the first empty seat for a given trip, blocking counterpart of
+        lock_seat for the callers without an event loop.
+
+        Args:
+            trip (dict): The trip information. trip_json
+            empty_seat (dict, optional): The seat to lock. Defaults to the first
+                of the trip's empty_seats.
+
+        Raises:
+            SeatLockedException: If the seat is already locked.
+            TcddApiError: If the server responds with a non zero response code.
+            aiohttp.ClientError: If the requests fail after the retries.
+
+        Returns:
+            tuple: The lock end time, the locked seat and the klSec response JSON,
+            None if the trip has no empty seats.
+        """
+        # imported here, tasks.worker_loop imports this module
+        from tasks import worker_loop  # pylint: disable=import-outside-toplevel
+
+        if empty_seat is None:
+            if not trip.get("empty_seats"):
+                return None
+            empty_seat = trip["empty_seats"][0]
+        return worker_loop.run(TripSearchApi.lock_seat(trip, empty_seat))
 
     @staticmethod
     async def get_detailed_vagon_info_empty_seats(
@@ -198,53 +367,18 @@ class TripSearchApi:
         Returns:
             list: The list of dictionaries containing the empty seat information.
         """
-        retries = 0
-        max_retries = 1
-        sleep = 3
-        timeout = 3
-
         empty_seats = list()
         response_json = None
 
-        while retries < max_retries:
-            if event and event.is_set():
-                logger.info(
-                    "**************************Event is set. Exiting.**************************************"
-                )
-                break
-            sleep_ = random.randint(int(sleep / 3), sleep)
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        api_constants.VAGON_HARITA_ENDPOINT,
-                        headers=api_constants.REQUEST_HEADER,
-                        data=json.dumps(vagon_map_req),
-                        timeout=timeout,
-                    ) as resp:
-                        # resp.raise_for_status()
-                        response_json = await resp.json()
-                        logger.info("Breaking, Response status code: %s", resp.status)
-                    break
-            # except timeout error
-            except asyncio.TimeoutError as e:
-                logger.error("Timeout error while getting vagon map: %s", e)
-                retries += 1
-                logger.error(
-                    "Sleeping: %s before Retrying vagon map. Retry count: %s",
-                    sleep_,
-                    retries,
-                )
-                await asyncio.sleep(sleep_)
-            except aiohttp.ClientError as e:
-                logger.error("Error while getting vagon map: %s", e)
-                retries += 1
-                # random number between 0 and 30
-                logger.error(
-                    "Sleeping: %s before Retrying vagon map. Retry count: %s",
-                    sleep_,
-                    retries,
-                )
-                await asyncio.sleep(sleep_)
+        if event and event.is_set():
+            logger.info("Event is set. Skipping vagon map.")
+            return empty_seats
+        try:
+            response_json = await get_client().apost(
+                api_constants.VAGON_HARITA_ENDPOINT, vagon_map_req, cache=True
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+            logger.error("Error while getting vagon map: %s", e)
 
         if response_json:
             for empty_seat in TripSearchApi.get_empty_vagon_seats(response_json):
@@ -262,15 +396,77 @@ class TripSearchApi:
         )
         return empty_seats
 
+    @staticmethod
+    async def get_vagon_empty_seat_counts(trip):
+        """
+        Retrieves the number of empty seats of every vagon of a trip with a single
+        request, which is much cheaper than fetching the vagon maps.
+
+        Args:
+            trip (dict): The trip returned by search_trips.
+
+        Returns:
+            dict: vagonSiraNo -> empty seat count, or None if the counts could not
+            be retrieved or the response lists none.
+        """
+        vagon_req = api_constants.vagon_req_body.copy()
+        vagon_req["seferBaslikId"] = trip["seferId"]
+        vagon_req["binisIstId"] = trip["binisIstasyonId"]
+        vagon_req["inisIstId"] = trip["inisIstasyonId"]
+        try:
+            response_json = await get_client().apost(
+                api_constants.VAGON_SEARCH_ENDPOINT, vagon_req, check=False
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+            logger.error("Error while getting vagon empty seat counts: %s", e)
+            return None
+
+        if response_json.get("cevapBilgileri", {}).get("cevapKodu") != "000":
+            logger.error("Non zero response code: response_json: %s", response_json)
+            return None
+        counts = {
+            vagon.get("vagonSiraNo"): vagon.get("bosYer")
+            for vagon in response_json.get("vagonBosYerList") or []
+        }
+        counts = {
+            vagon: count
+            for vagon, count in counts.items()
+            if vagon is not None and isinstance(count, int)
+        }
+        if not counts:
+            # nothing to filter the vagons with, every vagon map is fetched
+            logger.warning("No usable vagon empty seat counts: %s", response_json)
+            return None
+        logger.info("sefer: %s, vagon empty seat counts: %s", trip["seferId"], counts)
+        return counts
+
     @staticmethod
     async def get_empty_seats_trip(
-        trip, from_station, to_station, seat_type=None, event: asyncio.Event = None
+        trip,
+        from_station,
+        to_station,
+        seat_type=None,
+        event: asyncio.Event = None,
+        vagon_types=None,
+        pre_check=True,
+        queue: asyncio.Queue = None,
     ):
         """
         Retrieves the empty seats for a given trip.
 
+        The vagon maps are fetched concurrently, limited by the per host limit of
+        the http client. Requests still in flight are cancelled once the event is set.
+        With pre_check, only the vagons that report empty seats in
+        get_vagon_empty_seat_counts are fetched, the fullest vagon first.
+
         Args:
             trip (dict): The trip object containing information about the trip.
+            vagon_types (set, optional): Only the vagons of these vagonTipIds are
+                fetched. Defaults to None, all vagon types.
+            pre_check (bool, optional): Whether to check the vagon empty seat counts
+                before fetching the vagon maps. Defaults to True.
+            queue (asyncio.Queue, optional): If given, a (trip, empty_seats) tuple is
+                put into the queue as soon as a vagon map with empty seats arrives.
 
         Returns:
             dict: The trip object with an additional 'empty_seats' field
@@ -279,21 +475,47 @@ class TripSearchApi:
         # clone trip object
 
         trip_with_seats = trip.copy()
-        vagon_map_req = api_constants.vagon_harita_req_body.copy()
         trip_with_seats["empty_seats"] = list()
 
+        vagons = []
         for vagon in trip["vagons"]:
-            vagon_map_req["vagonSiraNo"] = vagon["vagonSiraNo"]
-            vagon_map_req["seferBaslikId"] = trip_with_seats["seferId"]
-            vagon_map_req["binisIst"] = from_station
-            vagon_map_req["InisIst"] = to_station
             if seat_type is not None:
                 vagon_type = vagon["vagonTipId"]
                 if seat_type != vagon_type:
                     continue
+            if vagon_types is not None and vagon["vagonTipId"] not in vagon_types:
+                continue
+            vagons.append(vagon)
+
+        vagon_counts = None
+        if pre_check and vagons:
+            vagon_counts = await TripSearchApi.get_vagon_empty_seat_counts(trip)
+        if vagon_counts is not None:
+            vagons = [v for v in vagons if vagon_counts.get(v["vagonSiraNo"], 0) > 0]
+            vagons.sort(key=lambda v: vagon_counts[v["vagonSiraNo"]], reverse=True)
+
+        vagon_map_reqs = []
+        for vagon in vagons:
+            vagon_map_req = api_constants.vagon_harita_req_body.copy()
+            vagon_map_req["vagonSiraNo"] = vagon["vagonSiraNo"]
+            vagon_map_req["seferBaslikId"] = trip_with_seats["seferId"]
+            vagon_map_req["binisIst"] = from_station
+            vagon_map_req["InisIst"] = to_station
+            vagon_map_reqs.append(vagon_map_req)
+
+        async def get_vagon_empty_seats(vagon_map_req):
             empty_seats = await TripSearchApi.get_detailed_vagon_info_empty_seats(
                 vagon_map_req, trip["vagons"], event=event
             )
+            if queue is not None and empty_seats:
+                queue.put_nowait((trip_with_seats, empty_seats))
+            return empty_seats
+
+        results = await gather_until_set(
+            [get_vagon_empty_seats(vagon_map_req) for vagon_map_req in vagon_map_reqs],
+            event,
+        )
+        for empty_seats in results:
             trip_with_seats["empty_seats"].extend(empty_seats)
 
         return trip_with_seats
@@ -336,97 +558,135 @@ class TripSearchApi:
         Args:
             from_station (str): The name of the departure station.
             to_station (str): The name of the destination station.
-            from_date (str, optional): The departure date in an human readable format.
-            to_date (str, optional): The maximum arrival date in an human readable format. Defaults to None.
-            check_satis_durum (bool, optional): Whether to check the sales status of the trip. Defaults to True.
-                if the trip has no available seats at all, it will be filtered out. For example, if the trip has
-                only disabled seats, it will be filtered out.
+            from_date (str, optional): The departure date in an human readable
+                format.
+            to_date (str, optional): The maximum arrival date in an human readable
+                format. Defaults to None.
+            check_satis_durum (bool, optional): Whether to check the sales status
+                of the trip. Defaults to True. If the trip has no available seats
+                at all, it will be filtered out. For example, if the trip has only
+                disabled seats, it will be filtered out.
 
         Returns:
-            list: A list of dictionaries representing the found trips. Each dictionary contains the following keys:
+            list: A list of dictionaries representing the found trips. Each
+            dictionary contains the following keys:
                 - 'vagons': A list of active vagon types.
-                - 'eco_empty_seat_count': The number of empty seats in the economy class.
-                - 'buss_empty_seat_count': The number of empty seats in the business class.
+                - 'eco_empty_seat_count': The number of empty seats in the economy
+                  class.
+                - 'buss_empty_seat_count': The number of empty seats in the business
+                  class.
                 - 'empty_seat_count': The total number of empty seats.
+                - 'vagon_type_counts': The number of empty seats per vagonTipId.
                 - 'binisTarih': The departure date and time.
                 - 'inisTarih': The arrival date and time.
                 - 'trenAdi': The name of the train.
                 - 'seferAdi': The name of the trip.
                 - 'seferId': The ID of the trip.
+                - 'satisDurum': 1 if the trip is on sale.
+                - 'binisIstasyonu': The name of the departure station.
+                - 'inisIstasyonu': The name of the destination station.
                 - 'binisIstasyonId': The ID of the departure station.
                 - 'inisIstasyonId': The ID of the destination station.
         """
-        # log the method parameters
-        retries = 0
-        max_retries = 10
-        sleep = 30
-        timeout = 10
+        trip_req = TripSearchApi.trip_search_request(
+            from_station, to_station, from_date
+        )
+        response_json = get_client().post(
+            api_constants.TRIP_SEARCH_ENDPOINT, trip_req, cache=True
+        )
+        return TripSearchApi.parse_trips(
+            response_json, trip_req, to_date, check_satis_durum
+        )
+
+    @staticmethod
+    async def asearch_trips(
+        from_station,
+        to_station,
+        from_date=None,
+        to_date=None,
+        check_satis_durum=True,
+        cache=True,
+        lane=None,
+    ):
+        """
+        Async counterpart of search_trips, see search_trips for the arguments.
+
+        Args:
+            cache (bool, optional): Whether to share the response through the
+                response cache. Defaults to True.
+            lane (str, optional): The request lane, see TcddClient.apost.
+
+        Raises:
+            TcddApiError: If the server responds with a non zero response code.
+            aiohttp.ClientError: If the request fails after the retries.
+        """
+        trip_req = TripSearchApi.trip_search_request(
+            from_station, to_station, from_date
+        )
+        response_json = await get_client().apost(
+            api_constants.TRIP_SEARCH_ENDPOINT, trip_req, cache=cache, lane=lane
+        )
+        return TripSearchApi.parse_trips(
+            response_json, trip_req, to_date, check_satis_durum
+        )
 
+    @staticmethod
+    def trip_search_request(from_station, to_station, from_date=None):
+        """
+        Builds the seferSorgula request body of a search.
+
+        Raises:
+            ValueError: If any of the stations is not valid.
+
+        Returns:
+            dict: The request body.
+        """
+        # log the method parameters
         logger.info(
-            "Searching for trips. from_station: %s to_station: %s from_date: %s to_date: %s",
+            "Searching for trips. from_station: %s to_station: %s from_date: %s",
             from_station,
             to_station,
             from_date,
-            to_date,
         )
 
         if not from_date:
             logger.info("from_date is not provided. Using the current date.")
             from_date = datetime.now().strftime(TripSearchApi.time_format)
 
-        vagon_req_body = api_constants.vagon_req_body.copy()
-        trip_req = api_constants.trip_search_req_body.copy()
-        trips = list()
+        # deep copy, concurrent searches must not share the nested criteria dict
+        trip_req = copy.deepcopy(api_constants.trip_search_req_body)
         from_date = dateparser.parse(from_date)
 
-        stations = TripSearchApi.get_station_list()
-        try:
-            TripSearchApi.check_stations(stations, from_station, to_station)
-        except ValueError as e:
-            logger.error(e)
-            raise e
-
-        # Find the station that matches from_station
-        for station in stations:
-            if station["station_name"] == from_station:
-                binis_istasyon_id = station["station_id"]
-                vagon_req_body["binisIstId"] = binis_istasyon_id
-                trip_req["seferSorgulamaKriterWSDVO"]["binisIstasyonu"] = from_station
-                trip_req["seferSorgulamaKriterWSDVO"][
-                    "binisIstasyonId"
-                ] = binis_istasyon_id
-            if station["station_name"] == to_station:
-                inis_istasyon_id = station["station_id"]
-                vagon_req_body["inisIstId"] = inis_istasyon_id
-                trip_req["seferSorgulamaKriterWSDVO"][
-                    "inisIstasyonId"
-                ] = inis_istasyon_id
-                trip_req["seferSorgulamaKriterWSDVO"]["inisIstasyonu"] = to_station
+        # raises ValueError if any of the stations is not valid
+        binis_istasyon_id = station_registry.station_id(from_station)
+        inis_istasyon_id = station_registry.station_id(to_station)
+
+        trip_req["seferSorgulamaKriterWSDVO"]["binisIstasyonu"] = from_station
+        trip_req["seferSorgulamaKriterWSDVO"]["binisIstasyonId"] = binis_istasyon_id
+        trip_req["seferSorgulamaKriterWSDVO"]["inisIstasyonu"] = to_station
+        trip_req["seferSorgulamaKriterWSDVO"]["inisIstasyonId"] = inis_istasyon_id
         # Set the date
         trip_req["seferSorgulamaKriterWSDVO"]["gidisTarih"] = datetime.strftime(
             from_date, TripSearchApi.time_format
         )
 
-        response = None
-        while retries < max_retries:
-            try:
-                response = requests.post(
-                    api_constants.TRIP_SEARCH_ENDPOINT,
-                    headers=api_constants.REQUEST_HEADER,
-                    data=json.dumps(trip_req),
-                    timeout=timeout,
-                )
-                response.raise_for_status()
-                logger.info("Breaking, Response status code: %s", response.status_code)
-                break
-            except RequestException as e:
-                logger.error("Error while searching for trips: %s", e)
-                retries += 1
-                logger.error("Retrying trip search. Retry count: %s", retries)
-                time.sleep(sleep)
+        return trip_req
+
+    @staticmethod
+    def parse_trips(response_json, trip_req, to_date=None, check_satis_durum=True):
+        """
+        Filters and summarizes the trips of a seferSorgula response.
 
-        response_json = response.json()
+        Args:
+            response_json (dict): The seferSorgula response JSON.
+            trip_req (dict): The request body of the search.
+            to_date (str, optional): See search_trips.
+            check_satis_durum (bool, optional): See search_trips.
 
+        Returns:
+            list: The trips, see search_trips.
+        """
+        trips = list()
         sorted_trips = sorted(
             response_json["seferSorgulamaSonucList"],
             key=lambda trip: datetime.strptime(
@@ -455,6 +715,7 @@ class TripSearchApi:
                 try:
                     t = {}
                     t["eco_empty_seat_count"], t["buss_empty_seat_count"] = 0, 0
+                    t["vagon_type_counts"] = {}
 
                     t["vagons"] = TripSearchApi.get_active_vagons(
                         trip["vagonTipleriBosYerUcret"]
@@ -468,6 +729,11 @@ class TripSearchApi:
                     #    file.write(str(trip))
 
                     for vagon_type in trip["vagonTipleriBosYerUcret"]:
+                        t["vagon_type_counts"][vagon_type["vagonTipId"]] = max(
+                            vagon_type["kalanSayi"]
+                            - vagon_type["kalanEngelliKoltukSayisi"],
+                            0,
+                        )
                         # 17002 is the vagonTipId for economy class
                         if vagon_type["vagonTipId"] == 17002:
                             t["eco_empty_seat_count"] = (
@@ -499,8 +765,15 @@ class TripSearchApi:
                     t["trenAdi"] = trip["trenAdi"]
                     t["seferAdi"] = trip["seferAdi"]
                     t["seferId"] = trip["seferId"]
+                    t["satisDurum"] = trip["satisDurum"]
                     t["trenTuruTktId"] = trip["trenTuruTktId"]
                     t["seyahatTuru"] = trip["seyahatTuru"]
+                    t["binisIstasyonu"] = trip_req["seferSorgulamaKriterWSDVO"][
+                        "binisIstasyonu"
+                    ]
+                    t["inisIstasyonu"] = trip_req["seferSorgulamaKriterWSDVO"][
+                        "inisIstasyonu"
+                    ]
                     t["binisIstasyonId"] = trip_req["seferSorgulamaKriterWSDVO"][
                         "binisIstasyonId"
                     ]
@@ -515,70 +788,124 @@ class TripSearchApi:
 
     @staticmethod
     def get_station_list():
+        """
+        Returns the cached list of high-speed train stations from the station registry.
+
+        Returns:
+            list: A list of dictionaries representing the stations.
+        """
+        return station_registry.stations()
+
+    @staticmethod
+    def fetch_station_list():
         """
         Retrieves the list of stations from the API endpoint and filters out the
         high-speed train stations.
 
         Returns:
-            str: JSON string representation of the filtered station list.
-            int: HTTP status code if the request fails.
+            list: The filtered station list, None if the request fails.
         """
-        retries = 0
-        max_retries = 10
-        sleep = 5
-        timeout = 10
-        hst_stations = list()
+        try:
+            data = get_client().post(
+                api_constants.STATION_LIST_ENDPOINT,
+                api_constants.STATION_LIST_REQUEST_BODY,
+            )
+        except (RequestException, ValueError) as e:
+            logger.error("Error while getting station list: %s", e)
+            return None
+        return TripSearchApi.parse_station_list(data)
 
-        while retries < max_retries:
-            try:
-                # Send the request to the endpoint
-                response = requests.post(
-                    api_constants.STATION_LIST_ENDPOINT,
-                    headers=api_constants.REQUEST_HEADER,
-                    data=api_constants.STATION_LIST_REQUEST_BODY,
-                    timeout=timeout,
-                )
+    @staticmethod
+    async def afetch_station_list():
+        """Async counterpart of fetch_station_list."""
+        try:
+            data = await get_client().apost(
+                api_constants.STATION_LIST_ENDPOINT,
+                api_constants.STATION_LIST_REQUEST_BODY,
+            )
+        except (asyncio.TimeoutError, aiohttp.ClientError, ValueError) as e:
+            logger.error("Error while getting station list: %s", e)
+            return None
+        return TripSearchApi.parse_station_list(data)
 
-                response.raise_for_status()
-                data = response.json()
-
-                for item in data["istasyonBilgileriList"]:
-                    if "YHT" in item["stationTrainTypes"]:
-                        station = {}
-                        station["station_name"] = find_value(item, "istasyonAdi")
-                        station["station_code"] = find_value(item, "istasyonKodu")
-                        station["station_id"] = find_value(item, "istasyonId")
-                        station["station_view_name"] = find_value(
-                            item, "stationViewName"
-                        )
-                        station["is_available"] = find_value(item, "istasyonDurumu")
-                        station["is_purchasable"] = find_value(
-                            item, "satisSorgudaGelsin"
-                        )
+    @staticmethod
+    def parse_station_list(data):
+        """
+        Filters the high-speed train stations out of a station list response.
 
-                        # Filter out the stations that are not available or not
-                        # purchasable
-                        if (
-                            station["is_available"] is True
-                            and station["is_purchasable"] is True
-                        ):
-                            hst_stations.append(station)
-                logger.info("Breaking, Response status code: %s", response.status_code)
-                return hst_stations
-
-            except RequestException as e:
-                logger.error("Error while getting station list: %s", e)
-                retries += 1
-                logger.error("Retrying station list. Retry count: %s", retries)
-                time.sleep(sleep)
+        Args:
+            data (dict): The station list response JSON.
+
+        Returns:
+            list: The available and purchasable YHT stations.
+        """
+        hst_stations = list()
+        for item in data["istasyonBilgileriList"]:
+            if "YHT" in item["stationTrainTypes"]:
+                station = {}
+                station["station_name"] = find_value(item, "istasyonAdi")
+                station["station_code"] = find_value(item, "istasyonKodu")
+                station["station_id"] = find_value(item, "istasyonId")
+                station["station_view_name"] = find_value(item, "stationViewName")
+                station["is_available"] = find_value(item, "istasyonDurumu")
+                station["is_purchasable"] = find_value(item, "satisSorgudaGelsin")
+
+                # Filter out the stations that are not available or not
+                # purchasable
+                if (
+                    station["is_available"] is True
+                    and station["is_purchasable"] is True
+                ):
+                    hst_stations.append(station)
+        return hst_stations
 
     @staticmethod
     def is_mernis_correct(passenger: Passenger, date_format: str = "%d/%m/%Y") -> bool:
-        """Mernis verification for the given passenger."""
-        retries = 0
-        max_retries = 10
-        sleep = 5
+        """Mernis verification for the given passenger.
 
+        Raises:
+            TcddApiError: If the verification fails, which is not retried.
+            requests.RequestException: If the request fails after the retries.
+        """
+        mernis_req_body = TripSearchApi.mernis_request(passenger, date_format)
+        try:
+            response_json = get_client().post(
+                api_constants.MERNIS_DOGRULAMA_ENDPOINT, mernis_req_body
+            )
+        except TcddApiError as e:
+            TripSearchApi.log_mernis_failure(e, mernis_req_body)
+            raise
+        logger.debug(response_json)
+
+        logger.info("Mernis verification succeeded.")
+        return True
+
+    @staticmethod
+    async def ais_mernis_correct(
+        passenger: Passenger, date_format: str = "%d/%m/%Y"
+    ) -> bool:
+        """Async counterpart of is_mernis_correct.
+
+        Raises:
+            TcddApiError: If the verification fails, which is not retried.
+            aiohttp.ClientError: If the request fails after the retries.
+        """
+        mernis_req_body = TripSearchApi.mernis_request(passenger, date_format)
+        try:
+            response_json = await get_client().apost(
+                api_constants.MERNIS_DOGRULAMA_ENDPOINT, mernis_req_body
+            )
+        except TcddApiError as e:
+            TripSearchApi.log_mernis_failure(e, mernis_req_body)
+            raise
+        logger.debug(response_json)
+
+        logger.info("Mernis verification succeeded.")
+        return True
+
+    @staticmethod
+    def mernis_request(passenger: Passenger, date_format: str = "%d/%m/%Y"):
+        """Builds the mernis verification request body of the passenger."""
         mernis_req_body = api_constants.mernis_dogrula_req_body.copy()
         date = datetime.strptime(passenger.birthday, date_format).strftime(
             TripSearchApi.time_format
@@ -588,38 +915,21 @@ class TripSearchApi:
         mernis_req_body["soyad"] = passenger.surname
         mernis_req_body["tckn"] = passenger.tckn
         mernis_req_body["dogumTar"] = date
+        return mernis_req_body
 
-        while retries < max_retries:
-            try:
-                response = requests.post(
-                    api_constants.MERNIS_DOGRULAMA_ENDPOINT,
-                    headers=api_constants.REQUEST_HEADER,
-                    data=json.dumps(mernis_req_body),
-                    timeout=30,
-                )
-                response.raise_for_status()
-                response_json = response.json()
-                logger.debug(response_json)
+    @staticmethod
+    def log_mernis_failure(error: TcddApiError, mernis_req_body):
+        """Logs a failed mernis verification."""
+        logger.error(
+            "Mernis verification failed. response_json: %s", error.response_json
+        )
+        logger.error(
+            "Passenger: %s %s TCKN: %s Birthday: %s",
+            mernis_req_body["ad"],
+            mernis_req_body["soyad"],
+            mernis_req_body["tckn"],
+            mernis_req_body["dogumTar"],
+        )
 
-                if response_json["cevapBilgileri"]["cevapKodu"] != "000":
-                    logger.error(
-                        "Mernis verification failed. response_json: %s", response_json
-                    )
-                    logger.error(
-                        "Passenger: %s %s TCKN: %s Birthday: %s",
-                        passenger.name,
-                        passenger.surname,
-                        passenger.tckn,
-                        date,
-                    )
-                    raise ValueError(response_json["cevapBilgileri"]["cevapMsj"])
-                logger.info("Breaking, Response status code: %s", response.status_code)
-                break
-            except (requests.RequestException, ValueError) as e:
-                retries += 1
-                logger.error("Error while verifying mernis: %s", e)
-                logger.error("Retrying mernis verification. Retry count: %s", retries)
-                time.sleep(sleep)
 
-        logger.info("Mernis verification succeeded.")
-        return True
+station_registry = StationRegistry(fetch=TripSearchApi.fetch_station_list)
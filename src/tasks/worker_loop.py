@@ -0,0 +1,101 @@
+"""Long lived event loop and warm resources of a celery worker process.
+
+Running every task with asyncio.run created a new event loop, and with it a new
+aiohttp session, for every invocation and every retry, so the first requests of
+a retried search paid the DNS lookups and TCP+TLS handshakes again. Instead
+every worker process creates a single event loop when it starts (see the
+worker_process_init handler in tasks.celery_tasks) and runs the coroutines of
+all of its tasks on it. The http client, the station registry and the Redis
+pool are warmed up at the same time, so the first poll of a task reuses open
+connections. The first poll latency is recorded as search.first_poll in
+tasks.metrics.
+"""
+
+import asyncio
+import logging
+
+import redis
+
+from tasks.http_client import get_client
+from tasks.redis_pool import redis_client
+from tasks.trip_search import TripSearchApi, station_registry
+
+logger = logging.getLogger(__name__)
+
+_loop = None
+# tasks started by spawn, see run
+_background = set()
+
+
+def get_loop():
+    """Return the event loop of the process, creating it if there is none."""
+    global _loop  # pylint: disable=global-statement
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
+def spawn(coro):
+    """
+    Run the coroutine in the background of the running event loop.
+
+    The background tasks, like the release of the extra seat locks of a lock
+    race, are finished by run before it returns, so they are not left suspended
+    on the idle loop of the worker.
+
+    Returns:
+        asyncio.Task: The background task.
+    """
+    task = asyncio.ensure_future(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+    return task
+
+
+def run(coro):
+    """Run the coroutine to completion on the event loop of the process."""
+    loop = get_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        if _background:
+            loop.run_until_complete(
+                asyncio.gather(*_background, return_exceptions=True)
+            )
+
+
+async def warm_up():
+    """Open the Redis and http connections and load the station registry."""
+    try:
+        redis_client.ping()
+    except redis.exceptions.RedisError as e:
+        logger.error("Redis is unreachable: %s", e)
+
+    # opens the async session and a connection to the api host, the response
+    # refreshes the station registry on the way
+    stations = await TripSearchApi.afetch_station_list()
+    if stations:
+        station_registry.refresh(stations)
+    else:
+        station_registry.stations()
+
+
+def init_worker_process(**_):
+    """worker_process_init handler, creates the loop and warms up the resources."""
+    try:
+        run(warm_up())
+        logger.info("Worker process is warmed up.")
+    except Exception as e:  # pylint: disable=broad-except
+        # the resources are created lazily by the first task instead
+        logger.error("Error while warming up the worker process: %s", e)
+
+
+def shutdown_worker_process(**_):
+    """worker_process_shutdown handler, closes the async session and the loop."""
+    if _loop is None or _loop.is_closed():
+        return
+    try:
+        run(get_client().aclose())
+    finally:
+        _loop.close()
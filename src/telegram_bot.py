@@ -1,12 +1,14 @@
 """ Telegram bot functions. """
 
 import asyncio
+import calendar
 import logging
-import pickle
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from uuid import uuid4
 
+import aiohttp
+import dateparser
 import regex
 import requests
 from celery.result import AsyncResult
@@ -24,13 +26,19 @@ from passenger import Passenger, Seat, Tariff
 from payment import Payment
 from tasks.celery_tasks import (
     celery_app,
-    find_trip_and_reserve,
-    keep_reserving_seat,
+    ensure_route_poller,
     redis_client,
     run_indefinete_task,
+    snipe_trip,
     available_workers,
+    watch_trip,
 )
+from tasks.cancellation import cancellation
+from tasks.lock_keeper import lock_keeper
+from tasks.route_watch import route_key, route_watch
+from tasks.sales_sniper import parse_opens_at
 from tasks.trip import Trip
+from tasks.trip_codec import decode_trip, encode_trip
 from tasks.trip_search import TripSearchApi
 from constants import *  # pylint: disable=wildcard-import, unused-wildcard-import
 
@@ -414,7 +422,7 @@ async def res(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("my_trip: from_date: %s,", my_trip.from_date)
     context.user_data[TRIP] = my_trip
 
-    trips = my_trip.get_trips(check_satis_durum=False)
+    trips = await my_trip.aget_trips(check_satis_durum=False)
     inline_keyboard = []
 
     try:
@@ -466,12 +474,226 @@ async def handle_datetime_type(
     return context.user_data.get(CURRENT_STATE, END)
 
 
+# commas separate the days, except the one before the year of "Oct 20, 2026"
+DAY_SEPARATOR = r"\s*[,;](?!\s*\d{4}\b)\s*"
+# a dash or "to" between spaces, or a dash between names as in Mon-Fri, never
+# the dashes of an ISO date
+RANGE_SEPARATOR = r"\s+(?:-|–|to)\s+|(?<=\p{L})\s*[-–]\s*(?=\p{L})"
+WEEKDAYS = {
+    name.lower(): weekday
+    for names in (calendar.day_name, calendar.day_abbr)
+    for weekday, name in enumerate(names)
+}
+
+
+def parse_date(text):
+    """Parse a single date of /days, raise ValueError if it is not one."""
+    parsed = None if text.lower() in WEEKDAYS else dateparser.parse(text)
+    if parsed is None:
+        raise ValueError(f"{text!r} is not a date")
+    return parsed.date()
+
+
+def parse_days(text, first_day, last_day):
+    """
+    Parse the argument of /days into the dates to search on.
+
+    Args:
+        text (str): Comma separated dates, ranges of dates or ranges of weekdays,
+            e.g. "Oct 20, Oct 22 - Oct 24" or "Mon - Fri".
+        first_day (date): The first date the weekdays are looked up from.
+        last_day (date): The last date the weekdays are looked up until.
+
+    Raises:
+        ValueError: If a day can not be read or a range ends before it starts.
+
+    Returns:
+        list: The dates, in date order.
+    """
+    dates = set()
+    for item in regex.split(DAY_SEPARATOR, text.strip()):
+        bounds = regex.split(RANGE_SEPARATOR, item, flags=regex.IGNORECASE)
+        if not item or len(bounds) > 2:
+            raise ValueError(f"{item!r} is not a day or a range of days")
+        first, last = bounds[0].lower(), bounds[-1].lower()
+        if first in WEEKDAYS and last in WEEKDAYS:
+            span = (WEEKDAYS[last] - WEEKDAYS[first]) % 7
+            weekdays = {(WEEKDAYS[first] + i) % 7 for i in range(span + 1)}
+            day = first_day
+            while day <= last_day:
+                if day.weekday() in weekdays:
+                    dates.add(day)
+                day += timedelta(days=1)
+            continue
+        day, end = parse_date(bounds[0]), parse_date(bounds[-1])
+        if end < day:
+            raise ValueError(f"{item!r} ends before it starts")
+        while day <= end:
+            dates.add(day)
+            day += timedelta(days=1)
+    return sorted(dates)
+
+
+async def days(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Search the configured trip on the given days, between the times of day of its
+    dates, e.g. /days Oct 20, Oct 22 - Oct 24 or /days Mon - Fri, see parse_days.
+    Without days every day from the from date to the to date is searched.
+    """
+    trip = context.user_data.get(TRIP)
+    if trip is None:
+        await update.message.reply_text("Search for a trip with /res first.")
+        return context.user_data.get(CURRENT_STATE, END)
+
+    arg_string = update.message.text.partition(" ")[2].strip()
+    start = (
+        dateparser.parse(trip.from_date)
+        if trip.from_date
+        else trip.departure_deadline()
+    )
+    end = dateparser.parse(trip.to_date) if trip.to_date else None
+    # weekdays are looked up in the week of the from date without a to date
+    last_day = end.date() if end else start.date() + timedelta(days=6)
+    try:
+        parsed = parse_days(arg_string, start.date(), last_day) if arg_string else []
+        if arg_string and not parsed:
+            raise ValueError(f"no day of {arg_string!r} is in the search")
+    except ValueError as e:
+        logger.info("Could not read the days: %s", e)
+        await update.message.reply_text(f"Could not read the days.\n{DAYS_USAGE}")
+        return context.user_data.get(CURRENT_STATE, END)
+
+    trip.days = [datetime.strftime(day, "%b %d, %Y") for day in parsed] or None
+    logger.info("my_trip: days: %s", trip.days)
+    if trip.days:
+        text = f"Searching on *{', '.join(trip.days)}*."
+    else:
+        text = f"Searching every day from *{trip.from_date}* to *{trip.to_date}*."
+    await update.message.reply_text(text, parse_mode="Markdown")
+    return context.user_data.get(CURRENT_STATE, END)
+
+
+async def expand(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Toggle searching the configured trip on the segments around it too, boarding
+    earlier or alighting later on the same line.
+    """
+    trip = context.user_data.get(TRIP)
+    if trip is None:
+        await update.message.reply_text("Search for a trip with /res first.")
+        return context.user_data.get(CURRENT_STATE, END)
+
+    trip.expand_stations = not trip.expand_stations
+    logger.info("my_trip: expand_stations: %s", trip.expand_stations)
+    if not trip.expand_stations:
+        await update.message.reply_text("Searching your stations only.")
+        return context.user_data.get(CURRENT_STATE, END)
+
+    pairs = trip.station_pairs()[1:]
+    if not pairs:
+        text = "No other segments found around your stations."
+    else:
+        text = "Also searching, by detour:\n" + "\n".join(
+            f"  {from_} - {to_} ({cost})" for from_, to_, cost in pairs
+        )
+    await update.message.reply_text(text)
+    return context.user_data.get(CURRENT_STATE, END)
+
+
+async def fastlock(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Toggle locking the seats of the configured trip with klSec only, skipping the
+    klCheck round trip unless the klSec outcome is unknown.
+    """
+    trip = context.user_data.get(TRIP)
+    if trip is None:
+        await update.message.reply_text("Search for a trip with /res first.")
+        return context.user_data.get(CURRENT_STATE, END)
+
+    trip.fast_lock = not trip.fast_lock
+    logger.info("my_trip: fast_lock: %s", trip.fast_lock)
+    if trip.fast_lock:
+        text = "Locking seats without checking them first."
+    else:
+        text = "Checking seats before locking them."
+    await update.message.reply_text(text)
+    return context.user_data.get(CURRENT_STATE, END)
+
+
+async def snipe(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """
+    Lock a seat of the trips of the configured search that are not on sale yet,
+    as soon as their sales open. The optional argument is the time the sales are
+    expected to open at, e.g. /snipe Oct 20 00:00
+    """
+    trip = context.user_data.get(TRIP)
+    if trip is None or not trip.to_date:
+        await update.message.reply_text(
+            "Search for a trip with /res and select a date first."
+        )
+        return context.user_data.get(CURRENT_STATE, END)
+    if trip.is_expired():
+        await update.message.reply_text(
+            "Every trip of your search has departed. Please search again."
+        )
+        return context.user_data.get(CURRENT_STATE, END)
+    if context.user_data.get("task_id") and await get_user_task(
+        context.user_data["task_id"]
+    ):
+        await update.message.reply_text("You already have a task in progress.")
+        return context.user_data.get(CURRENT_STATE, END)
+
+    opens_at = " ".join(context.args) or None
+    if opens_at:
+        try:
+            parse_opens_at(opens_at)
+        except ValueError as e:
+            await update.message.reply_text(f"{e}")
+            return context.user_data.get(CURRENT_STATE, END)
+
+    trips = await trip.asearch_windows(check_satis_durum=False)
+    sefer_ids = [t["seferId"] for t in trips if t["satisDurum"] != 1]
+    if not sefer_ids:
+        await update.message.reply_text(
+            "The trips are on sale already, start a search from the search menu."
+        )
+        return context.user_data.get(CURRENT_STATE, END)
+
+    await set_passenger(update, context)
+    trip.reset_reservation_data()
+    task = snipe_trip.delay(encode_trip(trip), sefer_ids, opens_at)
+    logger.info("SETTING TASK_ID: %s", task.id)
+    context.user_data["task_id"] = task.id
+    context.job_queue.run_repeating(
+        check_snipe_status,
+        first=30,
+        interval=30,
+        data=context.user_data,
+        chat_id=update.message.chat_id,
+        job_kwargs={"misfire_grace_time": 60},
+    )
+    await update.message.reply_text(
+        f"Watching *{len(sefer_ids)}* trips until their sales open"
+        + (f" at *{opens_at}*." if opens_at else "."),
+        parse_mode="Markdown",
+    )
+    return context.user_data.get(CURRENT_STATE, END)
+
+
 async def start_search(context: ContextTypes.DEFAULT_TYPE) -> int:
     """Callback for the reservation process."""
     user_data = context.job.data
     task_id = user_data.get("task_id")
     trip = user_data.get(TRIP)
 
+    if route_watch.is_subscribed(user_data.get("watch_id")):
+        await context.bot.send_message(
+            chat_id=context.job.chat_id,
+            text="*Oops*, You already have a search in progress.",
+            parse_mode="Markdown",
+        )
+        return user_data.get(CURRENT_STATE, END)
+
     if task_id:
         # get active tasks
         tasks = await get_user_task(task_id)
@@ -496,109 +718,124 @@ async def start_search(context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     # reset old reservation data
     trip.reset_reservation_data()
-    # serialize the trip object
-    trip_ = pickle.dumps(trip)
-    # start the celery task
-    task = find_trip_and_reserve.delay(trip_)
-    # save the task id to the context
-    logger.info("SETTING TASK_ID: %s", task.id)
-    user_data["task_id"] = task.id
+    # subscribe to the watch of the route, shared with the other users on it
+    watch_id = watch_trip(trip)
+    logger.info("SETTING WATCH_ID: %s", watch_id)
+    user_data["watch_id"] = watch_id
 
     return user_data.get(CURRENT_STATE, END)
 
 
 async def check_search_status(context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Check the status of the task."""
+    """Check the status of the route watch."""
+    watch_id = context.job.data.get("watch_id")
+    logger.info("watch_id: %s", watch_id)
+    my_trip = route_watch.pop_result(watch_id)
+
+    if my_trip is None:
+        if route_watch.pop_expired(watch_id):
+            context.job.data["watch_id"] = None
+            await context.bot.send_message(
+                chat_id=context.job.chat_id,
+                text="Every trip of your search has departed, the search is stopped.",
+            )
+            context.job.schedule_removal()
+        elif not route_watch.is_subscribed(watch_id):
+            await context.bot.send_message(
+                chat_id=context.job.chat_id,
+                text="No search task in progress. Removing job.",
+            )
+            context.job.schedule_removal()
+        else:
+            # starts a new poller if the poller of the route is gone
+            ensure_route_poller(route_key(context.job.data.get(TRIP)))
+        return context.job.data.get(CURRENT_STATE, END)
+
+    logger.info("SETTING WATCH_ID: None")
+    context.job.data["watch_id"] = None
+    await hand_over_locked_trip(context, my_trip)
+
+    logger.info(
+        "This job: %s has completed its purpose, removing it.", context.job.name
+    )
+    # remove this job
+    context.job.schedule_removal()
+
+    return context.job.data.get(CURRENT_STATE, END)
+
+
+async def check_snipe_status(context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Check the status of the snipe_trip task."""
     task_id = context.job.data.get("task_id")
-    logger.info("task_id: %s", task_id)
-    task_ = None
     if task_id is None:
-        await context.bot.send_message(
-            chat_id=context.job.chat_id,
-            text="No search task in progress. Removing job.",
-        )
+        # the sniper is stopped by the user
         context.job.schedule_removal()
         return context.job.data.get(CURRENT_STATE, END)
+    result = AsyncResult(task_id)
+    if not result.ready():
+        return context.job.data.get(CURRENT_STATE, END)
 
-    # try active tasks first
-    tasks = await get_user_task(task_id)
-    if tasks:
-        logger.info("tasks len: %s", len(tasks))
-        for task in tasks:
-            logger.info("task_name : %s", task["name"])
-            if task["name"] != "tasks.celery_tasks.find_trip_and_reserve":
-                logger.info("No active search task in progress. Removing this job.")
-                context.job.schedule_removal()
-                return context.job.data.get(CURRENT_STATE, END)
-            elif task["id"] == task_id:
-                logger.info("Found search task with task_id: %s", task_id)
-                task_ = AsyncResult(task_id)
-
-    # maybe task finished before we checked active tasks, so try to get the result anyway
-    # if task if none
-    if task_ is None:
-        logger.info("Getting task with id: %s", task_id)
-        task_ = AsyncResult(task_id)
-
-    if task_.ready():
-        logger.info("Task is ready")
-        if not task_.successful():
-            # get the exception
-            logger.error("Search task failed. Removing this job.")
-            context.job.schedule_removal()
+    context.job.schedule_removal()
+    payload = result.result if result.successful() else None
+    if payload is None:
+        trip = context.job.data.get(TRIP)
+        if trip is not None and trip.is_expired():
+            text = "Every trip of your search has departed, the sniper is stopped."
+        else:
+            text = "Sales sniper stopped without a seat."
+        await context.bot.send_message(chat_id=context.job.chat_id, text=text)
+        return context.job.data.get(CURRENT_STATE, END)
 
-        logger.info("Getting the result of the task.")
-        result = task_.get()
-        my_trip = pickle.loads(result)
+    logger.info("SETTING TASK_ID: None")
+    context.job.data["task_id"] = None
+    await hand_over_locked_trip(
+        context, decode_trip(payload, context.job.data.get(PASSENGER))
+    )
+    return context.job.data.get(CURRENT_STATE, END)
 
-        logger.info("setting context trip")
-        context.job.data[TRIP] = my_trip
 
-        logger.info("SETTING TASK_ID: None")
-        context.job.data["task_id"] = None
-        logger.warning("Revoking task with id: %s", task_id)
-        task_.revoke()
+async def hand_over_locked_trip(context: ContextTypes.DEFAULT_TYPE, my_trip: Trip):
+    """Set the locked trip on the user, hand its lock over and notify the user."""
+    logger.info("setting context trip")
+    context.job.data[TRIP] = my_trip
 
-        logger.info("Starting job keep_seat_lock.")
-        context.job_queue.run_once(
-            keep_seat_lock,
-            3,
-            data=context.job.data,
-            chat_id=context.job.chat_id,
-            job_kwargs={"misfire_grace_time": 60},
-        )
-        logger.info("Job queue: %s", context.job_queue.jobs())
+    logger.info("Starting job keep_seat_lock.")
+    context.job_queue.run_once(
+        keep_seat_lock,
+        3,
+        data=context.job.data,
+        chat_id=context.job.chat_id,
+        job_kwargs={"misfire_grace_time": 60},
+    )
+    logger.info("Job queue: %s", context.job_queue.jobs())
 
-        logger.info(
-            "This job: %s has completed its purpose, removing it.", context.job.name
-        )
-        text = (
-            "FOUND TRIP!\n"
-            f"Reserved Trip: *{my_trip.trip_json.get('binisTarih')}*\n"
-            f"Reserved Vagon: *{my_trip.empty_seat_json.get('vagonSiraNo')}*\n"
-            f"Reserved Seat: *{my_trip.empty_seat_json.get('koltukNo')}*\n"
-        )
-        # notify the user
-        await context.bot.send_message(
-            chat_id=context.job.chat_id,
-            text=text,
-            parse_mode="Markdown",
+    from_station = my_trip.trip_json.get("binisIstasyonu", my_trip.from_station)
+    to_station = my_trip.trip_json.get("inisIstasyonu", my_trip.to_station)
+    text = (
+        "FOUND TRIP!\n"
+        f"Reserved Trip: *{my_trip.trip_json.get('binisTarih')}*\n"
+        f"Reserved Segment: *{from_station} - {to_station}*\n"
+        f"Reserved Vagon: *{my_trip.empty_seat_json.get('vagonSiraNo')}*\n"
+        f"Reserved Seat: *{my_trip.empty_seat_json.get('koltukNo')}*\n"
+    )
+    if my_trip.trip_json.get("detour"):
+        text += (
+            f"The seat is on a longer segment than {my_trip.from_station} - "
+            f"{my_trip.to_station}, detour: *{my_trip.trip_json['detour']}*\n"
         )
-
-        # remove this job
-        context.job.schedule_removal()
-
-    return context.job.data.get(CURRENT_STATE, END)
+    # notify the user
+    await context.bot.send_message(
+        chat_id=context.job.chat_id,
+        text=text,
+        parse_mode="Markdown",
+    )
 
 
 async def keep_seat_lock(context: ContextTypes.DEFAULT_TYPE) -> int:
     """Keep the seat lock until the user progresses to payment."""
     trip = context.job.data.get(TRIP)
-    task = keep_reserving_seat.delay(pickle.dumps(trip), context.job.chat_id)
-    logger.info("Setting task_id to context.user_data")
-    # save the task id to the context
-    logger.warning("SETTING TASK_ID: %s", task.id)
-    context.job.data["task_id"] = task.id
+    # renewed by the lock keeper service, see tasks.lock_keeper
+    lock_keeper.hold(context.job.chat_id, trip)
     return context.job.data.get(CURRENT_STATE, END)
 
 
@@ -627,11 +864,20 @@ async def proceed_to_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.callback_query.edit_message_text(text=text, reply_markup=keyboard)
         return context.user_data.get(CURRENT_STATE, END)
 
+    if route_watch.is_subscribed(context.user_data.get("watch_id")):
+        logger.info("You still have a search in progress.")
+        await update.callback_query.edit_message_text(
+            text="*You still have an ongoing search in progress.*",
+            reply_markup=keyboard,
+            parse_mode="Markdown",
+        )
+        return context.user_data.get(CURRENT_STATE, END)
+
     tasks = await get_user_task(task_id)
 
     if tasks:
         for task in tasks:
-            if task["name"] == "tasks.celery_tasks.find_trip_and_reserve":
+            if task["name"] == "tasks.celery_tasks.snipe_trip":
                 logger.info("You still have a task in progress.")
                 await update.callback_query.edit_message_text(
                     text="*You still have an ongoing search in progress.*",
@@ -640,27 +886,16 @@ async def proceed_to_payment(update: Update, context: ContextTypes.DEFAULT_TYPE)
                 )
                 return context.user_data.get(CURRENT_STATE, END)
 
-            elif task["name"] == "tasks.celery_tasks.keep_reserving_seat":
-                # stop the keep_seat_lock job to get the trip object
-                # then start it again to keep the seat lock in case payment fails
-                redis_client.set(task_id, 1, ex=600)
-                # wait for the task to finish but also with a timeout
-                task_ = AsyncResult(task_id)
-                trip_ = task_.get(timeout=30)
-                trip = pickle.loads(trip_)
-
-                logger.info("Trip from keep_reserving_seat aquired.")
-                logger.info("Setting context trip.")
-
-                context.user_data[TRIP] = trip
-                # keep the seat lock
-                job = context.job_queue.run_once(
-                    keep_seat_lock,
-                    3,
-                    data=context.user_data,
-                    chat_id=update.callback_query.message.chat_id,
-                    job_kwargs={"misfire_grace_time": 60},
-                )
+    # the lock keeper goes on renewing the lock in case payment fails, take the
+    # trip with its latest lock from it
+    held_trip = lock_keeper.get_trip(
+        update.callback_query.message.chat_id, context.user_data.get(PASSENGER)
+    )
+    if held_trip is not None:
+        logger.info("Trip from the lock keeper aquired.")
+        logger.info("Setting context trip.")
+        trip = held_trip
+        context.user_data[TRIP] = trip
 
     logger.info("We can proceed to payment. Everything looks fine.")
     # set the passenger object, for if the user has changed some information
@@ -722,7 +957,6 @@ async def check_payment(context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("Checking payment status.")
 
     p = context.job.data.get(PAYMENT)
-    task_id = context.job.data.get("task_id")
 
     try:
         if p.is_payment_success():
@@ -732,11 +966,8 @@ async def check_payment(context: ContextTypes.DEFAULT_TYPE) -> int:
             if p.ticket_reservation():
 
                 logger.info("ticket: %s", p.ticket_reservation_info)
-                logger.info("Stopping keep_seat_lock.")
-                redis_client.set(task_id, 1, ex=600)
-
-                task = AsyncResult(task_id)
-                task.revoke(timeout=30, terminate=True)
+                logger.info("Releasing the seat lock.")
+                lock_keeper.release(context.job.chat_id)
 
                 logger.info("Removing this job: %s", context.job.name)
                 context.job.schedule_removal()
@@ -771,7 +1002,7 @@ async def set_passenger(
     """Wrapper for init_passenger. Handles exceptions. See: init_passenger()"""
     try:
         logger.info("init_passenger")
-        init_passenger(update, context, mernis_check)
+        await init_passenger(update, context, mernis_check)
 
     except KeyError as feature:
         logger.error("KeyError: %s", feature)
@@ -787,7 +1018,11 @@ async def set_passenger(
         )
         return context.user_data.get(CURRENT_STATE, END)
 
-    except requests.exceptions.HTTPError as exc:
+    except (
+        requests.exceptions.HTTPError,
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+    ) as exc:
         logger.error("HTTPError: %s", exc)
         await update.message.reply_text(
             "Mernis verification failed. Please update your information first.",
@@ -795,7 +1030,9 @@ async def set_passenger(
         return context.user_data.get(CURRENT_STATE, END)
 
 
-def init_passenger(_: Update, context: ContextTypes.DEFAULT_TYPE, mernis_check=True):
+async def init_passenger(
+    _: Update, context: ContextTypes.DEFAULT_TYPE, mernis_check=True
+):
     """Handle the /init_passenger command. Sets user_data[PASSENGER]."""
     # get the message coming from command
 
@@ -840,7 +1077,7 @@ def init_passenger(_: Update, context: ContextTypes.DEFAULT_TYPE, mernis_check=T
     )
     # sometimes mernis check fails, so we need to retry
     if mernis_check:
-        TripSearchApi.is_mernis_correct(passenger)
+        await TripSearchApi.ais_mernis_correct(passenger)
 
     logger.info("Setting context passenger object.")
     context.user_data[PASSENGER] = passenger
@@ -898,7 +1135,9 @@ async def reset_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     logger.info("Resetting search.")
     keyboard = InlineKeyboardMarkup(SEARCH_MENU_BUTTONS)
     text = ""
-    removed_task = await remove_user_task(context)
+    removed_task = await remove_user_task(
+        context, update.callback_query.message.chat_id
+    )
     removed_queued_jobs = await remove_queued_jobs(context)
 
     if update.callback_query.data == "reset_search":
@@ -917,17 +1156,34 @@ async def reset_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     return context.user_data.get(CURRENT_STATE, END)
 
 
-async def remove_user_task(context: ContextTypes.DEFAULT_TYPE) -> bool:
-    """Remove the user jobs and tasks."""
+async def remove_user_task(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> bool:
+    """Remove the user jobs, tasks, route watch subscription and held seat lock."""
 
-    tasks = await get_user_task(context.user_data.get("task_id"))
-    if tasks:
-        task_id = context.user_data.get("task_id")
-        for task in tasks:
-            logger.info("Revoking task with id: %s", task_id)
-            task = AsyncResult(task_id)
-            task.revoke(terminate=True)
-            logger.warning("SETTING TASK_ID: None")
+    watch_id = context.user_data.get("watch_id")
+    unsubscribed = route_watch.unsubscribe(watch_id)
+    # a seat the poller locked before the subscription ended is not wanted anymore
+    locked_trip = route_watch.pop_result(watch_id)
+    if locked_trip is not None:
+        logger.info("Releasing the seat locked for watch: %s", watch_id)
+        await TripSearchApi.release_seat(
+            locked_trip.trip_json,
+            locked_trip.empty_seat_json,
+            locked_trip.seat_lock_response,
+        )
+    if unsubscribed or locked_trip is not None:
+        context.user_data["watch_id"] = None
+        return True
+
+    if lock_keeper.release(chat_id):
+        return True
+
+    task_id = context.user_data.get("task_id")
+    if await get_user_task(task_id):
+        logger.info("Stopping task with id: %s", task_id)
+        cancellation.request_stop(task_id)
+        # drops the task if it has not started yet
+        AsyncResult(task_id).revoke()
+        logger.warning("SETTING TASK_ID: None")
         context.user_data["task_id"] = None
         return True
     return False
@@ -1004,9 +1260,9 @@ async def get_set_current_trip(
 
     for task in tasks:
         task_ = AsyncResult(task["id"])
-        redis_client.set(task["id"], 1, ex=60)
+        cancellation.request_stop(task["id"])
         result = task_.get()
-        trip = pickle.loads(result)
+        trip = decode_trip(result, context.user_data.get(PASSENGER))
         context.user_data[TRIP] = trip
         context.job_queue.run_once(
             keep_seat_lock, 3, data=context.user_data, chat_id=update.message.chat_id
@@ -1058,6 +1314,12 @@ async def start_res(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             reply_markup=keyboard,
         )
         return context.user_data.get(CURRENT_STATE, END)
+    elif route_watch.is_subscribed(context.user_data.get("watch_id")):
+        await update.callback_query.edit_message_text(
+            text="You already have a task in progress",
+            reply_markup=keyboard,
+        )
+        return context.user_data.get(CURRENT_STATE, END)
     elif task_id:
         tasks = await get_user_task(task_id)
         if tasks:
@@ -1086,7 +1348,15 @@ async def start_res(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return context.user_data.get(CURRENT_STATE, END)
 
-    if available_workers() < 1:
+    if trip.is_expired():
+        await update.callback_query.edit_message_text(
+            text="Every trip of your search has departed. Please search again.",
+            reply_markup=keyboard,
+        )
+        return context.user_data.get(CURRENT_STATE, END)
+
+    # a route that is already watched needs no new worker
+    if not route_watch.is_watched(route_key(trip)) and available_workers() < 1:
         await update.callback_query.edit_message_text(
             text="No worker available. Please try again later.",
             reply_markup=keyboard,
@@ -1139,6 +1409,14 @@ async def search_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     else:
         text += "No queued jobs\n"
 
+    if route_watch.is_subscribed(context.user_data.get("watch_id")):
+        trip = context.user_data.get(TRIP)
+        text += "Watching route\n"
+        text += f"  {trip.from_station} - {trip.to_station}\n"
+
+    if lock_keeper.is_held(update.callback_query.message.chat_id):
+        text += "Holding seat lock\n"
+
     if task_id:
         tasks = await get_user_task(task_id)
         if tasks:
@@ -1253,7 +1531,7 @@ async def send_redis_key(_: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     # get chat_id
     stop_task_id = context.user_data.get("task_id")
 
-    redis_client.set(stop_task_id, 1, ex=600)
+    cancellation.request_stop(stop_task_id)
     logger.info("stop_task_id: %s", stop_task_id)
     return context.user_data.get(CURRENT_STATE, END)
 
@@ -0,0 +1,64 @@
+"""Tests of the retry classification of tasks.retry_policy.
+
+Run from src:
+
+    python -m unittest discover tests
+"""
+
+import os
+import unittest
+
+# the tasks package logs to ../bot_data/logs, see tasks/__init__.py
+os.makedirs("../bot_data/logs", exist_ok=True)
+
+# pylint: disable=wrong-import-position
+import api_constants
+from tasks.retry_policy import (
+    CircuitBreaker,
+    RetryPolicy,
+    TcddApiError,
+    get_policy,
+    is_retryable,
+)
+
+
+def api_error(endpoint, code):
+    return TcddApiError(
+        endpoint, {"cevapBilgileri": {"cevapKodu": code, "cevapMsj": "HATA"}}
+    )
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def send_failing(self, endpoint, code, policy):
+        calls = []
+
+        def send():
+            calls.append(1)
+            raise api_error(endpoint, code)
+
+        with self.assertRaises(TcddApiError):
+            policy.call(endpoint, send, CircuitBreaker())
+        return len(calls)
+
+    def test_transient_code_is_retried_on_idempotent_policy(self):
+        endpoint = api_constants.TRIP_SEARCH_ENDPOINT
+        policy = RetryPolicy(max_attempts=3, base_delay=0)
+        self.assertTrue(is_retryable(api_error(endpoint, "999")))
+        self.assertEqual(self.send_failing(endpoint, "999", policy), 3)
+
+    def test_transient_code_is_not_retried_on_non_idempotent_policy(self):
+        for endpoint in (
+            api_constants.TICKET_RESERVATION_ENDPOINT,
+            api_constants.VB_ENROLL_CONTROL_ENDPOINT,
+        ):
+            with self.subTest(endpoint=endpoint):
+                policy = get_policy(endpoint)
+                self.assertFalse(policy.idempotent)
+                self.assertFalse(
+                    is_retryable(api_error(endpoint, "999"), idempotent=False)
+                )
+                self.assertEqual(self.send_failing(endpoint, "999", policy), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()